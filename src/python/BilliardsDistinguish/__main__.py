@@ -0,0 +1,5 @@
+import sys
+from BilliardsDistinguish.cli import main
+
+
+sys.exit(main())
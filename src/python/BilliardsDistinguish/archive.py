@@ -0,0 +1,303 @@
+'''archive of billiards regions for fast replay.
+
+    Replaying archived pictures decodes every JPEG again, which is much
+    slower than classifying the billiards in it. pack_archive decodes the
+    billiards region of each picture once and appends its raw RGB pixels to
+    one file, every frame has the same size, so frame i is at offset
+    i * height * width * 3. An index beside it (the file name with ".json")
+    keeps the position, file names and labels of the frames.
+
+    FrameArchive maps the file into memory, its frames are views of the
+    mapping, nothing is copied or decoded, and worker processes of
+    replay_archive share the same mapped pages.
+'''
+
+
+import csv
+import json
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import timeit
+import unittest
+from collections import OrderedDict
+import numpy
+from PIL import Image
+from BilliardsDistinguish.batch import list_image_files
+from BilliardsDistinguish.calibration import load_correction
+from BilliardsDistinguish.decode import open_region
+from BilliardsDistinguish.detector import BallDetector
+from BilliardsDistinguish.tuning import get_label
+
+# version of the files of the archive
+ARCHIVE_VERSION = 1
+
+# count of frames classified by a worker process at a time
+DEFAULT_CHUNK_SIZE = 256
+
+
+def get_index_filename(filename):
+    return filename + ".json"
+
+def pack_archive(filenames, filename, position):
+    '''decode the billiards of pictures and write them to an archive.
+
+    Args:
+        filenames: iterable of picture file names.
+        filename: file name of the archive, the index is written to
+            get_index_filename(filename).
+        position: (left, top, width, height) of the billiards.
+
+    Returns:
+        list of (file name, error message) of pictures not packed.
+    '''
+    names = []
+    labels = []
+    errors = []
+    with open(filename, "wb") as fp:
+        for name in filenames:
+            try:
+                pixels = numpy.asarray(open_region(name, position))
+            except Exception as e:
+                # a corrupt picture is reported and skipped, the archive is
+                # still written
+                errors.append((name, str(e) or e.__class__.__name__))
+                continue
+            fp.write(pixels.tobytes())
+            names.append(name)
+            labels.append(get_label(name))
+    index = OrderedDict((("version", ARCHIVE_VERSION),
+                         ("position", list(position)),
+                         ("count", len(names)),
+                         ("filenames", names),
+                         ("labels", labels)))
+    with open(get_index_filename(filename), "w") as fp:
+        json.dump(index, fp)
+    return errors
+
+
+class FrameArchive(object):
+    '''read only archive written by pack_archive.
+
+    Attributes:
+        filename: file name of the archive.
+        position: (left, top, width, height) of the billiards.
+        filenames: file names of the pictures of the frames.
+        labels: numbers of the billiards of the frames, None if not labeled.
+        frames: read only numpy uint8 array with shape (count, height,
+            width, 3), mapped from the archive.
+    '''
+    def __init__(self, filename):
+        with open(get_index_filename(filename)) as fp:
+            index = json.load(fp)
+        assert index["version"] == ARCHIVE_VERSION
+        self.filename = filename
+        self.position = tuple(index["position"])
+        self.filenames = index["filenames"]
+        self.labels = index["labels"]
+        x, y, w, h = self.position
+        shape = (index["count"], h, w, 3)
+        assert os.path.getsize(filename) == numpy.prod(shape)
+        if index["count"] == 0:
+            # an empty file can not be mapped
+            self.frames = numpy.zeros(shape, dtype=numpy.uint8)
+            self.frames.flags.writeable = False
+        else:
+            self.frames = numpy.memmap(filename, numpy.uint8, "r", shape=shape)
+
+    def __len__(self):
+        return len(self.frames)
+
+    def __getitem__(self, i):
+        return self.frames[i]
+
+    def __reduce__(self):
+        # worker processes map the file again instead of copying the frames
+        return (FrameArchive, (self.filename,))
+
+    def get_image(self, i):
+        '''frame i as a read only PIL.Image sharing memory with the mapping.'''
+        x, y, w, h = self.position
+        return Image.frombuffer("RGB", (w, h), self.frames[i], "raw", "RGB",
+                                0, 1)
+
+    def get_detector(self):
+        '''BallDetector of the billiards of the frames.'''
+        return BallDetector(self.position)
+
+
+def classify_archive(archive, detector=None, start=0, stop=None):
+    '''classify frames of an archive in the current process.
+
+    Args:
+        archive: an instance of FrameArchive.
+        detector(option): an instance of BallDetector, with the same size as
+            the position of the archive, default: archive.get_detector()
+        start, stop(option): range of frames. default: all frames
+
+    Returns:
+        list of numbers of the billiards, None if unknown.
+    '''
+    if detector is None:
+        detector = archive.get_detector()
+    if stop is None:
+        stop = len(archive)
+    return [detector.classify_features(detector.get_array_features(frame))
+            for frame in archive.frames[start:stop]]
+
+# archives opened by this worker process, by file name
+_worker_archives = {}
+
+def _classify_chunk(args):
+    filename, detector, start, stop = args
+    archive = _worker_archives.get(filename)
+    if archive is None:
+        archive = _worker_archives[filename] = FrameArchive(filename)
+    return classify_archive(archive, detector, start, stop)
+
+def replay_archive(archive, detector=None, processes=None,
+                   chunk_size=DEFAULT_CHUNK_SIZE):
+    '''classify all frames of an archive with a pool of worker processes.
+
+    Args:
+        archive: an instance of FrameArchive.
+        detector(option): see classify_archive.
+        processes(option): count of worker processes, default: count of cpus,
+            1 classifies in the current process.
+        chunk_size(option): count of frames sent to a worker at a time.
+
+    Returns:
+        list of numbers of the billiards, None if unknown.
+    '''
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    assert processes > 0 and chunk_size > 0
+    if processes == 1:
+        return classify_archive(archive, detector)
+    chunks = [(archive.filename, detector, start,
+               min(start + chunk_size, len(archive)))
+              for start in xrange(0, len(archive), chunk_size)]
+    pool = multiprocessing.Pool(processes)
+    try:
+        results = pool.map(_classify_chunk, chunks)
+    finally:
+        pool.terminate()
+        pool.join()
+    return [number for result in results for number in result]
+
+def add_pack_arguments(parser):
+    parser.add_argument("inputs", nargs="+",
+                        help="directories or glob patterns of pictures")
+    parser.add_argument("--position", type=int, nargs=4, required=True,
+                        metavar=("LEFT", "TOP", "WIDTH", "HEIGHT"),
+                        help="position of the billiards in the pictures")
+    parser.add_argument("--output", required=True,
+                        help="file name of the archive")
+    parser.set_defaults(func=pack_command)
+
+def pack_command(args):
+    filenames = [filename for pattern in args.inputs
+                 for filename in list_image_files(pattern)]
+    start = timeit.default_timer()
+    errors = pack_archive(filenames, args.output, tuple(args.position))
+    for filename, error in errors:
+        sys.stderr.write("%s: %s\n" % (filename, error))
+    sys.stderr.write("%d frames packed in %.2fs\n" %
+                     (len(filenames) - len(errors),
+                      timeit.default_timer() - start))
+    return 0
+
+def add_replay_arguments(parser):
+    parser.add_argument("archive", help="file name of the archive")
+    parser.add_argument("--processes", type=int, default=None,
+                        help="count of worker processes, default: cpu count")
+    parser.add_argument("--output", default=None,
+                        help="CSV of filename, label and number of each "
+                        "frame, default: not written")
+    parser.add_argument("--correction", metavar="FILE",
+                        help="color correction of the camera, see calibrate")
+    parser.set_defaults(func=replay_command)
+
+def replay_command(args):
+    archive = FrameArchive(args.archive)
+    start = timeit.default_timer()
+    detector = archive.get_detector()
+    if args.correction is not None:
+        detector = detector.replace(
+            correction=load_correction(args.correction))
+    numbers = replay_archive(archive, detector, args.processes)
+    seconds = timeit.default_timer() - start
+    labeled = [(label, number) for label, number in
+               zip(archive.labels, numbers) if label is not None]
+    print "%d frames in %.2fs, %.0f frames/s" % \
+        (len(numbers), seconds, len(numbers) / max(seconds, 1e-9))
+    if labeled:
+        print "%d/%d labeled frames correct" % \
+            (sum(label == number for label, number in labeled), len(labeled))
+    if args.output is not None:
+        with open(args.output, "wb") as out:
+            writer = csv.writer(out)
+            writer.writerow(("filename", "label", "number"))
+            writer.writerows(zip(archive.filenames, archive.labels, numbers))
+    return 0
+
+
+
+###############################################################################
+# for unit test
+###############################################################################
+class ArchiveTest(unittest.TestCase):
+    PICTURE_DIR = "../../../pictures/VGA"
+    POSITION = (215, 130, 265, 265)
+
+    def setUp(self):
+        self._directory = tempfile.mkdtemp()
+        self._filename = os.path.join(self._directory, "frames.bin")
+
+    def tearDown(self):
+        shutil.rmtree(self._directory)
+
+    def test_pack(self):
+        filenames = list_image_files(os.path.join(self.PICTURE_DIR, "1*_a.jpg"))
+        errors = pack_archive(filenames + ["not_exist.jpg"], self._filename,
+                              self.POSITION)
+        self.assertEqual([error[0] for error in errors], ["not_exist.jpg"])
+        archive = FrameArchive(self._filename)
+        self.assertEqual(len(archive), len(filenames))
+        self.assertEqual(archive.filenames, filenames)
+        self.assertEqual(archive.labels, [get_label(name) for name in filenames])
+        self.assertEqual(archive.frames.shape, (len(filenames), 265, 265, 3))
+        self.assertFalse(archive.frames.flags.writeable)
+        region = open_region(filenames[1], self.POSITION)
+        self.assertTrue(numpy.array_equal(archive[1], numpy.asarray(region)))
+        self.assertEqual(archive.get_image(1).tobytes(), region.tobytes())
+
+    def test_pack_otherError(self):
+        filenames = list_image_files(os.path.join(self.PICTURE_DIR, "9_*.jpg"))
+        # open(None) raises TypeError, not IOError
+        errors = pack_archive(filenames[:1] + [None] + filenames[1:],
+                              self._filename, self.POSITION)
+        self.assertEqual([error[0] for error in errors], [None])
+        self.assertEqual(FrameArchive(self._filename).filenames, filenames)
+
+    def test_replay(self):
+        import pickle
+        from BilliardsDistinguish.batch import classify_image_file
+        filenames = list_image_files(self.PICTURE_DIR)
+        pack_archive(filenames, self._filename, self.POSITION)
+        archive = FrameArchive(self._filename)
+        expected = [classify_image_file(name, self.POSITION)["number"]
+                    for name in filenames]
+        self.assertEqual(replay_archive(archive, processes=1), expected)
+        self.assertEqual(replay_archive(archive, processes=2, chunk_size=5),
+                         expected)
+        copy = pickle.loads(pickle.dumps(archive))
+        self.assertTrue(numpy.array_equal(copy.frames, archive.frames))
+
+    def test_empty(self):
+        pack_archive([], self._filename, self.POSITION)
+        archive = FrameArchive(self._filename)
+        self.assertEqual(len(archive), 0)
+        self.assertEqual(replay_archive(archive, processes=1), [])
@@ -0,0 +1,308 @@
+'''classify many pictures of billiards with a pool of worker processes.
+
+    Every worker opens, cuts and classifies its pictures independently, the
+    detector is sent to each worker once when the pool starts, the
+    results are streamed back in the order of the input files, at most
+    `window` pictures are in flight at any time, so memory stays bounded no
+    matter how many pictures are classified.
+'''
+
+
+import csv
+import glob
+import json
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from collections import OrderedDict, deque
+from BilliardsDistinguish.detector import BallDetector, default_detector
+from BilliardsDistinguish.feature_store import DEFAULT_CAPACITY, \
+    FeatureStore, get_file_feature_key
+
+# fields of each result, in output order
+RESULT_FIELDS = ("filename", "number", "total_pixels", "white_pixels",
+                 "r", "g", "b", "error")
+
+# fields of features, see get_ellipse_color_features
+FEATURE_FIELDS = ("total_pixels", "white_pixels", "r", "g", "b")
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".bmp")
+
+
+def list_image_files(pattern):
+    '''list pictures to classify.
+
+    Args:
+        pattern: a directory, all pictures in it are listed, or a glob
+            pattern like "pictures/VGA/*_a.jpg".
+
+    Returns:
+        sorted list of file names.
+    '''
+    if os.path.isdir(pattern):
+        return sorted(os.path.join(pattern, name)
+                      for name in os.listdir(pattern)
+                      if name.lower().endswith(IMAGE_EXTENSIONS))
+    return sorted(glob.glob(pattern))
+
+def classify_image_file(filename, position):
+    '''decode the billiards at position of a picture and classify it, only
+    the rows down to the billiards are decoded, see open_region.
+
+    Args:
+        filename: file name of the picture.
+        position: (left, top, width, height) of the billiards in the picture,
+            or an instance of BallDetector.
+
+    Returns:
+        OrderedDict with RESULT_FIELDS as keys, number and features are None
+        and error is set when the picture can not be processed.
+    '''
+    detector = _get_detector(position)
+    try:
+        features = detector.get_features(detector.open(filename))
+    except Exception as e:
+        # any failure of one picture, e.g. of a corrupt file, is reported in
+        # its result instead of aborting the batch in a worker process
+        result = OrderedDict((field, None) for field in RESULT_FIELDS)
+        result["filename"] = filename
+        result["error"] = str(e) or e.__class__.__name__
+        return result
+    return _get_result(filename, features, detector)
+
+# detector of this worker process, set by _init_worker
+_worker_detector = None
+
+def _init_worker(detector):
+    global _worker_detector
+    _worker_detector = detector
+
+def _classify_in_worker(filename):
+    return classify_image_file(filename, _worker_detector)
+
+def _get_detector(position):
+    if isinstance(position, BallDetector):
+        return position
+    if position is None:
+        return default_detector()
+    return BallDetector(position)
+
+def _get_result(filename, features, detector):
+    total_pixels, white_pixels, r, g, b = features
+    result = OrderedDict((field, None) for field in RESULT_FIELDS)
+    result["filename"] = filename
+    result["number"] = detector.classify_features(features)
+    result["total_pixels"] = total_pixels
+    result["white_pixels"] = white_pixels
+    result["r"] = r
+    result["g"] = g
+    result["b"] = b
+    return result
+
+
+class _Done(object):
+    '''a result known when submitted, has get() like AsyncResult.'''
+    def __init__(self, result):
+        self._result = result
+
+    def get(self):
+        return self._result
+
+
+def classify_image_files(filenames, position=None, processes=None, window=None,
+                         store=None):
+    '''classify pictures with a pool of worker processes.
+
+    Args:
+        filenames: iterable of picture file names, consumed lazily.
+        position(option): (left, top, width, height) of the billiards, or an
+            instance of BallDetector, default: default_detector()
+        processes(option): count of worker processes, default: count of cpus,
+            1 classifies in the current process.
+        window(option): max count of pictures in flight,
+            default: 4 * processes
+        store(option): an instance of FeatureStore, pictures in it are not
+            decoded, features of other pictures are put in it.
+
+    Returns:
+        generator of results of classify_image_file, in order of filenames.
+    '''
+    detector = _get_detector(position)
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    assert processes > 0
+    if window is None:
+        window = 4 * processes
+    pool = None
+    if processes > 1:
+        pool = multiprocessing.Pool(processes, _init_worker, (detector,))
+
+    def submit(filename):
+        key = None
+        if store is not None:
+            try:
+                key = get_file_feature_key(filename, detector.position,
+                                           detector.white_max_saturation,
+                                           detector.white_min_lightness,
+                                           detector.correction)
+            except IOError:
+                pass  # classify_image_file reports the error
+            else:
+                features = store.get(key)
+                if features is not None:
+                    return None, _Done(_get_result(filename, features,
+                                                   detector))
+        if pool is None:
+            return key, _Done(classify_image_file(filename, detector))
+        return key, pool.apply_async(_classify_in_worker, (filename,))
+
+    def finish(item):
+        key, pending = item
+        result = pending.get()
+        if key is not None and result["error"] is None:
+            store.put(key, [result[field] for field in FEATURE_FIELDS])
+        return result
+
+    try:
+        pending = deque()
+        for filename in filenames:
+            pending.append(submit(filename))
+            if pool is None or len(pending) >= window:
+                yield finish(pending.popleft())
+        while pending:
+            yield finish(pending.popleft())
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
+def write_results(results, out, format="csv"):
+    '''write results to a file one line per result, each line is flushed as
+    soon as it is written.
+
+    Args:
+        results: iterable of results of classify_image_file.
+        out: a file object.
+        format(option): "csv" with a header line or "json" for JSON lines.
+            default: "csv"
+    '''
+    assert format in ("csv", "json")
+    if format == "csv":
+        writer = csv.writer(out)
+        writer.writerow(RESULT_FIELDS)
+    for result in results:
+        if format == "csv":
+            writer.writerow([result[field] for field in RESULT_FIELDS])
+        else:
+            out.write(json.dumps(result) + "\n")
+        out.flush()
+
+def add_arguments(parser):
+    parser.add_argument("inputs", nargs="+",
+                        help="directories or glob patterns of pictures")
+    parser.add_argument("--position", type=int, nargs=4,
+                        metavar=("LEFT", "TOP", "WIDTH", "HEIGHT"),
+                        help="position of the billiards in the pictures")
+    parser.add_argument("--processes", type=int, default=None,
+                        help="count of worker processes, default: cpu count")
+    parser.add_argument("--format", choices=("csv", "json"), default="csv")
+    parser.add_argument("--output", default=None,
+                        help="output file, default: standard output")
+    parser.add_argument("--cache", default=None, metavar="DIRECTORY",
+                        help="feature store, pictures in it are not decoded")
+    parser.add_argument("--cache-size", type=int, default=None,
+                        help="max count of pictures in a new feature store, "
+                        "default: %d, an existing store keeps its size" %
+                        DEFAULT_CAPACITY)
+    parser.add_argument("--correction", metavar="FILE",
+                        help="color correction of the camera, see calibrate")
+    parser.set_defaults(func=command)
+
+def command(args):
+    def filenames():
+        for pattern in args.inputs:
+            for filename in list_image_files(pattern):
+                yield filename
+    store = None
+    if args.cache is not None:
+        store = FeatureStore(args.cache, args.cache_size)
+    # calibration imports this module
+    from BilliardsDistinguish.calibration import get_command_detector
+    detector = get_command_detector(args.position, args.correction)
+    results = classify_image_files(filenames(), detector, args.processes,
+                                   store=store)
+    try:
+        if args.output is None:
+            write_results(results, sys.stdout, args.format)
+        else:
+            with open(args.output, "wb") as out:
+                write_results(results, out, args.format)
+    finally:
+        if store is not None:
+            store.close()
+            sys.stderr.write("feature store: %d hits, %d misses\n" %
+                             (store.hits, store.misses))
+    return 0
+
+
+
+###############################################################################
+# for unit test
+###############################################################################
+class BatchTest(unittest.TestCase):
+    PICTURE_DIR = "../../../pictures/VGA"
+
+    def test_listImageFiles(self):
+        filenames = list_image_files(self.PICTURE_DIR)
+        self.assertEqual(filenames, sorted(filenames))
+        self.assertEqual(list_image_files(os.path.join(self.PICTURE_DIR, "9_*.jpg")),
+                         [os.path.join(self.PICTURE_DIR, name)
+                          for name in ("9_a.jpg", "9_b.jpg", "9_c.jpg")])
+
+    def test_classifyImageFiles(self):
+        filenames = list_image_files(os.path.join(self.PICTURE_DIR, "1*_a.jpg"))
+        position = (215, 130, 265, 265)
+        serial = list(classify_image_files(filenames, position, processes=1))
+        pooled = list(classify_image_files(filenames, position, processes=2,
+                                           window=2))
+        self.assertEqual(serial, pooled)
+        self.assertEqual([r["filename"] for r in serial], filenames)
+        self.assertEqual([r["error"] for r in serial], [None] * len(filenames))
+
+    def test_classifyImageFiles_store(self):
+        filenames = list_image_files(os.path.join(self.PICTURE_DIR, "1*_a.jpg"))
+        filenames.append("not_exist.jpg")
+        position = (215, 130, 265, 265)
+        directory = tempfile.mkdtemp()
+        try:
+            store = FeatureStore(directory, 16)
+            first = list(classify_image_files(filenames, position, 1,
+                                              store=store))
+            self.assertEqual(len(store), len(filenames) - 1)
+            second = list(classify_image_files(filenames, position, 2,
+                                               store=store))
+            self.assertEqual(first, second)
+            self.assertEqual(store.hits, len(filenames) - 1)
+        finally:
+            shutil.rmtree(directory)
+
+    def test_classifyImageFile_error(self):
+        result = classify_image_file("not_exist.jpg", (0, 0, 1, 1))
+        self.assertEqual(result["number"], None)
+        self.assertNotEqual(result["error"], None)
+
+    def test_classifyImageFiles_otherError(self):
+        class BrokenDetector(BallDetector):
+            def open(self, filename):
+                if filename.endswith("9_b.jpg"):
+                    raise RuntimeError()
+                return BallDetector.open(self, filename)
+        filenames = list_image_files(os.path.join(self.PICTURE_DIR, "9_*.jpg"))
+        results = list(classify_image_files(
+            filenames, BrokenDetector((215, 130, 265, 265)), processes=1))
+        self.assertEqual([r["filename"] for r in results], filenames)
+        self.assertEqual([r["error"] for r in results],
+                         [None, "RuntimeError", None])
@@ -0,0 +1,256 @@
+'''benchmarks of the hot paths of image_process and billiards_distinguish.
+
+    Benchmarks run over the bundled pictures/VGA and pictures/720p sets and
+    synthetic larger crops, results are written as JSON, and can be compared
+    with a saved baseline to find regressions:
+
+        python -m BilliardsDistinguish bench --output baseline.json
+        python -m BilliardsDistinguish bench --baseline baseline.json
+'''
+
+
+import json
+import os
+import platform
+import resource
+import sys
+import time
+import timeit
+import unittest
+from collections import OrderedDict
+import numpy
+import PIL
+from PIL import Image, ImageDraw
+from BilliardsDistinguish import batch
+from BilliardsDistinguish.image_process import cut_region_in_image, \
+    create_ellipse_mask_image, get_ellipse_histogram_of_image, \
+    get_ellipse_color_features, draw_ellipse_histogram_hsl, smooth_histogram, \
+    _filterList
+
+DEFAULT_PICTURE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                   "..", "..", "..", "pictures")
+
+# (name, sub directory of pictures, position of billiards)
+PICTURE_SETS = (("VGA", "VGA", (215, 130, 265, 265)),
+                ("720p", "720p", (585, 165, 415, 415)))
+
+# (name, size) of synthetic crops
+SYNTHETIC_SETS = (("synthetic800", 800), ("synthetic1200", 1200))
+
+# a benchmark regresses when it is slower than the baseline by this ratio
+DEFAULT_TOLERANCE = 0.10
+
+
+def create_synthetic_crop(size, seed=0):
+    '''create a picture of a striped billiards with given size, filled the
+    whole picture, with some noise, same seed gives same picture.
+    '''
+    im = Image.new("RGB", (size, size), "rgb(250,250,250)")
+    draw = ImageDraw.Draw(im, "RGB")
+    draw.ellipse((0, 0, size, size), fill="rgb(30,60,170)")
+    draw.rectangle((0, size / 3, size, 2 * size / 3), fill="rgb(240,240,235)")
+    pixels = numpy.asarray(im).astype(numpy.int16)
+    noise = numpy.random.RandomState(seed).randint(-12, 13, pixels.shape)
+    pixels = numpy.clip(pixels + noise, 0, 255).astype(numpy.uint8)
+    return Image.fromarray(pixels, "RGB")
+
+def _get_peak_rss_kb():
+    '''peak resident memory of this process in KB.'''
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        peak = peak / 1024
+    return peak
+
+def _get_cases(picture_dir, quick=False):
+    '''return list of (name, function, frames count of one call).'''
+    cases = []
+    sets = []
+    for name, directory, position in PICTURE_SETS:
+        filenames = batch.list_image_files(os.path.join(picture_dir, directory))
+        if quick:
+            filenames = filenames[:4]
+        x, y, w, h = position
+        crops = []
+        for filename in filenames:
+            im = Image.open(filename)
+            crops.append(cut_region_in_image(im, x, y, w, h).convert("RGB"))
+        sets.append((name, crops, filenames, position))
+        if quick:
+            break
+    if not quick:
+        for name, size in SYNTHETIC_SETS:
+            sets.append((name, [create_synthetic_crop(size, seed)
+                                for seed in range(2)], None, None))
+
+    for name, crops, filenames, position in sets:
+        def mask(crops=crops):
+            for im in crops:
+                create_ellipse_mask_image(im.size[0], im.size[1], im)
+        def histogram(crops=crops):
+            for im in crops:
+                get_ellipse_histogram_of_image(im, masked=True)
+        def features(crops=crops):
+            for im in crops:
+                get_ellipse_color_features(im)
+        def histogram_hsl(im=crops[0]):
+            draw_ellipse_histogram_hsl(im.copy(), masked=False)
+        cases.append(("create_ellipse_mask_image/" + name, mask, len(crops)))
+        cases.append(("get_ellipse_histogram_of_image/" + name, histogram,
+                      len(crops)))
+        cases.append(("get_ellipse_color_features/" + name, features,
+                      len(crops)))
+        cases.append(("draw_ellipse_histogram_hsl/" + name, histogram_hsl, 1))
+        if filenames is not None:
+            def process(filenames=filenames, position=position):
+                for filename in filenames:
+                    batch.classify_image_file(filename, position)
+            cases.append(("process_image/" + name, process, len(filenames)))
+
+    histogram_ = get_ellipse_histogram_of_image(sets[0][1][0])
+    def smooth(histogram_=histogram_):
+        smooth_histogram(list(histogram_))
+    def filter_list():
+        _filterList(range(256), [1] * 41)
+    cases.append(("smooth_histogram", smooth, 1))
+    cases.append(("_filterList", filter_list, 1))
+    return cases
+
+def run_benchmarks(picture_dir=None, repeat=5, quick=False, names=None):
+    '''run benchmarks.
+
+    Args:
+        picture_dir(option): directory of pictures, default: the bundled ones.
+        repeat(option): count of timed calls of each benchmark. default: 5
+        quick(option): only run 4 pictures of VGA and no synthetic crops.
+        names(option): names of benchmarks to run, default: all.
+
+    Returns:
+        OrderedDict with "meta" and "results", results of each benchmark has
+        the median and best seconds of one call, frames/s computed from the
+        median, and peak memory of the process after the benchmark.
+    '''
+    if picture_dir is None:
+        picture_dir = DEFAULT_PICTURE_DIR
+    results = OrderedDict()
+    for name, func, frames in _get_cases(picture_dir, quick):
+        if names and name not in names:
+            continue
+        func()
+        peakBefore = _get_peak_rss_kb()
+        times = []
+        for i in range(repeat):
+            start = timeit.default_timer()
+            func()
+            times.append(timeit.default_timer() - start)
+        times.sort()
+        median = times[len(times) / 2]
+        peak = _get_peak_rss_kb()
+        results[name] = OrderedDict((
+            ("seconds", median),
+            ("best_seconds", times[0]),
+            ("frames", frames),
+            ("seconds_per_frame", median / frames),
+            ("frames_per_second", frames / median if median > 0 else None),
+            ("peak_rss_kb", peak),
+            ("peak_rss_growth_kb", peak - peakBefore)))
+    meta = OrderedDict((
+        ("time", time.strftime("%Y-%m-%dT%H:%M:%S")),
+        ("python", platform.python_version()),
+        ("pil", getattr(PIL, "__version__", None)),
+        ("numpy", numpy.__version__),
+        ("platform", platform.platform()),
+        ("repeat", repeat),
+        ("quick", quick)))
+    return OrderedDict((("meta", meta), ("results", results)))
+
+def compare_benchmarks(current, baseline, tolerance=DEFAULT_TOLERANCE):
+    '''compare results of run_benchmarks with a baseline.
+
+    Returns:
+        list of (name, baseline seconds, current seconds, ratio) of all
+        benchmarks in both, and list of names of regressed benchmarks, whose
+        ratio current / baseline is greater than 1 + tolerance. Seconds are
+        the best seconds per frame, which is less noisy than the median.
+    '''
+    def seconds(result):
+        return float(result["best_seconds"]) / result["frames"]
+    rows = []
+    regressions = []
+    for name, result in current["results"].items():
+        base = baseline["results"].get(name)
+        if base is None or not base["best_seconds"]:
+            continue
+        ratio = seconds(result) / seconds(base)
+        rows.append((name, seconds(base), seconds(result), ratio))
+        if ratio > 1 + tolerance:
+            regressions.append(name)
+    return rows, regressions
+
+def format_benchmarks(results):
+    lines = []
+    for name, result in results["results"].items():
+        lines.append("%-45s %10.3fms %10.1f frames/s %8dKB" %
+                     (name, result["seconds"] * 1000,
+                      result["frames_per_second"] or 0, result["peak_rss_kb"]))
+    return "\n".join(lines)
+
+def add_arguments(parser):
+    parser.add_argument("--pictures", default=None,
+                        help="directory with VGA and 720p pictures")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--quick", action="store_true",
+                        help="only run few VGA pictures")
+    parser.add_argument("--only", nargs="+", default=None, metavar="NAME",
+                        help="names of benchmarks to run")
+    parser.add_argument("--output", default=None,
+                        help="write results to this JSON file")
+    parser.add_argument("--baseline", default=None,
+                        help="compare with results in this JSON file")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE,
+                        help="allowed slow down ratio before regression")
+    parser.set_defaults(func=command)
+
+def command(args):
+    results = run_benchmarks(args.pictures, args.repeat, args.quick, args.only)
+    print format_benchmarks(results)
+    if args.output is not None:
+        with open(args.output, "w") as fp:
+            json.dump(results, fp, indent=2)
+    if args.baseline is None:
+        return 0
+    with open(args.baseline) as fp:
+        baseline = json.load(fp)
+    rows, regressions = compare_benchmarks(results, baseline, args.tolerance)
+    for name, base, current, ratio in rows:
+        flag = "REGRESSION" if name in regressions else ""
+        print "%-45s %10.3fms -> %10.3fms per frame %6.2fx %s" % \
+            (name, base * 1000, current * 1000, ratio, flag)
+    return 1 if regressions else 0
+
+
+
+###############################################################################
+# for unit test
+###############################################################################
+class BenchmarkTest(unittest.TestCase):
+    def test_createSyntheticCrop(self):
+        im = create_synthetic_crop(100)
+        self.assertEqual(im.size, (100, 100))
+        self.assertEqual(im.tobytes(), create_synthetic_crop(100).tobytes())
+
+    def test_runBenchmarks(self):
+        results = run_benchmarks(repeat=1, quick=True,
+                                 names=["get_ellipse_color_features/VGA",
+                                        "smooth_histogram"])
+        self.assertEqual(results["results"].keys(),
+                         ["get_ellipse_color_features/VGA", "smooth_histogram"])
+        self.assertEqual(results["results"]["smooth_histogram"]["frames"], 1)
+
+    def test_compareBenchmarks(self):
+        def results(**seconds):
+            return {"results": dict((name, {"best_seconds": value, "frames": 1})
+                                    for name, value in seconds.items())}
+        rows, regressions = compare_benchmarks(results(a=1.2, b=1.05, c=1.0),
+                                               results(a=1.0, b=1.0))
+        self.assertEqual(sorted(row[0] for row in rows), ["a", "b"])
+        self.assertEqual(regressions, ["a"])
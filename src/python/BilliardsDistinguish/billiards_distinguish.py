@@ -1,4 +1,11 @@
 import colorsys
+import hashlib
+import os
+import shutil
+import tempfile
+import unittest
+import numpy
+from BilliardsDistinguish.profiling import profiled
 
 
 
@@ -10,6 +17,15 @@ DEFAULT_HUE_1_3_5_H = 0.166667
 DEFAULT_HUE_2_6_H = 0.500000
 DEFAULT_HUE_4_7_8_H = 0.833333
 
+# a color is black when its max band is less than DEFAULT_BLACK_MAX_BRIGHT
+# and max band - min band is less than DEFAULT_BLACK_MAX_RANGE
+DEFAULT_BLACK_MAX_BRIGHT = 75
+DEFAULT_BLACK_MAX_RANGE = 20
+
+# directory to save color tables, see load_billiards_color_table
+DEFAULT_COLOR_TABLE_DIR = os.path.join(os.path.expanduser("~"), ".cache",
+                                       "BilliardsDistinguish")
+
 
 class BilliardsType(object):
     White = -1
@@ -46,11 +62,12 @@ def _is_black(r, g, b):
     max_ = max(r, g, b)
     min_ = min(r, g, b)
 
-    if max_ < 75 and max_ - min_ < 20:
+    if max_ < DEFAULT_BLACK_MAX_BRIGHT and max_ - min_ < DEFAULT_BLACK_MAX_RANGE:
         return True
     else:
         return False
 
+@profiled("get_billiards_number")
 def get_billiards_number(white_color_ratio, r, g, b):
     billiards_type = _get_billiardsType(white_color_ratio)
     if billiards_type == BilliardsType.White:
@@ -61,7 +78,7 @@ def get_billiards_number(white_color_ratio, r, g, b):
         return 6 + billiards_type
     if _get_max_band(r, g, b) == "B":
         h, l, s = colorsys.rgb_to_hls(r, g, b)
-        if abs(h - 0.5) < abs(h - 0.833333):
+        if abs(h - DEFAULT_HUE_2_6_H) < abs(h - DEFAULT_HUE_4_7_8_H):
             return 2 + billiards_type
         else:
             return 4 + billiards_type
@@ -69,10 +86,243 @@ def get_billiards_number(white_color_ratio, r, g, b):
         if r - g < g - b :  # yellow color
             return 1 + billiards_type
         h, l, s = colorsys.rgb_to_hls(r, g, b)
-        if abs(h - 0.166667) < abs(h - 0.833333):
+        if abs(h - DEFAULT_HUE_1_3_5_H) < abs(h - DEFAULT_HUE_4_7_8_H):
             if _is_black(0, g, b):  # pure red color
                 return 3 + billiards_type
             else:
                 return 5 + billiards_type
         else:
             return 7 + billiards_type
+
+
+###############################################################################
+# vectorized classification with a precompiled color table
+###############################################################################
+# bits of each item of the color table
+_COLOR_NUMBER_BITS = 0x07  # number of billiards without type, 0 for None
+_COLOR_BLACK_BIT = 0x08  # set if _is_black(r, g, b)
+
+def _get_billiards_types(white_color_ratios, white_range=None, big_range=None,
+                         little_range=None):
+    '''vectorized _get_billiardsType. Ranges default to
+    DEFAULT_*_WHITE_COLOR_RATIO, their bounds may be arrays broadcast with
+    white_color_ratios to try many ranges at once.
+    '''
+    if white_range is None:
+        white_range = DEFAULT_WHITE_BILLIARDS_WHITE_COLOR_RATIO
+    if big_range is None:
+        big_range = DEFAULT_BIG_BILLIARDS_WHITE_COLOR_RATIO
+    if little_range is None:
+        little_range = DEFAULT_LITTLE_BILLIARDS_WHITE_COLOR_RATIO
+    ratios = numpy.asarray(white_color_ratios, dtype=numpy.float64)
+    def in_range(range_):
+        return (ratios >= range_[0]) & (ratios <= range_[1])
+    return numpy.where(
+        in_range(white_range), BilliardsType.White,
+        numpy.where(
+            in_range(big_range), BilliardsType.Big,
+            numpy.where(
+                in_range(little_range),
+                BilliardsType.Little, BilliardsType.White)))
+
+def _get_color_codes(r, g, b, hue_1_3_5_h=None, hue_2_6_h=None,
+                     hue_4_7_8_h=None, black_max_bright=None,
+                     black_max_range=None):
+    '''vectorized color decision of get_billiards_number, return items of
+    the color table for integer arrays r, g, b in 0~255. Hue and black
+    constants default to DEFAULT_*, they may be arrays broadcast with r, g, b
+    to try many constants at once.
+
+    get_billiards_number gives integers to colorsys.rgb_to_hls, so (maxc-r),
+    (maxc-g) and (maxc-b) are divided with integer division there, the same
+    is done here to get exactly the same hue.
+    '''
+    if hue_1_3_5_h is None:
+        hue_1_3_5_h = DEFAULT_HUE_1_3_5_H
+    if hue_2_6_h is None:
+        hue_2_6_h = DEFAULT_HUE_2_6_H
+    if hue_4_7_8_h is None:
+        hue_4_7_8_h = DEFAULT_HUE_4_7_8_H
+    if black_max_bright is None:
+        black_max_bright = DEFAULT_BLACK_MAX_BRIGHT
+    if black_max_range is None:
+        black_max_range = DEFAULT_BLACK_MAX_RANGE
+    r = numpy.asarray(r, dtype=numpy.int32)
+    g = numpy.asarray(g, dtype=numpy.int32)
+    b = numpy.asarray(b, dtype=numpy.int32)
+    maxc = numpy.maximum(numpy.maximum(r, g), b)
+    minc = numpy.minimum(numpy.minimum(r, g), b)
+    span = numpy.maximum(maxc - minc, 1)
+    rc = (maxc - r) // span
+    gc = (maxc - g) // span
+    bc = (maxc - b) // span
+    h = numpy.where(r == maxc, bc - gc,
+                    numpy.where(g == maxc, 2.0 + rc - bc, 4.0 + gc - rc))
+    h = (h / 6.0) % 1.0
+    hue_2_6 = numpy.abs(h - hue_2_6_h) < numpy.abs(h - hue_4_7_8_h)
+    hue_1_3_5 = numpy.abs(h - hue_1_3_5_h) < numpy.abs(h - hue_4_7_8_h)
+    red = numpy.where(r - g < g - b, 1,
+                      numpy.where(hue_1_3_5,
+                                  numpy.where(numpy.maximum(g, b) <
+                                              numpy.minimum(black_max_bright,
+                                                            black_max_range),
+                                              3, 5),
+                                  7))
+    codes = numpy.where((g > r) & (g > b), 6,
+                        numpy.where((b > r) & (b > g),
+                                    numpy.where(hue_2_6, 2, 4),
+                                    numpy.where((r > g) & (r > b), red, 0)))
+    black = (maxc < black_max_bright) & (maxc - minc < black_max_range)
+    return (codes | numpy.where(black, _COLOR_BLACK_BIT, 0)).astype(numpy.uint8)
+
+def _get_numbers_of_codes(types, codes):
+    '''numbers of billiards of types from _get_billiards_types and color
+    codes from _get_color_codes, -1 for None, types and codes are broadcast.
+    '''
+    colors = codes & _COLOR_NUMBER_BITS
+    numbers = numpy.where(colors == 0, -1, colors + types)
+    numbers = numpy.where((types == BilliardsType.Little) &
+                          ((codes & _COLOR_BLACK_BIT) != 0), 8, numbers)
+    return numpy.where(types == BilliardsType.White, 0,
+                       numbers).astype(numpy.int16)
+
+def build_billiards_color_table():
+    '''build the color table used by get_billiards_numbers.
+
+    Returns:
+        numpy uint8 array with shape (256, 256, 256), indexed by (r, g, b).
+    '''
+    table = numpy.empty((256, 256, 256), dtype=numpy.uint8)
+    g, b = numpy.mgrid[0:256, 0:256]
+    for r in xrange(256):
+        table[r] = _get_color_codes(r, g, b)
+    return table
+
+def _get_color_table_filename(directory):
+    key = repr((DEFAULT_HUE_1_3_5_H, DEFAULT_HUE_2_6_H, DEFAULT_HUE_4_7_8_H,
+                DEFAULT_BLACK_MAX_BRIGHT, DEFAULT_BLACK_MAX_RANGE))
+    return os.path.join(directory, "color_table_%s.npy" %
+                        hashlib.sha1(key).hexdigest()[:16])
+
+def load_billiards_color_table(directory=None):
+    '''load the color table from directory, build and save it there first if
+    it is not saved yet. The file name depends on the hue and black constants,
+    so tables of different constants never mix.
+
+    Args:
+        directory(option): directory of the table file,
+            default: DEFAULT_COLOR_TABLE_DIR
+
+    Returns:
+        read only numpy uint8 array with shape (256, 256, 256), mapped from the
+        table file.
+    '''
+    if directory is None:
+        directory = DEFAULT_COLOR_TABLE_DIR
+    filename = _get_color_table_filename(directory)
+    if not os.path.exists(filename):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        fd, tmpname = tempfile.mkstemp(suffix=".npy", dir=directory)
+        with os.fdopen(fd, "wb") as fp:
+            numpy.save(fp, build_billiards_color_table())
+        os.rename(tmpname, filename)
+    return numpy.load(filename, mmap_mode="r")
+
+def get_billiards_numbers_of_parameters(white_color_ratios, r, g, b,
+                                        parameters):
+    '''vectorized get_billiards_number with constants given in parameters
+    instead of DEFAULT_*, without the color table.
+
+    Args:
+        white_color_ratios: array of white color ratio.
+        r, g, b: integer arrays of max count value of band R, G and B.
+        parameters: mapping with keys "white_min_ratio" (lower bound of
+            DEFAULT_WHITE_BILLIARDS_WHITE_COLOR_RATIO), "big_min_ratio" (lower
+            bound of DEFAULT_BIG_BILLIARDS_WHITE_COLOR_RATIO), "hue_1_3_5_h",
+            "hue_2_6_h", "hue_4_7_8_h", "black_max_bright" and
+            "black_max_range", values may be arrays broadcast with r, g, b.
+
+    Returns:
+        numpy int16 array, -1 where get_billiards_number returns None.
+    '''
+    white = parameters["white_min_ratio"]
+    big = parameters["big_min_ratio"]
+    types = _get_billiards_types(white_color_ratios, [white, 1.0], [big, white],
+                                 [0, big])
+    codes = _get_color_codes(r, g, b, parameters["hue_1_3_5_h"],
+                             parameters["hue_2_6_h"], parameters["hue_4_7_8_h"],
+                             parameters["black_max_bright"],
+                             parameters["black_max_range"])
+    return _get_numbers_of_codes(types, codes)
+
+_color_table = None
+
+def get_billiards_numbers(white_color_ratios, r, g, b, table=None):
+    '''vectorized get_billiards_number, classify many feature vectors with
+    array lookups in the color table.
+
+    Args:
+        white_color_ratios: array of white color ratio.
+        r, g, b: integer arrays of max count value of band R, G and B.
+        table(option): color table, default: load_billiards_color_table()
+
+    Returns:
+        numpy int16 array, same numbers as get_billiards_number, -1 where
+        get_billiards_number returns None.
+    '''
+    global _color_table
+    if table is None:
+        if _color_table is None:
+            _color_table = load_billiards_color_table()
+        table = _color_table
+    codes = table[numpy.asarray(r, dtype=numpy.intp),
+                  numpy.asarray(g, dtype=numpy.intp),
+                  numpy.asarray(b, dtype=numpy.intp)]
+    return _get_numbers_of_codes(_get_billiards_types(white_color_ratios), codes)
+
+
+
+###############################################################################
+# for unit test
+###############################################################################
+class BilliardsDistinguishTest(unittest.TestCase):
+    def test_getBilliardsNumber(self):
+        self.assertEqual(get_billiards_number(0.95, 200, 200, 200), 0)
+        self.assertEqual(get_billiards_number(0.1, 10, 10, 10), 8)
+        self.assertEqual(get_billiards_number(0.1, 10, 100, 200), 2)
+        self.assertEqual(get_billiards_number(0.1, 100, 10, 200), 4)
+        self.assertEqual(get_billiards_number(0.5, 200, 10, 150), 15)
+
+    def test_getBilliardsNumbers(self):
+        random = numpy.random.RandomState(0)
+        count = 20000
+        ratios = random.choice([-0.1, 0, 0.1, 0.2, 0.5, 0.9, 0.95, 1.0, 1.1],
+                               count)
+        rgb = random.randint(0, 256, (3, count))
+        # many colors with equal bands or near black
+        rgb[:, :count / 4] = random.randint(0, 40, (3, count / 4))
+        rgb[1, count / 4: count / 2] = rgb[0, count / 4: count / 2]
+        rgb[2, count / 2: 3 * count / 4] = rgb[1, count / 2: 3 * count / 4]
+        table = numpy.zeros((256, 256, 256), dtype=numpy.uint8)
+        table[rgb[0], rgb[1], rgb[2]] = _get_color_codes(rgb[0], rgb[1], rgb[2])
+        numbers = get_billiards_numbers(ratios, rgb[0], rgb[1], rgb[2], table)
+        for i in xrange(count):
+            number = get_billiards_number(ratios[i], int(rgb[0, i]),
+                                          int(rgb[1, i]), int(rgb[2, i]))
+            if number is None:
+                number = -1
+            self.assertEqual(numbers[i], number)
+
+    def test_loadBilliardsColorTable(self):
+        directory = tempfile.mkdtemp()
+        try:
+            table = load_billiards_color_table(directory)
+            self.assertEqual(table.shape, (256, 256, 256))
+            self.assertEqual(table[10, 100, 200], _get_color_codes(10, 100, 200))
+            self.assertEqual(os.listdir(directory),
+                             [os.path.basename(_get_color_table_filename(directory))])
+            self.assertEqual(load_billiards_color_table(directory)[200, 10, 150],
+                             table[200, 10, 150])
+        finally:
+            shutil.rmtree(directory)
@@ -0,0 +1,429 @@
+'''per-camera color correction of lighting changes.
+
+    The thresholds of is_white_color and billiards_distinguish are tuned
+    under one lighting, a darker room or a warmer lamp moves the colors of
+    every billiards across them. A ColorCorrection maps the colors of a
+    camera under the current lighting back to the tuned lighting with one
+    table of 256 values per band, so the thresholds are kept.
+
+    The table is calibrated with the same billiards under both lightings,
+    e.g. the white cue ball 0_a.jpg: the levels of the pixels inside the
+    ellipse (LEVEL_COUNT quantiles of each band) under the current lighting
+    are mapped to the levels under the tuned lighting, values between them
+    are interpolated. The cue ball reflects the light of the room, its
+    shading covers a wide range of levels of all bands. The darkest and the
+    brightest pixels, the edge and the reflections of lamps, change with
+    every shot and are not compared, see LEVEL_RANGE.
+
+    The table is applied only to the pixels inside the ellipse, after they
+    are read, see BallDetector.get_array_features, with Image.point, which
+    is several times faster than indexing the table with numpy.
+'''
+
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+import numpy
+from PIL import Image
+from BilliardsDistinguish.batch import list_image_files
+from BilliardsDistinguish.decode import open_region
+from BilliardsDistinguish.detector import BallDetector
+from BilliardsDistinguish.image_process import get_ellipse_mask, \
+    _get_ellipse_pixels
+from BilliardsDistinguish.profiling import profiled, array_pixels
+from BilliardsDistinguish.tuning import get_label
+
+# count of levels of each band compared by calibration, quantiles evenly
+# spaced in LEVEL_RANGE percent
+LEVEL_COUNT = 19
+LEVEL_RANGE = (5, 95)
+
+# version of files of ColorCorrection.save
+CORRECTION_VERSION = 1
+
+
+def get_levels(im_cut, count=LEVEL_COUNT):
+    '''levels of the pixels inside the ellipse of a billiards.
+
+    Args:
+        im_cut: an instance of PIL.Image, mode "RGB".
+        count(option): count of levels, quantiles in LEVEL_RANGE percent.
+            default: LEVEL_COUNT
+
+    Returns:
+        numpy float64 array with shape (count, 3), levels of each band in
+        ascending order.
+    '''
+    assert str(im_cut.mode) == "RGB" and count > 1
+    width, height = im_cut.size
+    selected = _get_ellipse_pixels(numpy.asarray(im_cut),
+                                   get_ellipse_mask(width, height).offsets)
+    low, high = LEVEL_RANGE
+    return numpy.percentile(selected, numpy.linspace(low, high, count),
+                            axis=0)
+
+def get_correction_table(levels, target_levels):
+    '''table mapping levels of each band to target levels.
+
+    Args:
+        levels: levels under the current lighting, see get_levels.
+        target_levels: levels of the same billiards under the tuned
+            lighting, with the same shape as levels.
+
+    Returns:
+        numpy uint8 array with shape (3, 256), monotonic in each band, 0 and
+        255 are kept.
+    '''
+    levels = numpy.asarray(levels, dtype=numpy.float64)
+    target_levels = numpy.asarray(target_levels, dtype=numpy.float64)
+    assert levels.shape == target_levels.shape and levels.shape[1] == 3
+    values = numpy.arange(256)
+    # tiny steps keep points of equal levels, e.g. saturated highlights, in
+    # order for numpy.interp
+    steps = numpy.arange(len(levels) + 2) * 1e-6
+    table = numpy.empty((3, 256), dtype=numpy.uint8)
+    for band in range(3):
+        x = numpy.concatenate(([0.0], levels[:, band], [255.0]))
+        y = numpy.concatenate(([0.0], target_levels[:, band], [255.0]))
+        x = numpy.maximum.accumulate(x) + steps
+        y = numpy.maximum.accumulate(y)
+        table[band] = numpy.rint(numpy.interp(values, x, y)).clip(0, 255)
+    return table
+
+
+class ColorCorrection(object):
+    '''read only correction table of a camera.
+
+    Attributes:
+        table: read only numpy uint8 array with shape (3, 256), corrected
+            value of each value of each band.
+    '''
+    def __init__(self, table=None):
+        '''
+        Args:
+            table(option): array with shape (3, 256), default: identity
+        '''
+        if table is None:
+            table = numpy.tile(numpy.arange(256), (3, 1))
+        table = numpy.array(table, dtype=numpy.uint8)
+        assert table.shape == (3, 256)
+        table.flags.writeable = False
+        self.table = table
+        self._lut = table.ravel().tolist()
+
+    def __reduce__(self):
+        return (ColorCorrection, (self.table,))
+
+    def __repr__(self):
+        return "ColorCorrection(<%d bytes>)" % self.table.nbytes
+
+    def __eq__(self, other):
+        return isinstance(other, ColorCorrection) and \
+            numpy.array_equal(self.table, other.table)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.table.tobytes())
+
+    @property
+    def is_identity(self):
+        return bool((self.table == numpy.arange(256)).all())
+
+    def apply(self, im):
+        '''corrected copy of a picture, mode "RGB".'''
+        assert str(im.mode) == "RGB"
+        return im.point(self._lut)
+
+    @profiled("color_correction",
+              pixels=lambda self, pixels: array_pixels(pixels))
+    def apply_array(self, pixels):
+        '''corrected copy of an array of pixels.
+
+        Args:
+            pixels: numpy uint8 array with shape (..., 3), e.g. pixels inside
+                the ellipse read by _get_ellipse_pixels.
+        '''
+        shape = pixels.shape
+        pixels = numpy.ascontiguousarray(pixels, dtype=numpy.uint8)
+        pixels = pixels.reshape(-1, 3)
+        if len(pixels) == 0:
+            return pixels.reshape(shape)
+        im = Image.frombuffer("RGB", (len(pixels), 1), pixels, "raw", "RGB",
+                              0, 1)
+        return numpy.asarray(im.point(self._lut)).reshape(shape)
+
+    def save(self, filename):
+        with open(filename, "wb") as fp:
+            numpy.savez(fp, version=CORRECTION_VERSION, table=self.table)
+
+    @classmethod
+    def load(cls, filename):
+        with numpy.load(filename) as data:
+            assert int(data["version"]) == CORRECTION_VERSION
+            return cls(data["table"])
+
+
+# corrections loaded by load_correction, by file name
+_corrections = {}
+
+def load_correction(filename):
+    '''ColorCorrection saved in a file, each file is read only once.'''
+    key = os.path.abspath(filename)
+    correction = _corrections.get(key)
+    if correction is None:
+        correction = _corrections[key] = ColorCorrection.load(filename)
+    return correction
+
+def get_command_detector(position=None, correction=None):
+    '''detector of the --position and --correction options of commands.
+
+    Args:
+        position(option): (left, top, width, height) of the billiards,
+            default: get_default_position()
+        correction(option): file name of a table saved by calibrate, read
+            with load_correction.
+
+    Returns:
+        an instance of BallDetector, None if neither is given, for
+        default_detector().
+    '''
+    if position is None and correction is None:
+        return None
+    if position is not None:
+        position = tuple(position)
+    if correction is not None:
+        correction = load_correction(correction)
+    return BallDetector(position, correction=correction)
+
+def calibrate(reference, position, target, target_position=None,
+              count=LEVEL_COUNT):
+    '''calibrate the correction of a camera.
+
+    Args:
+        reference: file name of a picture of a billiards taken by the camera
+            under the current lighting, e.g. the cue ball.
+        position: (left, top, width, height) of the billiards in reference.
+        target: file name of a picture of the same billiards under the
+            lighting the thresholds are tuned for.
+        target_position(option): position of the billiards in target.
+            default: position
+        count(option): see get_levels.
+
+    Returns:
+        an instance of ColorCorrection.
+    '''
+    if target_position is None:
+        target_position = position
+    return ColorCorrection(get_correction_table(
+        get_levels(open_region(reference, position), count),
+        get_levels(open_region(target, target_position), count)))
+
+def add_arguments(parser):
+    parser.add_argument("reference",
+                        help="picture of the cue ball under the current "
+                        "lighting")
+    parser.add_argument("target",
+                        help="picture of the cue ball under the lighting "
+                        "of the thresholds")
+    parser.add_argument("--position", type=int, nargs=4, required=True,
+                        metavar=("LEFT", "TOP", "WIDTH", "HEIGHT"),
+                        help="position of the billiards in the pictures")
+    parser.add_argument("--target-position", type=int, nargs=4,
+                        metavar=("LEFT", "TOP", "WIDTH", "HEIGHT"),
+                        help="position of the billiards in target, "
+                        "default: --position")
+    parser.add_argument("--output", required=True,
+                        help="file name of the correction table")
+    parser.add_argument("--check", nargs="*", default=[],
+                        metavar="INPUT",
+                        help="directories or glob patterns of labeled "
+                        "pictures under the current lighting, classified "
+                        "with and without correction")
+    parser.set_defaults(func=command)
+
+def command(args):
+    position = tuple(args.position)
+    targetPosition = position
+    if args.target_position:
+        targetPosition = tuple(args.target_position)
+    correction = calibrate(args.reference, position, args.target,
+                           targetPosition)
+    correction.save(args.output)
+    filenames = [filename for pattern in args.check
+                 for filename in list_image_files(pattern)
+                 if get_label(filename) is not None]
+    if not filenames:
+        return 0
+    detector = BallDetector(position)
+    corrected = detector.replace(correction=correction)
+    correct = [0, 0]
+    for filename in filenames:
+        region = detector.open(filename)
+        label = get_label(filename)
+        for i, each in enumerate((detector, corrected)):
+            correct[i] += each.classify_features(
+                each.get_features(region)) == label
+    print "not corrected: %d/%d correct" % (correct[0], len(filenames))
+    print "corrected: %d/%d correct" % (correct[1], len(filenames))
+    sys.stdout.flush()
+    return 0
+
+
+
+###############################################################################
+# for unit test
+###############################################################################
+class CalibrationTest(unittest.TestCase):
+    PICTURES = (("../../../pictures/VGA", "0_a.jpg", (215, 130, 265, 265)),
+                ("../../../pictures/720p", "0.jpg", (585, 165, 415, 415)))
+
+    @staticmethod
+    def _shift_lighting(im, gains, gamma):
+        '''picture under a simulated lighting.'''
+        lut = []
+        for gain in gains:
+            lut.extend(min(255, int(round(255 * (value / 255.0) ** gamma *
+                                          gain)))
+                       for value in range(256))
+        return im.point(lut)
+
+    def test_correctionTable(self):
+        levels = numpy.tile(numpy.linspace(40, 240, 5)[:, numpy.newaxis],
+                            (1, 3))
+        table = get_correction_table(levels, levels)
+        self.assertTrue((table == numpy.arange(256)).all())
+        dark = levels * [0.5, 1.0, 0.8]
+        table = get_correction_table(dark, levels)
+        self.assertEqual(table[:, 0].tolist(), [0, 0, 0])
+        self.assertEqual(table[:, 255].tolist(), [255, 255, 255])
+        self.assertEqual(table[:, 120].tolist(), [240, 120, 150])
+        self.assertTrue((numpy.diff(table.astype(int), axis=1) >= 0).all())
+        # equal levels, e.g. saturated highlights
+        levels[-2:] = 255
+        table = get_correction_table(levels, levels)
+        self.assertTrue((numpy.diff(table.astype(int), axis=1) >= 0).all())
+
+    def test_apply(self):
+        table = numpy.tile(255 - numpy.arange(256), (3, 1))
+        table[1] = numpy.arange(256) // 2
+        correction = ColorCorrection(table)
+        self.assertFalse(correction.table.flags.writeable)
+        self.assertFalse(correction.is_identity)
+        self.assertTrue(ColorCorrection().is_identity)
+        pixels = numpy.random.RandomState(1).randint(
+            0, 256, (20, 30, 3)).astype(numpy.uint8)
+        expected = numpy.dstack((255 - pixels[..., 0], pixels[..., 1] // 2,
+                                 255 - pixels[..., 2]))
+        self.assertTrue(numpy.array_equal(correction.apply_array(pixels),
+                                          expected))
+        im = Image.fromarray(pixels)
+        self.assertTrue(numpy.array_equal(
+            numpy.asarray(correction.apply(im)), expected))
+        self.assertEqual(correction.apply_array(pixels[:0]).shape, (0, 30, 3))
+
+    def test_saveLoad(self):
+        import pickle
+        correction = ColorCorrection(numpy.tile(numpy.arange(256) // 2, (3, 1)))
+        self.assertEqual(pickle.loads(pickle.dumps(correction)), correction)
+        directory = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(directory, "camera.npz")
+            correction.save(filename)
+            loaded = load_correction(filename)
+            self.assertEqual(loaded, correction)
+            self.assertTrue(load_correction(filename) is loaded)
+        finally:
+            _corrections.clear()
+            shutil.rmtree(directory)
+
+    def test_detector(self):
+        directory, name, position = self.PICTURES[0]
+        detector = BallDetector(position)
+        region = detector.open(os.path.join(directory, "9_a.jpg"))
+        correction = ColorCorrection(numpy.tile(numpy.arange(256) // 2,
+                                                (3, 1)))
+        corrected = detector.replace(correction=correction)
+        self.assertNotEqual(corrected, detector)
+        self.assertEqual(corrected.replace(correction=None), detector)
+        self.assertEqual(corrected.get_features(region),
+                         detector.get_features(correction.apply(region)))
+        pixels = numpy.array([numpy.asarray(region)] * 2)
+        self.assertEqual([tuple(row) for row in
+                          corrected.get_batch_features(pixels)],
+                         [corrected.get_features(region)] * 2)
+        self.assertEqual(BallDetector(position, correction=ColorCorrection()
+                                      ).get_features(region),
+                         detector.get_features(region))
+
+    def test_commands(self):
+        import csv
+        from BilliardsDistinguish import cli
+        from BilliardsDistinguish.archive import pack_archive
+        directory, name, position = self.PICTURES[0]
+        filenames = list_image_files(os.path.join(directory, "1*_a.jpg"))
+        correction = ColorCorrection(numpy.tile(numpy.arange(256) // 2,
+                                                (3, 1)))
+        corrected = BallDetector(position, correction=correction)
+        expected = [corrected.classify_file(filename)
+                    for filename in filenames]
+        self.assertNotEqual(expected, [BallDetector(position).classify_file(
+            filename) for filename in filenames])
+        temp = tempfile.mkdtemp()
+        try:
+            table = os.path.join(temp, "camera.npz")
+            correction.save(table)
+            options = ["--position"] + [str(value) for value in position] + \
+                ["--correction", table]
+            output = os.path.join(temp, "classify.csv")
+            self.assertEqual(cli.main(["classify", "--processes", "1",
+                                       "--output", output] + options +
+                                      filenames), 0)
+            with open(output) as fp:
+                rows = list(csv.DictReader(fp))
+            self.assertEqual([int(row["number"]) if row["number"] else None
+                              for row in rows], expected)
+            frames = os.path.join(temp, "frames.bin")
+            pack_archive(filenames, frames, position)
+            output = os.path.join(temp, "replay.csv")
+            self.assertEqual(cli.main(["replay", frames, "--processes", "1",
+                                       "--correction", table,
+                                       "--output", output]), 0)
+            with open(output) as fp:
+                rows = list(csv.DictReader(fp))
+            self.assertEqual([int(row["number"]) if row["number"] else None
+                              for row in rows], expected)
+        finally:
+            _corrections.clear()
+            shutil.rmtree(temp)
+        self.assertEqual(get_command_detector(), None)
+
+    def test_lightingShift(self):
+        for directory, name, position in self.PICTURES:
+            filenames = [filename for filename in list_image_files(directory)
+                         if get_label(filename) is not None]
+            detector = BallDetector(position)
+            target = get_levels(detector.open(os.path.join(directory, name)))
+            expected = [detector.classify_file(filename)
+                        for filename in filenames]
+            for gains, gamma in (((0.8, 0.8, 0.8), 1.0),
+                                 ((0.85, 0.8, 0.7), 1.2)):
+                reference = self._shift_lighting(
+                    detector.open(os.path.join(directory, name)), gains, gamma)
+                corrected = detector.replace(correction=ColorCorrection(
+                    get_correction_table(get_levels(reference), target)))
+                regions = [self._shift_lighting(detector.open(filename),
+                                                gains, gamma)
+                           for filename in filenames]
+                shifted = [detector.classify_features(
+                    detector.get_features(region)) for region in regions]
+                numbers = [corrected.classify_features(
+                    corrected.get_features(region)) for region in regions]
+                agree = sum(a == b for a, b in zip(numbers, expected))
+                self.assertTrue(agree >= 0.8 * len(filenames))
+                self.assertTrue(agree > sum(a == b for a, b in
+                                            zip(shifted, expected)))
@@ -0,0 +1,81 @@
+'''command line interface of BilliardsDistinguish.
+
+    usage: python -m BilliardsDistinguish <command> [options]
+
+    commands:
+        classify: classify pictures with a pool of worker processes.
+        stream: classify a sequence of frames, numbered files or raw RGB.
+        bench: run benchmarks, compare with a baseline.
+        decode: decode only the billiards region, compare with full decode.
+        tune: tune thresholds of billiards_distinguish over labeled pictures.
+        pack: pack the billiards of pictures into an archive of raw frames.
+        replay: classify all frames of an archive.
+        serve: serve classification to camera nodes over TCP.
+        loadgen: send pictures to the service from many connections.
+        match: build references of the nearest histogram matcher.
+        coarse: compare coarse to fine classification with full size.
+        calibrate: build the color correction of a camera from the cue ball.
+
+    --profile prints time spent in each stage of the pipeline after the
+    command, --profile-json writes it to a file, see profiling. Worker
+    processes are not profiled, use --processes 1 with classify.
+'''
+
+
+import argparse
+import sys
+from BilliardsDistinguish import archive, batch, benchmark, calibration, \
+    decode, matcher, multiscale, service, stream, tuning
+from BilliardsDistinguish.profiling import PROFILER
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="BilliardsDistinguish",
+        description="Distinguish different billiards images")
+    parser.add_argument("--profile", action="store_true",
+                        help="print time of each stage to stderr")
+    parser.add_argument("--profile-json", metavar="FILE",
+                        help="write time of each stage to FILE as JSON")
+    subparsers = parser.add_subparsers(dest="command")
+    batch.add_arguments(subparsers.add_parser(
+        "classify", help="classify pictures with a pool of worker processes"))
+    stream.add_arguments(subparsers.add_parser(
+        "stream", help="classify a sequence of frames"))
+    benchmark.add_arguments(subparsers.add_parser(
+        "bench", help="run benchmarks of the hot paths"))
+    decode.add_arguments(subparsers.add_parser(
+        "decode", help="check decoding of the billiards region only"))
+    tuning.add_arguments(subparsers.add_parser(
+        "tune", help="tune thresholds over labeled pictures"))
+    archive.add_pack_arguments(subparsers.add_parser(
+        "pack", help="pack the billiards of pictures into an archive"))
+    archive.add_replay_arguments(subparsers.add_parser(
+        "replay", help="classify all frames of an archive"))
+    service.add_serve_arguments(subparsers.add_parser(
+        "serve", help="serve classification to camera nodes over TCP"))
+    service.add_loadgen_arguments(subparsers.add_parser(
+        "loadgen", help="send pictures to the service from many connections"))
+    matcher.add_arguments(subparsers.add_parser(
+        "match", help="build and evaluate references of the histogram "
+        "matcher"))
+    multiscale.add_arguments(subparsers.add_parser(
+        "coarse", help="compare coarse to fine classification with full "
+        "size"))
+    calibration.add_arguments(subparsers.add_parser(
+        "calibrate", help="build the color correction of a camera from a "
+        "picture of the cue ball"))
+    args = parser.parse_args(argv)
+    if not (args.profile or args.profile_json):
+        return args.func(args)
+    PROFILER.reset()
+    PROFILER.enable()
+    try:
+        return args.func(args)
+    finally:
+        PROFILER.disable()
+        if args.profile:
+            print >> sys.stderr, PROFILER.report()
+        if args.profile_json:
+            with open(args.profile_json, "w") as fp:
+                fp.write(PROFILER.to_json())
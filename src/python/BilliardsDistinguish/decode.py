@@ -0,0 +1,251 @@
+'''decode only the region of a picture that contains the billiards.
+
+    Billiards are at a fixed position, so most of every picture is thrown
+    away after it is decoded. open_region stops the JPEG decoder after the
+    last row of the region, and with scale > 1 decodes JPEG at 1/2, 1/4 or
+    1/8 size (draft mode), which is much faster, but gives an approximate,
+    smaller region. Other formats are fully decoded and cut.
+'''
+
+
+import sys
+import timeit
+import unittest
+import numpy
+from PIL import Image
+from BilliardsDistinguish.image_process import cut_region_in_image, \
+    get_ellipse_color_features
+from BilliardsDistinguish.billiards_distinguish import get_billiards_number
+from BilliardsDistinguish.profiling import profiled
+
+# scales supported by the JPEG decoder
+JPEG_SCALES = (1, 2, 4, 8)
+
+
+class DecodeStats(object):
+    '''cost of decoding one region.
+
+    Attributes:
+        seconds: seconds to open, decode and cut the region.
+        file_bytes: bytes read from the file.
+        decoded_bytes: bytes of pixels the decoder produced.
+        full_bytes: bytes of pixels of the fully decoded picture.
+        scale: the picture is decoded at 1/scale size.
+    '''
+    __slots__ = ("seconds", "file_bytes", "decoded_bytes", "full_bytes",
+                 "scale")
+
+    def __init__(self):
+        self.seconds = 0.0
+        self.file_bytes = 0
+        self.decoded_bytes = 0
+        self.full_bytes = 0
+        self.scale = 1
+
+
+class _CountingFile(object):
+    '''file object wrapper that counts bytes read.'''
+    def __init__(self, fp):
+        self._fp = fp
+        self.count = 0
+
+    def read(self, *args):
+        data = self._fp.read(*args)
+        self.count = self.count + len(data)
+        return data
+
+    def seek(self, *args):
+        return self._fp.seek(*args)
+
+    def tell(self):
+        return self._fp.tell()
+
+    def close(self):
+        return self._fp.close()
+
+
+@profiled("decode", pixels=lambda filename, box, *args, **kwargs:
+          box[2] * box[3])
+def open_region(filename, box, scale=1, stats=None):
+    '''open a picture and decode only what the region needs.
+
+    A JPEG decoder can not skip rows, but it can stop after the last row of
+    the region, libjpeg then complains the image is not finished, that error
+    is expected and ignored, all rows of the region are decoded.
+
+    Args:
+        filename: file name or file object of the picture.
+        box: (left, top, width, height) of the region in the full size
+            picture, like get_default_position().
+        scale(option): decode JPEG at 1/scale size, one of JPEG_SCALES, the
+            region is scaled too. default: 1
+        stats(option): an instance of DecodeStats to fill.
+
+    Returns:
+        an instance of PIL.Image, the region, mode "RGB".
+
+    Raises:
+        AssertError: scale is not supported or the picture is not JPEG when
+            scale > 1.
+    '''
+    assert scale in JPEG_SCALES
+    start = timeit.default_timer()
+    if isinstance(filename, basestring):
+        fp = open(filename, "rb")
+    else:
+        fp = filename
+    counter = _CountingFile(fp)
+    try:
+        im = Image.open(counter)
+        fullWidth, fullHeight = im.size
+        x, y, w, h = box
+        if im.format == "JPEG":
+            im.draft("RGB", (fullWidth / scale, fullHeight / scale))
+            assert im.size[0] <= (fullWidth + scale - 1) / scale
+            _load_rows(im, min((y + h + scale - 1) / scale, im.size[1]))
+        else:
+            assert scale == 1
+            im.load()
+        decodedBytes = im.size[0] * im.size[1] * len(im.getbands())
+        region = im.crop((x / scale, y / scale, (x + w) / scale,
+                          (y + h) / scale))
+        if region.mode != "RGB":
+            region = region.convert("RGB")
+    finally:
+        if fp is not filename:
+            fp.close()
+    if stats is not None:
+        stats.seconds = timeit.default_timer() - start
+        stats.file_bytes = counter.count
+        stats.decoded_bytes = decodedBytes
+        stats.full_bytes = fullWidth * fullHeight * 3
+        stats.scale = scale
+    return region
+
+def _load_rows(im, rows):
+    '''load the first rows of a JPEG image, the image is cut to these rows.'''
+    if rows >= im.size[1] or len(im.tile) != 1:
+        im.load()
+        return
+    name, extents, offset, args = im.tile[0]
+    im._size = (im.size[0], rows)
+    im.tile = [(name, (0, 0, im.size[0], rows), offset, args)]
+    try:
+        im.load()
+    except IOError as e:
+        # libjpeg: "Application transferred too few scanlines", raised after
+        # the requested rows are decoded
+        if not str(e).startswith("broken data stream"):
+            raise
+
+def compare_with_full_decode(filenames, box, scale=1):
+    '''decode regions with open_region and with full decode, compare results.
+
+    Args:
+        filenames: iterable of picture file names.
+        box: (left, top, width, height) of the region.
+        scale(option): scale of open_region. default: 1
+
+    Returns:
+        generator of (filename, DecodeStats, seconds of full decode and cut,
+        mean absolute difference of pixels, True if both regions give the
+        same billiards number). With scale > 1 the fully decoded region is
+        reduced to the same size before compared.
+    '''
+    x, y, w, h = box
+    for filename in filenames:
+        stats = DecodeStats()
+        region = open_region(filename, box, scale, stats)
+        start = timeit.default_timer()
+        full = cut_region_in_image(Image.open(filename), x, y, w, h)
+        full.load()
+        fullSeconds = timeit.default_timer() - start
+        if full.mode != "RGB":
+            full = full.convert("RGB")
+        if region.size != full.size:
+            full = full.resize(region.size, Image.BOX)
+        difference = numpy.abs(numpy.asarray(region, dtype=numpy.int16) -
+                               numpy.asarray(full, dtype=numpy.int16)).mean()
+        yield (filename, stats, fullSeconds, float(difference),
+               _classify(region) == _classify(full))
+
+def _classify(im):
+    total_pixels, white_pixels, r, g, b = get_ellipse_color_features(im)
+    return get_billiards_number(float(white_pixels) / total_pixels, r, g, b)
+
+def add_arguments(parser):
+    parser.add_argument("inputs", nargs="+",
+                        help="directories or glob patterns of pictures")
+    parser.add_argument("--position", type=int, nargs=4, required=True,
+                        metavar=("LEFT", "TOP", "WIDTH", "HEIGHT"),
+                        help="position of the billiards in the pictures")
+    parser.add_argument("--scale", type=int, choices=JPEG_SCALES, default=1)
+    parser.set_defaults(func=command)
+
+def command(args):
+    from BilliardsDistinguish.batch import list_image_files
+    filenames = [filename for pattern in args.inputs
+                 for filename in list_image_files(pattern)]
+    print "filename,seconds,full_seconds,file_bytes,decoded_bytes,full_bytes," \
+        "difference,same_number"
+    count = 0
+    same = 0
+    seconds = 0.0
+    fullSeconds = 0.0
+    for filename, stats, full, difference, sameNumber in \
+            compare_with_full_decode(filenames, tuple(args.position), args.scale):
+        print "%s,%.6f,%.6f,%d,%d,%d,%.3f,%s" % \
+            (filename, stats.seconds, full, stats.file_bytes,
+             stats.decoded_bytes, stats.full_bytes, difference, sameNumber)
+        count = count + 1
+        same = same + sameNumber
+        seconds = seconds + stats.seconds
+        fullSeconds = fullSeconds + full
+    if count:
+        sys.stderr.write("%d pictures, %d same number, decode %.1fms vs full "
+                         "%.1fms per picture\n" % (count, same,
+                                                   seconds * 1000 / count,
+                                                   fullSeconds * 1000 / count))
+    return 0
+
+
+
+###############################################################################
+# for unit test
+###############################################################################
+class DecodeTest(unittest.TestCase):
+    PICTURES = (("../../../pictures/VGA/2_a.jpg", (215, 130, 265, 265)),
+                ("../../../pictures/720p/2.jpg", (585, 165, 415, 415)),
+                ("../../../pictures/720p/2.jpg", (0, 0, 1280, 720)))
+
+    def test_openRegion(self):
+        for filename, box in self.PICTURES:
+            x, y, w, h = box
+            stats = DecodeStats()
+            region = open_region(filename, box, stats=stats)
+            full = cut_region_in_image(Image.open(filename), x, y, w, h)
+            self.assertEqual(region.tobytes(), full.tobytes())
+            self.assertTrue(stats.decoded_bytes <= stats.full_bytes)
+            self.assertTrue(stats.file_bytes > 0)
+
+    def test_openRegion_scale(self):
+        filename, box = self.PICTURES[1]
+        stats = DecodeStats()
+        region = open_region(filename, box, 4, stats)
+        self.assertEqual(region.size, (104, 104))
+        self.assertEqual(stats.decoded_bytes, 320 * 145 * 3)
+
+    def test_openRegion_png(self):
+        import StringIO
+        im = Image.new("RGB", (40, 30), "rgb(10,20,30)")
+        fp = StringIO.StringIO()
+        im.save(fp, "PNG")
+        fp.seek(0)
+        self.assertEqual(open_region(fp, (5, 5, 10, 10)).getpixel((0, 0)),
+                         (10, 20, 30))
+
+    def test_compareWithFullDecode(self):
+        filename, box = self.PICTURES[0]
+        rows = list(compare_with_full_decode([filename], box))
+        self.assertEqual(rows[0][3], 0.0)
+        self.assertTrue(rows[0][4])
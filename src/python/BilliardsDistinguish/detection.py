@@ -0,0 +1,341 @@
+'''locate and classify all billiards in one picture.
+
+    The picture is binarized once, foreground pixels are the pixels not of
+    the background color, connected foreground pixels are found with runs of
+    pixels in rows: runs overlapping in neighbor rows are joined with union
+    find, so the work depends on count of runs, not pixels. Components of
+    billiards size are classified with slices of the pixel and white arrays
+    of the whole picture, which are computed only once per picture.
+'''
+
+
+import unittest
+import numpy
+from PIL import Image
+from BilliardsDistinguish.image_process import add_ellipse_mask_to_image, \
+    cut_region_in_image, get_ellipse_color_features, get_ellipse_mask, \
+    get_white_pixel_array, _analyze_selected_pixels
+from BilliardsDistinguish.billiards_distinguish import get_billiards_number, \
+    get_billiards_numbers
+
+# components smaller or bigger than these are not billiards
+DEFAULT_MIN_SIZE = 20
+DEFAULT_MAX_SIZE = None
+# max ratio of long side to short side of billiards
+DEFAULT_MAX_ASPECT = 1.5
+
+
+class Component(object):
+    '''a connected component of foreground pixels.
+
+    Attributes:
+        box: (x, y, width, height) of the bounding box.
+        pixels: count of pixels.
+    '''
+    __slots__ = ("box", "pixels")
+
+    def __init__(self, box, pixels):
+        self.box = box
+        self.pixels = pixels
+
+    def __repr__(self):
+        return "Component(%r, %r)" % (self.box, self.pixels)
+
+
+class BilliardsRegion(object):
+    '''a billiards found in a picture.
+
+    Attributes:
+        box: (x, y, width, height) of the billiards.
+        number: number of the billiards, None if unknown.
+        features: (total pixels, white pixels, r, g, b), see
+            get_ellipse_color_features.
+    '''
+    __slots__ = ("box", "number", "features")
+
+    def __init__(self, box, number, features):
+        self.box = box
+        self.number = number
+        self.features = features
+
+    def __repr__(self):
+        return "BilliardsRegion(%r, %r, %r)" % (self.box, self.number,
+                                                self.features)
+
+
+def get_foreground_array(im, background=1, white=None):
+    '''binarize a picture.
+
+    Args:
+        im: an instance of PIL.Image.
+        background(option): 1 for white background, pixels not white are
+            foreground, see is_white_color, 0 for black background, pixels
+            with brightness > 127 are foreground. default: 1
+        white(option): get_white_pixel_array(im) if already computed.
+
+    Returns:
+        numpy bool array with shape (height, width).
+    '''
+    if background == 1:
+        if white is None:
+            white = get_white_pixel_array(im)
+        return ~white
+    return numpy.asarray(im.convert("L")) > 127
+
+def _get_runs(foreground):
+    '''runs of True in each row, sorted by row and start.
+
+    Returns:
+        (rows, starts, ends) of runs, ends are exclusive.
+    '''
+    h, w = foreground.shape
+    padded = numpy.zeros((h, w + 2), dtype=numpy.int8)
+    padded[:, 1:-1] = foreground
+    edges = numpy.diff(padded, axis=1)
+    rows, starts = numpy.nonzero(edges == 1)
+    ends = numpy.nonzero(edges == -1)[1]
+    return rows, starts, ends
+
+def _get_run_pairs(rows, starts, ends, width):
+    '''pairs of runs of neighbor rows which are 8-connected.
+
+    Runs of a row are sorted and disjoint, so runs of the previous row
+    touching a run are a continuous range, found with binary search on keys
+    row * (width + 2) + column of all runs.
+    '''
+    scale = width + 2
+    startKeys = rows * scale + starts
+    endKeys = rows * scale + ends
+    lo = numpy.searchsorted(endKeys, (rows - 1) * scale + starts, "left")
+    hi = numpy.searchsorted(startKeys, (rows - 1) * scale + ends, "right")
+    counts = numpy.maximum(hi - lo, 0)
+    current = numpy.repeat(numpy.arange(len(rows)), counts)
+    offsets = numpy.arange(counts.sum()) - \
+        numpy.repeat(numpy.cumsum(counts) - counts, counts)
+    previous = numpy.repeat(lo, counts) + offsets
+    return current, previous
+
+def _union_find(count, first, second):
+    '''labels of connected items, items of each pair are connected.
+
+    Roots are hooked to the smaller root of each pair, then paths are
+    compressed by pointer jumping, until no root changes.
+
+    Returns:
+        numpy array, label of each item is the smallest item connected.
+    '''
+    labels = numpy.arange(count)
+    while True:
+        rootsFirst = labels[first]
+        rootsSecond = labels[second]
+        smaller = numpy.minimum(rootsFirst, rootsSecond)
+        hooked = labels.copy()
+        numpy.minimum.at(hooked, rootsFirst, smaller)
+        numpy.minimum.at(hooked, rootsSecond, smaller)
+        while True:
+            jumped = hooked[hooked]
+            if numpy.array_equal(jumped, hooked):
+                break
+            hooked = jumped
+        if numpy.array_equal(hooked, labels):
+            return labels
+        labels = hooked
+
+def find_components(foreground):
+    '''find 8-connected components of a binarized picture.
+
+    Args:
+        foreground: numpy bool array with shape (height, width).
+
+    Returns:
+        list of Component, sorted by position of their first pixel.
+    '''
+    rows, starts, ends = _get_runs(foreground)
+    if len(rows) == 0:
+        return []
+    current, previous = _get_run_pairs(rows, starts, ends,
+                                       foreground.shape[1])
+    labels = _union_find(len(rows), current, previous)
+    roots, index = numpy.unique(labels, return_inverse=True)
+    count = len(roots)
+    def reduce(ufunc, values, initial):
+        result = numpy.full(count, initial, dtype=numpy.int64)
+        ufunc.at(result, index, values)
+        return result
+    left = reduce(numpy.minimum, starts, foreground.shape[1])
+    right = reduce(numpy.maximum, ends, 0)
+    top = reduce(numpy.minimum, rows, foreground.shape[0])
+    bottom = reduce(numpy.maximum, rows + 1, 0)
+    pixels = numpy.bincount(index, weights=ends - starts, minlength=count)
+    return [Component((int(left[i]), int(top[i]), int(right[i] - left[i]),
+                       int(bottom[i] - top[i])), int(pixels[i]))
+            for i in xrange(count)]
+
+def _is_billiards_size(box, min_size, max_size, max_aspect):
+    x, y, w, h = box
+    short = min(w, h)
+    long_ = max(w, h)
+    return short >= min_size and (max_size is None or long_ <= max_size) and \
+        long_ <= short * max_aspect
+
+def locate_all_billiards_in_image(im, background=1, min_size=DEFAULT_MIN_SIZE,
+                                  max_size=DEFAULT_MAX_SIZE,
+                                  max_aspect=DEFAULT_MAX_ASPECT, white=None):
+    '''locate all billiards in a picture, like locate_billiards_in_image but
+    returns every component of billiards size instead of one bounding box of
+    all foreground.
+
+    Args:
+        im: an instance of PIL.Image.
+        background(option): see get_foreground_array. default: 1
+        min_size(option): min width and height of billiards. default: 20
+        max_size(option): max width and height of billiards, default: no limit
+        max_aspect(option): max ratio of long side to short side. default: 1.5
+        white(option): get_white_pixel_array(im) if already computed.
+
+    Returns:
+        list of (x, y, width, height) of billiards.
+    '''
+    foreground = get_foreground_array(im, background, white)
+    return [component.box for component in find_components(foreground)
+            if _is_billiards_size(component.box, min_size, max_size,
+                                  max_aspect)]
+
+def classify_billiards_in_image(im, boxes=None, background=1, **kwargs):
+    '''locate and classify all billiards in a picture.
+
+    Pixels and white pixels of the picture are computed once, each billiards
+    is analyzed on slices of them, and all billiards are classified with one
+    call of get_billiards_numbers. A box not inside the picture is cut from
+    it instead, pixels outside the picture are black like cut_region_in_image.
+
+    Args:
+        im: an instance of PIL.Image.
+        boxes(option): (x, y, width, height) of billiards, default: located
+            with locate_all_billiards_in_image.
+        background(option): see get_foreground_array. default: 1
+        kwargs: other arguments of locate_all_billiards_in_image.
+
+    Returns:
+        list of BilliardsRegion, same features as get_ellipse_color_features
+        of each box cut from the picture.
+    '''
+    if im.mode != "RGB":
+        im = im.convert("RGB")
+    pixels = numpy.asarray(im)
+    white = get_white_pixel_array(im)
+    if boxes is None:
+        boxes = locate_all_billiards_in_image(im, background, white=white,
+                                              **kwargs)
+    features = []
+    flatPixels = pixels.reshape(-1, pixels.shape[-1])
+    flatWhite = white.reshape(-1)
+    width, height = im.size
+    for x, y, w, h in boxes:
+        if x + w > width or y + h > height:
+            # offsets of the flat buffer would wrap to the next row
+            features.append(get_ellipse_color_features(
+                cut_region_in_image(im, x, y, w, h)))
+            continue
+        offsets = get_ellipse_mask(w, h).get_image_offsets(x, y, width)
+        histogram, maxCount, total, whiteCount = _analyze_selected_pixels(
+            flatPixels.take(offsets, axis=0), flatWhite.take(offsets),
+            masked=True)
+        features.append((total, whiteCount) + maxCount)
+    if not features:
+        return []
+    array = numpy.array(features, dtype=numpy.int64)
+    numbers = get_billiards_numbers(
+        array[:, 1].astype(numpy.float64) / numpy.maximum(array[:, 0], 1),
+        array[:, 2], array[:, 3], array[:, 4])
+    return [BilliardsRegion(tuple(box), None if number < 0 else int(number),
+                            feature)
+            for box, number, feature in zip(boxes, numbers, features)]
+
+
+
+###############################################################################
+# for unit test
+###############################################################################
+class DetectionTest(unittest.TestCase):
+    PICTURE_DIR = "../../../pictures/VGA"
+    POSITION = (215, 130, 265, 265)
+
+    def test_findComponents(self):
+        foreground = numpy.zeros((8, 10), dtype=bool)
+        foreground[1, 1:4] = True
+        foreground[2, 4] = True  # 8-connected to the first
+        foreground[2, 7:9] = True
+        foreground[3:6, 8] = True
+        foreground[7, 0] = True
+        foreground[6, 2:5] = True
+        foreground[5, 3] = True
+        components = find_components(foreground)
+        self.assertEqual([c.box for c in components],
+                         [(1, 1, 4, 2), (7, 2, 2, 4), (2, 5, 3, 2), (0, 7, 1, 1)])
+        self.assertEqual([c.pixels for c in components], [4, 5, 4, 1])
+        self.assertEqual(find_components(numpy.zeros((3, 3), dtype=bool)), [])
+
+    def test_findComponents_random(self):
+        random = numpy.random.RandomState(0)
+        foreground = random.rand(40, 60) < 0.45
+        expected = []
+        seen = numpy.zeros_like(foreground)
+        for y0, x0 in zip(*numpy.nonzero(foreground)):
+            if seen[y0, x0]:
+                continue
+            seen[y0, x0] = True
+            stack = [(y0, x0)]
+            points = []
+            while stack:
+                y, x = stack.pop()
+                points.append((y, x))
+                for ny in (y - 1, y, y + 1):
+                    for nx in (x - 1, x, x + 1):
+                        if 0 <= ny < 40 and 0 <= nx < 60 and \
+                                foreground[ny, nx] and not seen[ny, nx]:
+                            seen[ny, nx] = True
+                            stack.append((ny, nx))
+            ys, xs = zip(*points)
+            expected.append(((min(xs), min(ys), max(xs) - min(xs) + 1,
+                              max(ys) - min(ys) + 1), len(points)))
+        self.assertEqual([(c.box, c.pixels) for c in find_components(foreground)],
+                         expected)
+
+    def _create_frame(self, names):
+        '''paste billiards of pictures side by side on a white frame.'''
+        x, y, w, h = self.POSITION
+        frame = Image.new("RGB", (len(names) * (w + 30) + 30, h + 60), "white")
+        for i, name in enumerate(names):
+            im = cut_region_in_image(Image.open(self.PICTURE_DIR + "/" + name),
+                                     x, y, w, h).convert("RGB")
+            frame.paste(add_ellipse_mask_to_image(im), (30 + i * (w + 30), 30))
+        return frame
+
+    def test_classifyBilliardsInImage(self):
+        names = ("2_a.jpg", "5_a.jpg", "13_a.jpg")
+        frame = self._create_frame(names)
+        regions = classify_billiards_in_image(frame, min_size=100)
+        self.assertEqual(len(regions), len(names))
+        for region in regions:
+            x, y, w, h = region.box
+            im = cut_region_in_image(frame, x, y, w, h)
+            self.assertEqual(region.features, get_ellipse_color_features(im))
+            total, white, r, g, b = region.features
+            self.assertEqual(region.number, get_billiards_number(
+                float(white) / total, r, g, b))
+        self.assertEqual(regions[0].number, 2)
+        self.assertEqual(classify_billiards_in_image(Image.new("RGB", (9, 9),
+                                                               "white")), [])
+
+    def test_classifyBilliardsInImage_edge(self):
+        im = Image.open(self.PICTURE_DIR + "/9_a.jpg")
+        width, height = im.size
+        boxes = [(500, 130, 265, 265), (215, 300, 265, 265),
+                 (width - 265, height - 265, 265, 265)]
+        regions = classify_billiards_in_image(im, boxes)
+        self.assertEqual([region.box for region in regions], boxes)
+        for region in regions:
+            x, y, w, h = region.box
+            self.assertEqual(region.features, get_ellipse_color_features(
+                cut_region_in_image(im, x, y, w, h)))
@@ -0,0 +1,335 @@
+'''detector of billiards at a fixed position, with its own geometry and
+thresholds.
+
+    A BallDetector can not be changed once built, so one instance can be
+    shared by any count of threads, and cameras with different geometries
+    can be served by different detectors in one process. The module level
+    functions of image_process and billiards_distinguish keep using the
+    global position and constants, default_detector() is a detector of them.
+'''
+
+
+import unittest
+import numpy
+from PIL import Image
+from BilliardsDistinguish import image_process
+from BilliardsDistinguish.image_process import cut_region_in_image, \
+    get_default_position, get_ellipse_mask, _analyze_selected_pixels, \
+    _get_ellipse_pixels, _is_white_color_array
+from BilliardsDistinguish.billiards_distinguish import get_billiards_number, \
+    get_billiards_numbers, get_billiards_numbers_of_parameters
+from BilliardsDistinguish.decode import open_region
+
+
+class BallDetector(object):
+    '''classify billiards at a fixed position of pictures.
+
+    Attributes:
+        position: (left, top, width, height) of the billiards.
+        white_max_saturation, white_min_lightness: thresholds of white color,
+            see is_white_color.
+        parameters: None to classify with get_billiards_number, or a tuple
+            of (name, value) of constants of billiards_distinguish, see
+            get_billiards_numbers_of_parameters, e.g. the result of tuning.
+        mask: read only numpy bool array with shape (height, width), True for
+            pixels inside the ellipse.
+        offsets: read only offsets of pixels inside the ellipse, see
+            EllipseMask.offsets
+        correction: None, or an instance of calibration.ColorCorrection
+            applied to the pixels inside the ellipse before their features
+            are computed.
+    '''
+    __slots__ = ("position", "white_max_saturation", "white_min_lightness",
+                 "parameters", "mask", "offsets", "correction")
+
+    def __init__(self, position=None, white_max_saturation=None,
+                 white_min_lightness=None, parameters=None, correction=None):
+        '''
+        Args:
+            position(option): default: get_default_position()
+            white_max_saturation(option): default: WHITE_MAX_SATURATION
+            white_min_lightness(option): default: WHITE_MIN_LIGHTNESS
+            parameters(option): mapping or pairs of constants, default: None
+            correction(option): color correction of the camera, default: None
+        '''
+        if position is None:
+            position = get_default_position()
+        if white_max_saturation is None:
+            white_max_saturation = image_process.WHITE_MAX_SATURATION
+        if white_min_lightness is None:
+            white_min_lightness = image_process.WHITE_MIN_LIGHTNESS
+        if parameters is not None:
+            parameters = tuple(sorted(dict(parameters).items()))
+        x, y, w, h = position
+        assert w > 0 and h > 0 and x >= 0 and y >= 0
+        set_ = super(BallDetector, self).__setattr__
+        set_("position", tuple(int(value) for value in position))
+        set_("white_max_saturation", white_max_saturation)
+        set_("white_min_lightness", white_min_lightness)
+        set_("parameters", parameters)
+        # shared with every detector of the geometry, so building one, e.g.
+        # when unpickled in a worker process, does not draw the ellipse again
+        mask = get_ellipse_mask(w, h)
+        set_("mask", mask.array)
+        set_("offsets", mask.offsets)
+        set_("correction", correction)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("BallDetector can not be changed, use replace")
+
+    def __delattr__(self, name):
+        raise AttributeError("BallDetector can not be changed, use replace")
+
+    def __reduce__(self):
+        return (BallDetector, (self.position, self.white_max_saturation,
+                               self.white_min_lightness, self.parameters,
+                               self.correction))
+
+    def __repr__(self):
+        return "BallDetector(%r, %r, %r, %r, %r)" % \
+            (self.position, self.white_max_saturation,
+             self.white_min_lightness, self.parameters, self.correction)
+
+    def _key(self):
+        return (self.position, self.white_max_saturation,
+                self.white_min_lightness, self.parameters, self.correction)
+
+    def __eq__(self, other):
+        return isinstance(other, BallDetector) and self._key() == other._key()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self._key())
+
+    def replace(self, **changes):
+        '''a new detector with some attributes changed.'''
+        arguments = dict(position=self.position,
+                         white_max_saturation=self.white_max_saturation,
+                         white_min_lightness=self.white_min_lightness,
+                         parameters=self.parameters,
+                         correction=self.correction)
+        arguments.update(changes)
+        return BallDetector(**arguments)
+
+    def cut(self, im):
+        '''cut the billiards from a picture, mode "RGB".'''
+        x, y, w, h = self.position
+        im_cut = cut_region_in_image(im, x, y, w, h)
+        if im_cut.mode != "RGB":
+            im_cut = im_cut.convert("RGB")
+        return im_cut
+
+    def open(self, filename):
+        '''decode only the billiards of a picture file, see open_region.'''
+        return open_region(filename, self.position)
+
+    def get_features(self, im_cut):
+        '''get_ellipse_color_features with thresholds of the detector.
+
+        Args:
+            im_cut: an instance of PIL.Image, the billiards cut by cut or open.
+
+        Returns:
+            (total pixels count, white pixels count, r, g, b)
+        '''
+        assert str(im_cut.mode) == "RGB"
+        return self.get_array_features(numpy.asarray(im_cut))
+
+    def _get_inside_pixels(self, pixels):
+        # only the pixels inside the ellipse are corrected
+        selected = _get_ellipse_pixels(pixels, self.offsets)
+        if self.correction is not None:
+            selected = self.correction.apply_array(selected)
+        return selected
+
+    def get_array_features(self, pixels):
+        '''get_features of an array of the billiards, e.g. a frame of a
+        FrameArchive, the array is not copied.
+
+        Args:
+            pixels: numpy uint8 array with shape (height, width, 3).
+
+        Returns:
+            (total pixels count, white pixels count, r, g, b)
+        '''
+        assert pixels.shape == self.mask.shape + (3,)
+        selected = self._get_inside_pixels(pixels)
+        white = _is_white_color_array(selected, self.white_max_saturation,
+                                      self.white_min_lightness)
+        histogram, maxCount, total, whiteCount = _analyze_selected_pixels(
+            selected, white, masked=True)
+        return (total, whiteCount) + maxCount
+
+    def get_batch_features(self, pixels):
+        '''get_array_features of many billiards in one pass.
+
+        Args:
+            pixels: numpy uint8 array with shape (count, height, width, 3).
+
+        Returns:
+            numpy int64 array with shape (count, 5), rows of (total pixels
+            count, white pixels count, r, g, b)
+        '''
+        assert pixels.shape[1:] == self.mask.shape + (3,)
+        count = len(pixels)
+        inside = self._get_inside_pixels(pixels)
+        white = _is_white_color_array(inside, self.white_max_saturation,
+                                      self.white_min_lightness)
+        items = numpy.nonzero(~white)[0]
+        selected = inside[~white]
+        # histograms of all billiards in one bincount, 256 bins per billiards
+        offsets = items * 256
+        features = numpy.empty((count, 5), dtype=numpy.int64)
+        features[:, 0] = len(self.offsets)
+        features[:, 1] = white.sum(axis=1)
+        for band in range(3):
+            histograms = numpy.bincount(offsets + selected[:, band],
+                                        minlength=count * 256)
+            features[:, 2 + band] = histograms.reshape(count, 256).argmax(axis=1)
+        return features
+
+    def classify_batch_features(self, features):
+        '''classify_features of rows of get_batch_features.
+
+        Returns:
+            list of numbers of the billiards, None if unknown.
+        '''
+        features = numpy.asarray(features)
+        ratios = features[:, 1] / features[:, 0].astype(numpy.float64)
+        r, g, b = features[:, 2], features[:, 3], features[:, 4]
+        if self.parameters is None:
+            numbers = get_billiards_numbers(ratios, r, g, b)
+        else:
+            numbers = get_billiards_numbers_of_parameters(
+                ratios, r, g, b, dict(self.parameters))
+        return [None if number < 0 else int(number) for number in numbers]
+
+    def classify_features(self, features):
+        '''number of the billiards of features, None if unknown.'''
+        total_pixels, white_pixels, r, g, b = features
+        ratio = float(white_pixels) / total_pixels
+        if self.parameters is None:
+            return get_billiards_number(ratio, r, g, b)
+        number = get_billiards_numbers_of_parameters(ratio, r, g, b,
+                                                     dict(self.parameters))
+        return None if number < 0 else int(number)
+
+    def classify(self, im):
+        '''number of the billiards in a picture, see classify_features.'''
+        return self.classify_features(self.get_features(self.cut(im)))
+
+    def classify_file(self, filename):
+        '''number of the billiards in a picture file, see classify_features.'''
+        return self.classify_features(self.get_features(self.open(filename)))
+
+
+_default_detector = None
+
+def default_detector():
+    '''detector of the global position and white thresholds of
+    image_process, a new one is built after they are changed.
+    '''
+    global _default_detector
+    detector = _default_detector
+    if detector is None or \
+            detector.position != get_default_position() or \
+            detector.white_max_saturation != image_process.WHITE_MAX_SATURATION or \
+            detector.white_min_lightness != image_process.WHITE_MIN_LIGHTNESS:
+        detector = BallDetector()
+        _default_detector = detector
+    return detector
+
+
+
+###############################################################################
+# for unit test
+###############################################################################
+class DetectorTest(unittest.TestCase):
+    PICTURES = (("../../../pictures/VGA/%s_a.jpg", (215, 130, 265, 265)),
+                ("../../../pictures/720p/%s_a.jpg", (585, 165, 415, 415)))
+
+    def test_immutable(self):
+        detector = BallDetector((1, 2, 30, 40))
+        self.assertRaises(AttributeError, setattr, detector, "position",
+                          (0, 0, 1, 1))
+        self.assertRaises(AttributeError, delattr, detector, "parameters")
+        self.assertFalse(detector.mask.flags.writeable)
+        other = detector.replace(position=(0, 0, 10, 10))
+        self.assertEqual(detector.position, (1, 2, 30, 40))
+        self.assertEqual(other.position, (0, 0, 10, 10))
+        self.assertEqual(detector, BallDetector((1, 2, 30, 40)))
+
+    def test_pickle(self):
+        import pickle
+        detector = BallDetector((1, 2, 30, 40), parameters={"a": 1})
+        self.assertEqual(pickle.loads(pickle.dumps(detector)), detector)
+        misses = image_process.ELLIPSE_MASK_CACHE.misses
+        copy = pickle.loads(pickle.dumps(detector))
+        self.assertEqual(image_process.ELLIPSE_MASK_CACHE.misses, misses)
+        self.assertTrue(copy.offsets is detector.offsets)
+
+    def test_defaultDetector(self):
+        position = get_default_position()
+        try:
+            image_process.set_default_position(215, 130, 265, 265)
+            detector = default_detector()
+            self.assertEqual(detector.position, (215, 130, 265, 265))
+            self.assertTrue(default_detector() is detector)
+            image_process.set_default_position(1, 2, 3, 4)
+            self.assertEqual(default_detector().position, (1, 2, 3, 4))
+        finally:
+            image_process.set_default_position(*position)
+
+    def test_classify(self):
+        from BilliardsDistinguish.tuning import get_current_parameters
+        for pattern, position in self.PICTURES:
+            detector = BallDetector(position)
+            tuned = detector.replace(parameters=get_current_parameters())
+            for number in (9, 12, 13):
+                filename = pattern % number
+                x, y, w, h = position
+                im_cut = cut_region_in_image(Image.open(filename), x, y, w, h)
+                features = image_process.get_ellipse_color_features(im_cut)
+                self.assertEqual(detector.get_features(im_cut), features)
+                expected = get_billiards_number(
+                    float(features[1]) / features[0], *features[2:])
+                self.assertEqual(detector.classify_file(filename), expected)
+                self.assertEqual(tuned.classify(Image.open(filename)), expected)
+        darker = BallDetector(position, white_min_lightness=200)
+        self.assertTrue(darker.get_features(im_cut)[1] < features[1])
+
+    def test_batch(self):
+        from BilliardsDistinguish.tuning import get_current_parameters
+        for pattern, position in self.PICTURES:
+            detector = BallDetector(position)
+            tuned = detector.replace(parameters=get_current_parameters())
+            regions = [numpy.asarray(detector.open(pattern % number))
+                       for number in range(9, 16)]
+            features = detector.get_batch_features(numpy.array(regions))
+            self.assertEqual([tuple(row) for row in features],
+                             [detector.get_array_features(region)
+                              for region in regions])
+            expected = [detector.classify_features(row) for row in features]
+            self.assertEqual(detector.classify_batch_features(features),
+                             expected)
+            self.assertEqual(tuned.classify_batch_features(features), expected)
+
+    def test_threads(self):
+        from multiprocessing.pool import ThreadPool
+        detectors = [BallDetector(position) for pattern, position in
+                     self.PICTURES]
+        jobs = [(detector, pattern % number)
+                for detector, (pattern, position) in zip(detectors,
+                                                         self.PICTURES)
+                for number in range(9, 16)] * 3
+        serial = [detector.classify_file(filename)
+                  for detector, filename in jobs]
+        pool = ThreadPool(4)
+        try:
+            threaded = pool.map(lambda job: job[0].classify_file(job[1]), jobs)
+        finally:
+            pool.close()
+            pool.join()
+        self.assertEqual(threaded, serial)
@@ -0,0 +1,377 @@
+'''persistent store of features of pictures, so pictures classified before
+are not decoded again, e.g. when thresholds of billiards_distinguish are
+tuned over the same archived pictures.
+
+    Features are keyed by the SHA1 of the file content, the billiards
+    position, the white color thresholds and the color correction, so a
+    changed picture, position, definition of white or correction never hits
+    an old entry. Entries are fixed size
+    records in a memory mapped file, with an optional memory mapped file of
+    histograms beside, the store holds at most `capacity` entries and evicts
+    the least recently used one when full, found with a heap of access
+    times instead of scanning all records.
+
+    A store must be written by one process at a time.
+'''
+
+
+import hashlib
+import heapq
+import json
+import os
+import shutil
+import tempfile
+import time
+import unittest
+import StringIO
+import numpy
+from BilliardsDistinguish import image_process
+from BilliardsDistinguish.decode import open_region
+
+DEFAULT_CAPACITY = 100000
+
+# version of the files of the store, a store of other version is cleared
+STORE_VERSION = 2
+
+# (total pixels, white pixels, r, g, b), see get_ellipse_color_features
+FEATURE_COUNT = 5
+HISTOGRAM_LENGTH = 3 * 256
+
+# keys are raw bytes, a "S20" field would drop trailing NUL bytes of digests
+KEY_LENGTH = 20
+FEATURE_RECORD = numpy.dtype([("key", "u1", (KEY_LENGTH,)),
+                              ("features", "<i4", (FEATURE_COUNT,)),
+                              ("flags", "<u4"),
+                              ("atime", "<f8")])
+
+# bits of flags of records
+_HAS_HISTOGRAM = 0x01
+_USED = 0x02
+
+
+def get_feature_key(content, position, max_saturation=None,
+                    min_lightness=None, correction=None):
+    '''key of features of a picture.
+
+    Args:
+        content: content of the picture file.
+        position: (left, top, width, height) of the billiards.
+        max_saturation, min_lightness(option): thresholds of white color,
+            default: WHITE_MAX_SATURATION and WHITE_MIN_LIGHTNESS
+        correction(option): an instance of calibration.ColorCorrection.
+
+    Returns:
+        20 bytes string.
+    '''
+    if max_saturation is None:
+        max_saturation = image_process.WHITE_MAX_SATURATION
+    if min_lightness is None:
+        min_lightness = image_process.WHITE_MIN_LIGHTNESS
+    sha1 = hashlib.sha1(content)
+    sha1.update(repr((tuple(position), max_saturation, min_lightness)))
+    if correction is not None:
+        sha1.update(correction.table.tobytes())
+    return sha1.digest()
+
+def get_file_feature_key(filename, position, max_saturation=None,
+                         min_lightness=None, correction=None):
+    with open(filename, "rb") as fp:
+        return get_feature_key(fp.read(), position, max_saturation,
+                               min_lightness, correction)
+
+
+class FeatureStore(object):
+    '''features store in a directory.
+
+    Attributes:
+        directory: directory of the store.
+        capacity: max count of entries.
+        histograms: True if histograms can be stored.
+        hits, misses: count of get found or not found an entry.
+        evictions: count of entries evicted by put.
+    '''
+    def __init__(self, directory, capacity=None, histograms=False):
+        '''open a store, create it if not exist, a store created with other
+        version or histograms is cleared.
+
+        Args:
+            directory: directory of the store.
+            capacity(option): max count of entries, default: capacity of the
+                existing store, or DEFAULT_CAPACITY for a new store.
+            histograms(option): True to store histograms. default: False
+
+        Raises:
+            ValueError: capacity is not the capacity of the existing store.
+        '''
+        assert capacity is None or capacity > 0
+        metaFile = os.path.join(directory, "store.json")
+        mode = "w+"
+        if os.path.exists(metaFile):
+            with open(metaFile) as fp:
+                stored = json.load(fp)
+            if stored.get("version") == STORE_VERSION:
+                if capacity is None:
+                    capacity = stored["capacity"]
+                elif capacity != stored["capacity"]:
+                    raise ValueError("feature store %s has capacity %d, not "
+                                     "%d" % (directory, stored["capacity"],
+                                             capacity))
+                if stored["histograms"] == histograms:
+                    mode = "r+"
+        elif not os.path.isdir(directory):
+            os.makedirs(directory)
+        if capacity is None:
+            capacity = DEFAULT_CAPACITY
+        self.directory = directory
+        self.capacity = capacity
+        self.histograms = histograms
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        meta = {"version": STORE_VERSION, "capacity": capacity,
+                "histograms": histograms}
+        self._records = numpy.memmap(os.path.join(directory, "features.bin"),
+                                     FEATURE_RECORD, mode, shape=(capacity,))
+        self._histograms = None
+        if histograms:
+            self._histograms = numpy.memmap(
+                os.path.join(directory, "histograms.bin"), "<u4", mode,
+                shape=(capacity, HISTOGRAM_LENGTH))
+        if mode == "w+":
+            with open(metaFile, "w") as fp:
+                json.dump(meta, fp)
+        self._slots = {}
+        self._free = []
+        for slot, record in enumerate(self._records):
+            if record["flags"] & _USED:
+                self._slots[record["key"].tobytes()] = slot
+            else:
+                self._free.append(slot)
+        self._free.reverse()
+        self._rebuild_heap()
+
+    def __len__(self):
+        return len(self._slots)
+
+    def __contains__(self, key):
+        return key in self._slots
+
+    def get(self, key):
+        '''get features of key.
+
+        Returns:
+            (total pixels, white pixels, r, g, b), None if not found.
+        '''
+        slot = self._slots.get(key)
+        if slot is None:
+            self.misses = self.misses + 1
+            return None
+        self.hits = self.hits + 1
+        self._touch(slot)
+        return tuple(int(value) for value in self._records[slot]["features"])
+
+    def get_histogram(self, key):
+        '''get histogram of key, a list like EllipseStats.histogram of
+        analyze_ellipse(im, masked=True), None if not stored.
+        '''
+        slot = self._slots.get(key)
+        if slot is None or not self._records[slot]["flags"] & _HAS_HISTOGRAM:
+            return None
+        return self._histograms[slot].tolist()
+
+    def put(self, key, features, histogram=None):
+        '''put features and optional histogram of key, replace the old ones.'''
+        assert len(features) == FEATURE_COUNT
+        assert len(key) == KEY_LENGTH
+        assert histogram is None or self.histograms
+        slot = self._slots.get(key)
+        if slot is None:
+            slot = self._allocate()
+        record = self._records[slot]
+        flags = _USED
+        if histogram is not None:
+            assert len(histogram) == HISTOGRAM_LENGTH
+            self._histograms[slot] = histogram
+            flags = flags | _HAS_HISTOGRAM
+        record["features"] = features
+        record["flags"] = flags
+        record["key"] = numpy.frombuffer(key, numpy.uint8)
+        self._slots[key] = slot
+        self._touch(slot)
+
+    def _touch(self, slot):
+        # the heap keeps old (atime, slot) items of a slot, they are skipped
+        # when popped, and dropped when the heap is rebuilt
+        atime = time.time()
+        self._records[slot]["atime"] = atime
+        heapq.heappush(self._heap, (atime, slot))
+        if len(self._heap) > 2 * self.capacity + 64:
+            self._rebuild_heap()
+
+    def _rebuild_heap(self):
+        slots = self._slots.values()
+        self._heap = zip(self._records["atime"][slots].tolist(), slots)
+        heapq.heapify(self._heap)
+
+    def _allocate(self):
+        if self._free:
+            return self._free.pop()
+        while True:
+            atime, slot = heapq.heappop(self._heap)
+            record = self._records[slot]
+            if record["flags"] & _USED and record["atime"] == atime:
+                break
+        del self._slots[record["key"].tobytes()]
+        self.evictions = self.evictions + 1
+        return slot
+
+    def clear(self):
+        self._records[:] = numpy.zeros(1, FEATURE_RECORD)
+        self._slots.clear()
+        self._free = range(self.capacity - 1, -1, -1)
+        self._heap = []
+
+    def flush(self):
+        self._records.flush()
+        if self._histograms is not None:
+            self._histograms.flush()
+
+    def close(self):
+        self.flush()
+        self._records = None
+        self._histograms = None
+
+
+def get_file_features(filename, position, store=None, histogram=False):
+    '''get features of the billiards in a picture, from store if there.
+
+    Args:
+        filename: file name of the picture.
+        position: (left, top, width, height) of the billiards.
+        store(option): an instance of FeatureStore, features not in it are
+            put in it.
+        histogram(option): also return the histogram. default: False
+
+    Returns:
+        (total pixels, white pixels, r, g, b), or a tuple of it and the
+        histogram if histogram is True.
+    '''
+    with open(filename, "rb") as fp:
+        content = fp.read()
+    if store is not None:
+        key = get_feature_key(content, position)
+        features = store.get(key)
+        if features is not None and not histogram:
+            return features
+        histogram_ = store.get_histogram(key)
+        if features is not None and histogram_ is not None:
+            return features, histogram_
+    stats = image_process.analyze_ellipse(
+        open_region(StringIO.StringIO(content), position), masked=True)
+    r, g, b = stats.max_count
+    features = (stats.total_pixels, stats.white_pixels, r, g, b)
+    if store is not None:
+        store.put(key, features, stats.histogram if store.histograms else None)
+    if histogram:
+        return features, stats.histogram
+    return features
+
+
+
+###############################################################################
+# for unit test
+###############################################################################
+class FeatureStoreTest(unittest.TestCase):
+    FILENAME = "../../../pictures/VGA/0_a.jpg"
+    POSITION = (215, 130, 265, 265)
+
+    def setUp(self):
+        self._directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self._directory)
+
+    def test_getFeatureKey(self):
+        key = get_file_feature_key(self.FILENAME, self.POSITION)
+        self.assertEqual(len(key), 20)
+        self.assertEqual(key, get_file_feature_key(self.FILENAME, self.POSITION))
+        self.assertNotEqual(key, get_file_feature_key(self.FILENAME,
+                                                      (215, 130, 266, 265)))
+        from BilliardsDistinguish.calibration import ColorCorrection
+        self.assertNotEqual(key, get_file_feature_key(
+            self.FILENAME, self.POSITION, correction=ColorCorrection()))
+
+    def test_putGet(self):
+        store = FeatureStore(self._directory, 4, histograms=True)
+        store.put("a" * 20, (1, 2, 3, 4, 5))
+        store.put("b" * 20, (6, 7, 8, 9, 10), range(HISTOGRAM_LENGTH))
+        self.assertEqual(store.get("a" * 20), (1, 2, 3, 4, 5))
+        self.assertEqual(store.get_histogram("a" * 20), None)
+        self.assertEqual(store.get_histogram("b" * 20), range(HISTOGRAM_LENGTH))
+        self.assertEqual(store.get("c" * 20), None)
+        self.assertEqual((store.hits, store.misses), (1, 1))
+        store.close()
+        store = FeatureStore(self._directory, 4, histograms=True)
+        self.assertEqual(len(store), 2)
+        self.assertEqual(store.get("b" * 20), (6, 7, 8, 9, 10))
+        store.close()
+        self.assertRaises(ValueError, FeatureStore, self._directory, 8, True)
+        store = FeatureStore(self._directory, histograms=True)
+        self.assertEqual((store.capacity, len(store)), (4, 2))
+        store.close()
+        self.assertEqual(len(FeatureStore(self._directory)), 0)
+
+    def test_evict(self):
+        store = FeatureStore(self._directory, 2)
+        store.put("a" * 20, (1, 1, 1, 1, 1))
+        time.sleep(0.01)
+        store.put("b" * 20, (2, 2, 2, 2, 2))
+        time.sleep(0.01)
+        store.get("a" * 20)
+        store.put("c" * 20, (3, 3, 3, 3, 3))
+        self.assertEqual(store.evictions, 1)
+        self.assertTrue("a" * 20 in store)
+        self.assertFalse("b" * 20 in store)
+        self.assertEqual(len(store), 2)
+
+    def test_evictMany(self):
+        store = FeatureStore(self._directory, 8)
+        keys = ["%020d" % i for i in range(40)]
+        for i, key in enumerate(keys):
+            store.put(key, (i, 0, 0, 0, 0))
+            # keep the first key the most recently used
+            store.get(keys[0])
+            time.sleep(0.001)
+        self.assertEqual(store.evictions, 32)
+        self.assertEqual(sorted(store._slots), [keys[0]] + keys[-7:])
+        self.assertTrue(len(store._heap) <= 2 * store.capacity + 64)
+        store.close()
+        store = FeatureStore(self._directory)
+        store.put("x" * 20, (1, 1, 1, 1, 1))
+        self.assertFalse(keys[-7] in store)
+
+    def test_keyEndsWithNul(self):
+        key = "a" * 19 + "\x00"
+        store = FeatureStore(self._directory, 2)
+        store.put(key, (1, 1, 1, 1, 1))
+        store.close()
+        store = FeatureStore(self._directory, 2)
+        self.assertEqual(store.get(key), (1, 1, 1, 1, 1))
+        self.assertEqual(store.get("a" * 19 + "b"), None)
+        store.put("b" * 20, (2, 2, 2, 2, 2))
+        store.put("c" * 20, (3, 3, 3, 3, 3))
+        self.assertFalse(key in store)
+        self.assertEqual(store.evictions, 1)
+        self.assertEqual(len(store), 2)
+
+    def test_getFileFeatures(self):
+        store = FeatureStore(self._directory, 4, histograms=True)
+        features, histogram = get_file_features(self.FILENAME, self.POSITION,
+                                                store, histogram=True)
+        im = open_region(self.FILENAME, self.POSITION)
+        self.assertEqual(features, image_process.get_ellipse_color_features(im))
+        self.assertEqual(get_file_features(self.FILENAME, self.POSITION, store),
+                         features)
+        self.assertEqual(get_file_features(self.FILENAME, self.POSITION, store,
+                                           histogram=True)[1], histogram)
+        self.assertEqual(store.hits, 2)
@@ -0,0 +1,176 @@
+'''skip classification of frames whose billiards has not changed.
+
+    On a live feed the same billiards stays in the region for many frames.
+    ChangeGate keeps a small signature of the region of the last classified
+    frame: the region reduced to size x size pixels with box filter, only
+    pixels inside the ellipse are compared. Frames whose signature is close
+    to it reuse its result instead of being classified again.
+'''
+
+
+import time
+import unittest
+import numpy
+from PIL import Image
+from BilliardsDistinguish.image_process import get_ellipse_mask
+
+DEFAULT_SIZE = 16
+# mean and max absolute difference of signature pixels, in 0 ~ 255
+DEFAULT_MAX_MEAN_DIFFERENCE = 3.0
+DEFAULT_MAX_DIFFERENCE = 48
+
+
+class ChangeGate(object):
+    '''reuse the result of the last classified frame for unchanged frames.
+
+    Attributes:
+        hits: count of frames reused the last result.
+        misses: count of frames classified.
+        gate_seconds: seconds spent on signatures and comparing them.
+        classify_seconds: seconds spent on classifying the misses.
+    '''
+    def __init__(self, size=DEFAULT_SIZE,
+                 max_mean_difference=DEFAULT_MAX_MEAN_DIFFERENCE,
+                 max_difference=DEFAULT_MAX_DIFFERENCE, max_reuse=None):
+        '''
+        Args:
+            size(option): width and height of signatures. default: 16
+            max_mean_difference(option): a frame is changed when the mean
+                absolute difference of its signature is greater. default: 3.0
+            max_difference(option): a frame is changed when the absolute
+                difference of any band of any signature pixel is greater.
+                default: 48
+            max_reuse(option): classify again after reused the result of a
+                frame this many times, default: no limit.
+        '''
+        assert size > 0
+        self._size = size
+        self._inside = get_ellipse_mask(size, size).array
+        self._maxMeanDifference = max_mean_difference
+        self._maxDifference = max_difference
+        self._maxReuse = max_reuse
+        self._signature = None
+        self._result = None
+        self._reused = 0
+        self.hits = 0
+        self.misses = 0
+        self.gate_seconds = 0.0
+        self.classify_seconds = 0.0
+
+    @property
+    def hit_rate(self):
+        if self.hits + self.misses == 0:
+            return 0.0
+        return float(self.hits) / (self.hits + self.misses)
+
+    @property
+    def saved_seconds(self):
+        '''estimated seconds saved by the hits.'''
+        if self.misses == 0:
+            return 0.0
+        return self.hits * (self.classify_seconds / self.misses) - \
+            self.gate_seconds
+
+    def get_signature(self, im_cut):
+        '''signature of a region, numpy int16 array with shape (pixels inside
+        the ellipse, bands).
+        '''
+        small = im_cut.resize((self._size, self._size), Image.BOX)
+        pixels = numpy.asarray(small, dtype=numpy.int16)
+        if pixels.ndim == 2:
+            pixels = pixels[..., numpy.newaxis]
+        return pixels[self._inside]
+
+    def is_changed(self, signature):
+        '''True if signature is changed from the last classified frame.'''
+        if self._signature is None or \
+                self._signature.shape != signature.shape:
+            return True
+        if self._maxReuse is not None and self._reused >= self._maxReuse:
+            return True
+        difference = numpy.abs(signature - self._signature)
+        return difference.mean() > self._maxMeanDifference or \
+            difference.max() > self._maxDifference
+
+    def classify(self, im_cut, classify):
+        '''classify a region, or reuse the result of the last classified frame.
+
+        Args:
+            im_cut: an instance of PIL.Image, the region of the billiards.
+            classify: function of im_cut to its result.
+
+        Returns:
+            (result, True if reused)
+        '''
+        start = time.time()
+        signature = self.get_signature(im_cut)
+        changed = self.is_changed(signature)
+        self.gate_seconds = self.gate_seconds + time.time() - start
+        if not changed:
+            self.hits = self.hits + 1
+            self._reused = self._reused + 1
+            return self._result, True
+        start = time.time()
+        result = classify(im_cut)
+        self.classify_seconds = self.classify_seconds + time.time() - start
+        self.misses = self.misses + 1
+        self._signature = signature
+        self._result = result
+        self._reused = 0
+        return result, False
+
+    def reset(self):
+        '''forget the last classified frame.'''
+        self._signature = None
+        self._result = None
+        self._reused = 0
+
+    def __str__(self):
+        frames = max(self.hits + self.misses, 1)
+        return "gate: %d hits, %d misses, %.1f%% hit rate, gate %.2fms per " \
+            "frame, classify %.2fms per miss" % \
+            (self.hits, self.misses, self.hit_rate * 100,
+             self.gate_seconds * 1000 / frames,
+             self.classify_seconds * 1000 / max(self.misses, 1))
+
+
+
+###############################################################################
+# for unit test
+###############################################################################
+class ChangeGateTest(unittest.TestCase):
+    POSITION = (215, 130, 265, 265)
+
+    def _open(self, name):
+        x, y, w, h = self.POSITION
+        im = Image.open("../../../pictures/VGA/" + name)
+        return im.crop((x, y, x + w, y + h)).convert("RGB")
+
+    def test_classify(self):
+        calls = []
+        def classify(im):
+            calls.append(im)
+            return len(calls)
+        gate = ChangeGate()
+        a = self._open("9_a.jpg")
+        noise = numpy.random.RandomState(0).randint(-6, 7, (265, 265, 3))
+        noisy = Image.fromarray(numpy.clip(numpy.asarray(a, dtype=numpy.int16) +
+                                           noise, 0, 255).astype(numpy.uint8))
+        self.assertEqual(gate.classify(a, classify), (1, False))
+        self.assertEqual(gate.classify(a, classify), (1, True))
+        self.assertEqual(gate.classify(noisy, classify), (1, True))
+        self.assertEqual(gate.classify(self._open("9_b.jpg"), classify),
+                         (2, False))
+        self.assertEqual(gate.classify(self._open("3_a.jpg"), classify),
+                         (3, False))
+        self.assertEqual((gate.hits, gate.misses), (2, 3))
+        self.assertAlmostEqual(gate.hit_rate, 0.4)
+        gate.reset()
+        self.assertEqual(gate.classify(self._open("3_a.jpg"), classify),
+                         (4, False))
+
+    def test_maxReuse(self):
+        gate = ChangeGate(max_reuse=2)
+        a = self._open("9_a.jpg")
+        reused = [gate.classify(a, lambda im: 0)[1] for i in range(6)]
+        self.assertEqual(reused, [False, True, True, False, True, True])
@@ -6,10 +6,16 @@
 
 
 import colorsys
+import os
+import threading
 import unittest
+from collections import OrderedDict
+import numpy
 from PIL import Image, ImageDraw, ImageFilter
 import PIL
 from Crypto.SelfTest import SelfTestError
+from BilliardsDistinguish.profiling import profiled, image_pixels, \
+    array_pixels
 
 # default position and size of billiards in the target pictures
 LEFT = 215
@@ -17,6 +23,11 @@ TOP = 130
 WIDTH = 270
 HEIGHT = 270
 
+# a pixel is white when its HLS saturation is less than WHITE_MAX_SATURATION
+# and its HLS lightness is greater than WHITE_MIN_LIGHTNESS, see is_white_color
+WHITE_MAX_SATURATION = 0.60
+WHITE_MIN_LIGHTNESS = 128
+
 
 def set_default_position(left, top, width, height):
     '''set default position of the billiards in each image.
@@ -36,6 +47,117 @@ def get_default_position():
     global  LEFT, TOP, WIDTH, HEIGHT
     return (LEFT, TOP, WIDTH, HEIGHT)
 
+class EllipseMask(object):
+    '''precomputed ellipse mask of one crop geometry, shared by every caller
+    of EllipseMaskCache.get, so never modify image or array.
+
+    Attributes:
+        image: an instance of PIL.Image with the ellipse drawn in it, mode "1"
+            if the mask is got with mode "1", otherwise converted to the mode.
+        array: numpy bool array with shape (height, width), True for pixels
+            inside the ellipse.
+        count: pixels count inside the ellipse.
+        offsets: numpy intp array of y * width + x of the pixels inside the
+            ellipse in row major order, so only these pixels are read from
+            a flat buffer of the crop, see _get_ellipse_pixels.
+    '''
+    def __init__(self, image, array, count, offsets=None):
+        self.image = image
+        self.array = array
+        self.count = count
+        if offsets is None:
+            offsets = numpy.flatnonzero(array)
+            offsets.flags.writeable = False
+        self.offsets = offsets
+
+    def get_image_offsets(self, x, y, image_width):
+        '''offsets of the ellipse in a flat buffer of a whole image, with the
+        crop at (x, y) of the image, so the pixels are read straight from the
+        image without cutting it.
+        '''
+        width = self.array.shape[1]
+        return (self.offsets // width + y) * image_width + \
+            self.offsets % width + x
+
+
+class EllipseMaskCache(object):
+    '''cache of EllipseMask keyed by (width, height, mode), the least recently
+    used mask is dropped when more than maxsize masks are cached.
+
+    Attributes:
+        maxsize: max count of cached masks.
+        hits: count of get() calls answered from the cache.
+        misses: count of get() calls that had to draw the ellipse.
+    '''
+    def __init__(self, maxsize=16):
+        assert maxsize > 0
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._masks = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._masks)
+
+    def get(self, width, height, mode="1"):
+        '''return the EllipseMask with given size and image mode.
+
+        Args:
+            width: width of the mask, should not less than 0.
+            height: height of the mask, should not less than 0.
+            mode(option): mode of EllipseMask.image, default: "1"
+
+        Raises:
+            AssertError: width < 0 or height < 0.
+        '''
+        assert width >= 0 and height >= 0
+        key = (width, height, mode)
+        with self._lock:
+            mask = self._masks.pop(key, None)
+            if mask is not None:
+                self.hits = self.hits + 1
+                self._masks[key] = mask
+                return mask
+            self.misses = self.misses + 1
+        if mode == "1":
+            mask = _draw_ellipse_mask(width, height)
+        else:
+            mask1 = self.get(width, height)
+            mask = EllipseMask(mask1.image.convert(mode), mask1.array,
+                               mask1.count, mask1.offsets)
+        with self._lock:
+            self._masks[key] = mask
+            while len(self._masks) > self.maxsize:
+                self._masks.popitem(last=False)
+        return mask
+
+    def clear(self):
+        '''drop all cached masks and reset hits and misses.'''
+        with self._lock:
+            self._masks.clear()
+            self.hits = 0
+            self.misses = 0
+
+
+def _draw_ellipse_mask(width, height):
+    imOut = Image.new("1", (width, height) , 0)
+    draw = ImageDraw.Draw(imOut, "1")
+    draw.ellipse((0, 0, width, height), fill=1, outline=1)
+    array = numpy.asarray(imOut, dtype=bool)
+    array.flags.writeable = False
+    return EllipseMask(imOut, array, int(numpy.count_nonzero(array)))
+
+# masks used by all functions in this module
+ELLIPSE_MASK_CACHE = EllipseMaskCache()
+
+def get_ellipse_mask(width, height, mode="1"):
+    '''return the cached EllipseMask with given size, see EllipseMaskCache.get
+    '''
+    return ELLIPSE_MASK_CACHE.get(width, height, mode)
+
+@profiled("ellipse_mask",
+          pixels=lambda width, height, im=None: width * height)
 def create_ellipse_mask_image(width, height, im=None):
     '''Create an image with given size, draw an ellipse at center of the image,
     all pixels outside the ellipse with value 0, and inside the ellipse with
@@ -53,25 +175,101 @@ def create_ellipse_mask_image(width, height, im=None):
         AssertError: width < 0 or height < 0.
     '''
     assert width >= 0 and  height >= 0
-    imOut = Image.new("1", (width, height) , 0)
-    draw = ImageDraw.Draw(imOut, "1")
-    draw.ellipse((0, 0, width, height), fill=1, outline=1)
-    if im != None:
-        assert isinstance(im, PIL.Image.Image) and im.size == (width, height)
-        for x in range(width):
-            for y in range(height):
-                color = im.getpixel((x, y))
-                if is_white_color(color):
-                    imOut.putpixel((x, y), 0)
+    mask = get_ellipse_mask(width, height)
+    if im is None:
+        return mask.image.copy()
+    assert isinstance(im, PIL.Image.Image) and im.size == (width, height)
+    if str(im.mode) in ("RGB", "RGBA", "RGBX", "L"):
+        # only pixels inside the ellipse are tested
+        white = _get_ellipse_white(_get_ellipse_pixels(numpy.asarray(im),
+                                                       mask.offsets))
+        array = numpy.zeros(width * height, dtype=bool)
+        array[mask.offsets[~white]] = True
+        return Image.frombytes("1", (width, height), numpy.packbits(
+            array.reshape(height, width), axis=1).tobytes())
+    imOut = mask.image.copy()
+    for x in range(width):
+        for y in range(height):
+            color = im.getpixel((x, y))
+            if is_white_color(color):
+                imOut.putpixel((x, y), 0)
     return imOut
 
 def is_white_color(color):
     if isinstance(color, tuple):
         h, l, s = colorsys.rgb_to_hls(color[0], color[1], color[2])
-        return abs(s) < 0.60 and l > 128
+        return abs(s) < WHITE_MAX_SATURATION and l > WHITE_MIN_LIGHTNESS
     else:
-        return color > 128
+        return color > WHITE_MIN_LIGHTNESS
+
+@profiled("white_scan", pixels=array_pixels)
+def _is_white_color_array(pixels, max_saturation=None, min_lightness=None):
+    '''vectorized is_white_color, test every pixel of an array at once.
+
+    colorsys.rgb_to_hls gives l = (max + min) / 2.0, and for l > 0.5 it gives
+    s = (max - min) / (2.0 - max - min), the same float operations are used
+    here so the result is exactly the same as is_white_color.
+
+    Args:
+        pixels: numpy array of RGB pixels, shape (..., 3).
+        max_saturation, min_lightness(option): thresholds of white color,
+            default: WHITE_MAX_SATURATION and WHITE_MIN_LIGHTNESS
 
+    Returns:
+        numpy bool array, True for white pixels, shape of pixels without the
+        last axis.
+    '''
+    if max_saturation is None:
+        max_saturation = WHITE_MAX_SATURATION
+    if min_lightness is None:
+        min_lightness = WHITE_MIN_LIGHTNESS
+    rgb = pixels[..., :3]
+    maxc = rgb.max(axis=-1).astype(numpy.int32)
+    minc = rgb.min(axis=-1).astype(numpy.int32)
+    bright = (maxc + minc) / 2.0 > min_lightness
+    # denominator only matters for bright pixels, where it is always positive
+    denominator = numpy.maximum(maxc + minc - 2, 1).astype(numpy.float64)
+    saturation = (maxc - minc) / denominator
+    return bright & (saturation < max_saturation)
+
+def get_white_pixel_array(im, max_saturation=None, min_lightness=None):
+    '''whole image version of is_white_color, test every pixel of the image
+    with exactly the same thresholds in one operation.
+
+    Note: is_white_color raises ZeroDivisionError in colorsys.rgb_to_hls for
+    colors with max band 2 and min band 0, such dark colors are not white here.
+
+    Args:
+        im: an instance of PIL.Image, im.mode is "RGB", "RGBA", "RGBX" or "L"
+        max_saturation, min_lightness(option): thresholds of white color,
+            default: WHITE_MAX_SATURATION and WHITE_MIN_LIGHTNESS
+
+    Returns:
+        numpy bool array with shape (height, width), True for white pixels.
+    '''
+    assert str(im.mode) in ("RGB", "RGBA", "RGBX", "L")
+    pixels = numpy.asarray(im)
+    if pixels.ndim == 2:
+        if min_lightness is None:
+            min_lightness = WHITE_MIN_LIGHTNESS
+        return pixels > min_lightness
+    return _is_white_color_array(pixels, max_saturation, min_lightness)
+
+def create_white_mask_image(im):
+    '''Create an image with same size of the given image, white pixels of the
+    given image are 1 in the output image, others are 0, see is_white_color.
+
+    Args:
+        im: an instance of PIL.Image, see get_white_pixel_array
+
+    Returns:
+        An instance of class PIL.Image with model "1".
+    '''
+    white = get_white_pixel_array(im)
+    return Image.frombytes("1", im.size, numpy.packbits(white, axis=1).tobytes())
+
+@profiled("cut_region",
+          pixels=lambda im, startX, startY, width, height: width * height)
 def cut_region_in_image(im, startX, startY, width, height):
     '''Cut region in the image.
 
@@ -99,11 +297,13 @@ def add_ellipse_mask_to_image(im, masked=False):
         A new PIL.Image instance with mask added.
     '''
     w, h = im.size
-    im_ = None
     if masked:
-        im_ = im
-    imMask = create_ellipse_mask_image(w, h, im_)
-    imOut = Image.composite(im, imMask.convert(im.mode), imMask)
+        imMask = create_ellipse_mask_image(w, h, im)
+        imBackground = imMask.convert(im.mode)
+    else:
+        imMask = get_ellipse_mask(w, h).image
+        imBackground = get_ellipse_mask(w, h, im.mode).image
+    imOut = Image.composite(im, imBackground, imMask)
     return imOut
 
 def locate_billiards_in_image(im, background=1):
@@ -131,6 +331,161 @@ def locate_billiards_in_image(im, background=1):
         im_01 = Image.eval(im_01, reverse_color)
     return im_01.getbbox()
 
+class EllipseStats(object):
+    '''statistics of the pixels inside the ellipse of an image, computed by
+    analyze_ellipse with one pass over the image.
+
+    Attributes:
+        mode: mode of the analyzed image, "RGB" or "L".
+        masked: True if white pixels are NOT counted in histogram, average
+            and max_count.
+        histogram: a list of integer indicate each band's histogram, same as
+            get_ellipse_histogram_of_image(im, masked).
+        max_count: tuple of max count value of each band.
+        average: tuple of average value of each band.
+        average_bright: average brightness, same as
+            get_ellipse_average_bright(im, masked).
+        max_count_bright: max count brightness, same as
+            get_ellipse_max_count_bright(im, masked).
+        total_pixels: all pixels count inside the ellipse.
+        white_pixels: white pixels count inside the ellipse.
+        white_ratio: white_pixels / total_pixels, 0 if no pixel in ellipse.
+    '''
+    __slots__ = ("mode", "masked", "histogram", "max_count", "total_pixels",
+                 "white_pixels", "_average", "_image", "_bright")
+
+    def __init__(self, im, masked, histogram, max_count, total_pixels,
+                 white_pixels):
+        self.mode = str(im.mode)
+        self.masked = masked
+        self.histogram = histogram
+        self.max_count = max_count
+        self.total_pixels = total_pixels
+        self.white_pixels = white_pixels
+        self._average = None
+        self._image = im
+        self._bright = None
+
+    @property
+    def average(self):
+        if self._average is None:
+            self._average = tuple(_get_band_average(self.histogram, start)
+                                  for start in range(0, len(self.histogram), 256))
+        return self._average
+
+    @property
+    def white_ratio(self):
+        if self.total_pixels == 0:
+            return 0.0
+        return float(self.white_pixels) / self.total_pixels
+
+    @property
+    def average_bright(self):
+        return self._get_bright_stats().average[0]
+
+    @property
+    def max_count_bright(self):
+        return self._get_bright_stats().max_count[0]
+
+    def _get_bright_stats(self):
+        if self._bright is None:
+            if self.mode == "L":
+                self._bright = self
+            else:
+                self._bright = analyze_ellipse(self._image.convert("L"),
+                                               self.masked)
+        return self._bright
+
+
+@profiled("analyze_ellipse", pixels=image_pixels)
+def analyze_ellipse(im, masked=False):
+    '''get all statistics of the pixels inside the ellipse of the image with
+    one pass over the image, get_ellipse_histogram_of_image, get_ellipse_*
+    and draw_ellipse_histogram are all views of the result.
+
+    Args:
+        im: an instance of PIL.Image, im.mode == "RGB" or im.mode == "L"
+        masked(option): NOT counter white pixels when set masked to True.
+            default: False
+
+    Returns:
+        an instance of EllipseStats
+    '''
+    assert str(im.mode) in ("RGB", "L")
+    width, height = im.size
+    selected = _get_ellipse_pixels(numpy.asarray(im),
+                                   get_ellipse_mask(width, height).offsets)
+    return EllipseStats(im, masked, *_analyze_selected_pixels(
+        selected, _get_ellipse_white(selected), masked))
+
+def _get_ellipse_pixels(pixels, offsets):
+    '''read pixels inside the ellipse with an offset index, without testing
+    the pixels in the corners.
+
+    Args:
+        pixels: numpy array with shape (..., height, width, bands) or
+            (height, width) for images with one band.
+        offsets: offsets of the ellipse, see EllipseMask.offsets
+
+    Returns:
+        numpy array with shape (..., count of offsets, bands)
+    '''
+    if pixels.ndim == 2:
+        pixels = pixels[..., numpy.newaxis]
+    shape = pixels.shape
+    flat = pixels.reshape(shape[:-3] + (shape[-3] * shape[-2], shape[-1]))
+    return flat.take(offsets, axis=-2)
+
+def _get_ellipse_white(selected, max_saturation=None, min_lightness=None):
+    '''is_white_color of pixels read by _get_ellipse_pixels.'''
+    if selected.shape[-1] == 1:
+        if min_lightness is None:
+            min_lightness = WHITE_MIN_LIGHTNESS
+        return selected[..., 0] > min_lightness
+    return _is_white_color_array(selected, max_saturation, min_lightness)
+
+@profiled("ellipse_histogram", pixels=array_pixels)
+def _analyze_selected_pixels(selected, white, masked=False):
+    '''analyze_ellipse of pixels inside the ellipse.
+
+    Args:
+        selected: numpy uint8 array with shape (count, bands), pixels inside
+            the ellipse, see _get_ellipse_pixels.
+        white: numpy bool array with shape (count,), white pixels.
+        masked(option): NOT counter white pixels. default: False
+
+    Returns:
+        (histogram, max_count, total_pixels, white_pixels), see EllipseStats.
+    '''
+    if masked:
+        selected = selected[~white]
+    bandHistograms = [numpy.bincount(selected[:, i], minlength=256)
+                      for i in range(selected.shape[1])]
+    histogram = numpy.concatenate(bandHistograms).tolist()
+    maxCount = tuple(int(band.argmax()) for band in bandHistograms)
+    return (histogram, maxCount, len(white), int(numpy.count_nonzero(white)))
+
+def _analyze_ellipse_pixels(pixels, white, masked=False, inside=None):
+    '''analyze_ellipse of an array of pixels, so regions of a bigger image
+    can be analyzed by slicing arrays of the whole image.
+
+    Args:
+        pixels: numpy uint8 array with shape (height, width, bands).
+        white: numpy bool array with shape (height, width), white pixels.
+        masked(option): NOT counter white pixels. default: False
+        inside(option): ellipse mask array, default: get_ellipse_mask
+
+    Returns:
+        (histogram, max_count, total_pixels, white_pixels), see EllipseStats.
+    '''
+    if inside is None:
+        h, w = white.shape
+        offsets = get_ellipse_mask(w, h).offsets
+    else:
+        offsets = numpy.flatnonzero(inside)
+    return _analyze_selected_pixels(_get_ellipse_pixels(pixels, offsets),
+                                    white.reshape(-1).take(offsets), masked)
+
 def get_ellipse_histogram_of_image(im, masked=False):
     '''Get histogram of the image, NOT counter pixels outside the ellipse.
 
@@ -143,39 +498,193 @@ def get_ellipse_histogram_of_image(im, masked=False):
         a list of integer indicate each band's histogram  of the given image.
         len(list) equal 256 * band_counter
     '''
-    im_ = None
-    if masked:
-        im_ = im
+    if str(im.mode) in ("RGB", "L"):
+        return analyze_ellipse(im, masked).histogram
     w, h = im.size
-    imMask = create_ellipse_mask_image(w, h, im_)
+    if masked:
+        imMask = create_ellipse_mask_image(w, h, im)
+    else:
+        imMask = get_ellipse_mask(w, h).image
     return im.histogram(imMask)
 
-def smooth_histogram(histogram, filterLength=41):
+def _get_band_average(histogram, start=0):
+    '''average value of the band histogram[start: start + 256], 0 if no pixel
+    is counted in the band.
+    '''
+    countPixels = 0
+    for index in range(256):
+        countPixels = countPixels + histogram[start + index]
+    if countPixels == 0:
+        return 0
+    average = 0
+    for index in range(256):
+        average = average + \
+            float(index * histogram[start + index]) / countPixels
+    return int(average)
+
+def smooth_histogram(histogram, filterLength=41, mode="edge"):
     '''smooth histogram, use filter like (1,1,1,1,1)
 
     Args:
         histogram: a list with length % 256 == 0, and length >= 256
         filterLength: length of filter, the bigger value make more smooth
+        mode(option): how to pad each band at its edges, see
+            smooth_histogram_array. default: "edge"
     Returns:
         the histogram, same one with the arguments.
     '''
-    filter = list()
-    for i in range(filterLength):
-        filter.append(1)
-    bands_count = len(histogram) / 256
-    for i in range(bands_count):
-        _filterList(histogram, filter, start=256 * i, end=256 * (i + 1))
+    histogram[:] = smooth_histogram_array(histogram, filterLength, mode).tolist()
     return histogram
 
-def draw_ellipse_histogram_hsl(im, masked=False):
+def smooth_histogram_array(histograms, filter=41, mode="edge"):
+    '''smooth every band of many histograms at once, each band of 256 values
+    is filtered independently.
+
+    A box filter is a running sum, O(n) whatever its length, other filters are
+    convolved with FFT. As _filterList, integer histograms with integer filter
+    are divided with integer division.
+
+    Args:
+        histograms: array like, length of its last axis % 256 == 0, e.g. one
+            histogram of get_ellipse_histogram_of_image, or an array with
+            shape (count of histograms, 768).
+        filter(option): length of a box filter like (1,1,1,1,1), or a list of
+            weights with odd length. default: 41
+        mode(option): how to pad each band at its edges, "edge" repeats the
+            first and last value of the band, "reflect" and "wrap" work like
+            numpy.pad, "constant" pads 0. default: "edge"
+
+    Returns:
+        numpy array with same shape of histograms.
+    '''
+    assert mode in ("edge", "reflect", "wrap", "constant")
+    histograms = numpy.asarray(histograms)
+    assert histograms.shape[-1] % 256 == 0
+    bands = histograms.reshape(histograms.shape[:-1] +
+                               (histograms.shape[-1] / 256, 256))
+    return _filter_array(bands, filter, mode).reshape(histograms.shape)
+
+def _filter_array(values, filter, mode="edge", constant_values=0):
+    '''filter the last axis of values, see smooth_histogram_array.
+
+    Args:
+        values: numpy array.
+        filter: length of a box filter, or a list of weights with odd length.
+        mode: "edge", "reflect", "wrap" or "constant", see numpy.pad
+        constant_values: (before, after) or one value to pad with when mode is
+            "constant".
+    '''
+    if isinstance(filter, (int, long)):
+        weights = None
+        length = filter
+    else:
+        weights = numpy.asarray(filter)
+        length = len(weights)
+    assert length % 2 == 1
+    half = length / 2
+    padWidth = [(0, 0)] * (values.ndim - 1) + [(half, half)]
+    if mode == "constant":
+        padded = numpy.pad(values, padWidth, mode,
+                           constant_values=constant_values)
+    else:
+        padded = numpy.pad(values, padWidth, mode)
+    integer = padded.dtype.kind in "biu" and \
+        (weights is None or weights.dtype.kind in "biu")
+    if weights is None or (weights == weights[0]).all():
+        weight = 1 if weights is None else weights[0]
+        sums = numpy.zeros(padded.shape[:-1] + (padded.shape[-1] + 1,),
+                           dtype=numpy.int64 if integer else numpy.float64)
+        numpy.cumsum(padded, axis=-1, out=sums[..., 1:])
+        sums = (sums[..., length:] - sums[..., :-length]) * weight
+        allWeight = weight * length
+    else:
+        # correlation, as _filterList, is convolution with reversed weights
+        size = padded.shape[-1] + length - 1
+        spectrum = numpy.fft.rfft(padded, size) * \
+            numpy.fft.rfft(weights[::-1], size)
+        sums = numpy.fft.irfft(spectrum, size)[..., length - 1: padded.shape[-1]]
+        if integer:
+            sums = numpy.rint(sums).astype(numpy.int64)
+        allWeight = weights.sum()
+    assert allWeight != 0
+    if integer:
+        return sums // allWeight
+    return sums / float(allWeight)
+
+def get_hls_pixel_array(im):
+    '''convert every pixel of a RGB image to HLS at once, encoded as
+    (int(h * 255), int(l), int(abs(s))) of colorsys.rgb_to_hls(r, g, b).
+
+    colorsys gets integer values, so (maxc-r), (maxc-g), (maxc-b) are divided
+    with integer division there, and so is saturation of colors with l <= 0.5,
+    the same is done here to get exactly the same values. colorsys raises
+    ZeroDivisionError for colors with max band 2 and min band 0, their
+    saturation is 255 here.
+
+    Args:
+        im: an instance of PIL.Image, im.mode == "RGB"
+
+    Returns:
+        numpy uint8 array with shape (height, width, 3)
+    '''
     assert str(im.mode) == "RGB"
-    width, height = im.size
-    for x in xrange(width):
-        for y in xrange(height):
-            r, g, b = im.getpixel((x, y))
-            h, l, s = colorsys.rgb_to_hls(r, g, b)
-            im.putpixel((x, y), (int(h * 255), int(l), int(abs(s))))
-    return draw_ellipse_histogram(im, masked)
+    pixels = numpy.asarray(im).astype(numpy.int32)
+    r = pixels[..., 0]
+    g = pixels[..., 1]
+    b = pixels[..., 2]
+    maxc = pixels.max(axis=-1)
+    minc = pixels.min(axis=-1)
+    span = numpy.maximum(maxc - minc, 1)
+    rc = (maxc - r) // span
+    gc = (maxc - g) // span
+    bc = (maxc - b) // span
+    h = numpy.where(r == maxc, bc - gc,
+                    numpy.where(g == maxc, 2.0 + rc - bc, 4.0 + gc - rc))
+    h = (h / 6.0) % 1.0
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        s = (maxc - minc) / (maxc + minc - 2.0)
+    s = numpy.where(maxc + minc <= 1, (maxc - minc) // numpy.maximum(maxc + minc, 1),
+                    numpy.minimum(s, 255))
+    gray = maxc == minc
+    hls = numpy.empty(pixels.shape, dtype=numpy.uint8)
+    hls[..., 0] = numpy.where(gray, 0, (h * 255).astype(numpy.int32))
+    hls[..., 1] = (maxc + minc) // 2
+    hls[..., 2] = numpy.where(gray, 0, s.astype(numpy.int32))
+    return hls
+
+def convert_image_to_hls(im):
+    '''return a new image with every pixel of a RGB image converted to HLS,
+    see get_hls_pixel_array, the given image is not changed.
+
+    Args:
+        im: an instance of PIL.Image, im.mode == "RGB"
+
+    Returns:
+        an new instance of PIL.Image, mode "RGB" with bands (H, L, S)
+    '''
+    return Image.fromarray(get_hls_pixel_array(im), "RGB")
+
+def get_ellipse_histogram_hsl(im, masked=False):
+    '''get histogram of bands (H, L, S) of the image, NOT counter pixels
+    outside the ellipse, it's the histogram drawn by draw_ellipse_histogram_hsl.
+
+    Args:
+        im: an instance of PIL.Image, im.mode == "RGB"
+        masked(option): NOT counter white pixels when set masked to True, the
+            pixels are tested after converted to HLS, as
+            draw_ellipse_histogram_hsl does. default: False
+
+    Returns:
+        a list of 768 integer, histogram of band H, L and S.
+    '''
+    return get_ellipse_histogram_of_image(convert_image_to_hls(im), masked)
+
+def draw_ellipse_histogram_hsl(im, masked=False):
+    '''draw histogram of bands (H, L, S) to a new image, see
+    convert_image_to_hls and draw_ellipse_histogram, the given image is not
+    changed.
+    '''
+    return draw_ellipse_histogram(convert_image_to_hls(im), masked)
 
 
 def draw_ellipse_histogram(im, masked=False):
@@ -195,7 +704,8 @@ def draw_ellipse_histogram(im, masked=False):
     assert str(im.mode) == "RGB"
     imOut = Image.new("RGB", (3 * 256, 120), "rgb(255,255,255)")
     draw = ImageDraw.Draw(imOut, "RGB")
-    histogram = get_ellipse_histogram_of_image(im, masked)
+    stats = analyze_ellipse(im, masked)
+    histogram = stats.histogram
     pixCountMaxR = 0
     pixCountMaxG = 0
     pixCountMaxB = 0
@@ -220,8 +730,8 @@ def draw_ellipse_histogram(im, masked=False):
         draw.line([(index + 512, 100), (index + 512, 100 - int(ratioB * 100))],
                   "rgb(0,0,255)")
     draw.line([(0, 100), (767, 100)], "rgb(125,125,125)")
-    averageR, averageG, averageB = get_ellipse_average_RGB(im, masked)
-    maxR, maxG, maxB = get_ellipse_max_count_RGB(im, masked)
+    averageR, averageG, averageB = stats.average
+    maxR, maxG, maxB = stats.max_count
     msg = "maxRGB(%d, %d, %d), averageRGB(%d, %d, %d)" % \
         (maxR, maxG, maxB, averageR, averageG, averageB)
     draw.text((50, 105), text=msg, fill="rgb(0,0,0)", font=None)
@@ -242,7 +752,8 @@ def _draw_ellipse_histogram_L(im, masked=False):
     assert str(im.mode) == "L"
     imOut = Image.new("L", (256, 120), 255)
     draw = ImageDraw.Draw(imOut, "L")
-    histogram = get_ellipse_histogram_of_image(im, masked)
+    stats = analyze_ellipse(im, masked)
+    histogram = stats.histogram
     pixelCountMax = 0.0;
     for index in range(256):
         if histogram[index] > pixelCountMax:
@@ -251,8 +762,8 @@ def _draw_ellipse_histogram_L(im, masked=False):
         ratio = float(float(histogram[index]) / float(pixelCountMax))
         draw.line([(index, 100), (index, 100 - int(ratio * 100))], 0)
     draw.line([(0, 100), (255, 100)], 125)
-    average = get_ellipse_average_bright(im, masked)
-    max = get_ellipse_max_count_bright(im, masked)
+    average = stats.average_bright
+    max = stats.max_count_bright
     msg = "Max(%d),  Average(%d)" % (max, average)
     draw.text((1, 105), msg, 0)
     return imOut
@@ -268,21 +779,7 @@ def get_ellipse_average_bright(im, maksed=True):
     Returns:
         average brightness of the given image.
     '''
-    im = im.convert("L")
-    histogram = get_ellipse_histogram_of_image(im, maksed)
-    index = 0
-    countPixels = 0
-    for count in histogram:
-        countPixels = countPixels + count
-        index = index + 1
-    averageBright = 0
-    index = 0
-    if countPixels == 0:
-        return 0
-    for count in histogram:
-        averageBright = averageBright + float(index * count) / countPixels
-        index = index + 1
-    return  int(averageBright)
+    return analyze_ellipse(im.convert("L"), maksed).average[0]
 
 
 def get_ellipse_average_RGB(im, masked=False):
@@ -297,28 +794,7 @@ def get_ellipse_average_RGB(im, masked=False):
         (R,G,B): average value of band (R,G,B) of the given image.
     '''
     assert str(im.mode) == "RGB"
-    histogram = get_ellipse_histogram_of_image(im, masked)
-    countPixelsR = 0
-    countPixelsG = 0
-    countPixelsB = 0
-    for index in range(256):
-        countPixelsR = countPixelsR + histogram[index]
-        countPixelsG = countPixelsG + histogram[index + 256]
-        countPixelsB = countPixelsB + histogram[index + 512]
-    averageBrightR = 0
-    averageBrightG = 0
-    averageBrightB = 0
-    for index in range(256):
-        if countPixelsR != 0:
-            averageBrightR = averageBrightR + \
-                float(index * histogram[index ]) / countPixelsR
-        if countPixelsG != 0:
-            averageBrightG = averageBrightG + \
-                float(index * histogram[index + 256]) / countPixelsG
-        if countPixelsB != 0:
-            averageBrightB = averageBrightB + \
-                float(index * histogram[index + 512]) / countPixelsB
-    return int(averageBrightR), int(averageBrightG), int(averageBrightB)
+    return analyze_ellipse(im, masked).average
 
 
 def get_ellipse_max_count_bright(im, masked=False):
@@ -333,16 +809,9 @@ def get_ellipse_max_count_bright(im, masked=False):
     Returns:
         max count brightness of the given image.
     '''
-    im = im.convert("L")
-    histogram = get_ellipse_histogram_of_image(im, masked)
-    maxBright = 0
-    targetIndex = 0
-    for index in range(256):
-        if histogram[index] > maxBright:
-            maxBright = histogram[index]
-            targetIndex = index
-    return targetIndex
+    return analyze_ellipse(im.convert("L"), masked).max_count[0]
 
+@profiled("max_count_RGB", pixels=image_pixels)
 def get_ellipse_max_count_RGB(im, masked=False):
     '''get max count value of each band (R,G,B) in the given image, max count
     is the brightness that max count pixels have the same brightness.
@@ -356,28 +825,12 @@ def get_ellipse_max_count_RGB(im, masked=False):
         (r,b,b): max count brightness of band (R,G,B) in the given image.
     '''
     assert str(im.mode) == "RGB"
-    histogram = get_ellipse_histogram_of_image(im, masked)
-    maxR = 0
-    maxG = 0
-    maxB = 0
-    targetIndexR = 0
-    targetIndexG = 0
-    targetIndexB = 0
-    for index in range(256):
-        if histogram[index] > maxR:
-            maxR = histogram[index]
-            targetIndexR = index
-        if histogram[index + 256] > maxG:
-            maxG = histogram[index + 256]
-            targetIndexG = index
-        if histogram[index + 512] > maxB:
-            maxB = histogram[index + 512]
-            targetIndexB = index
-    return targetIndexR, targetIndexG, targetIndexB
+    return analyze_ellipse(im, masked).max_count
 
 def _filterList(targetList, filter=(1, 1, 1), start=0, end=None):
     '''filter the give list.
-    Use Convolution to process list.
+    Use Convolution to process list, padded with the first and the last value
+    of targetList.
 
     Args:
         targetList: the list to be filtered.
@@ -386,60 +839,34 @@ def _filterList(targetList, filter=(1, 1, 1), start=0, end=None):
         end(option): end index(not included) of targetList,default=len(targetList)
     '''
     assert isinstance(filter, tuple) or isinstance(filter, list)
-    length = len(filter)
-    assert length % 2 == 1
+    assert len(filter) % 2 == 1
     if end == None:
         end = len(targetList)
-    newList = []
-    for i in range(length / 2):
-        newList.append(targetList[0])
-    newList.extend(targetList[start: end])
-    for i in range(length / 2):
-        newList.append(targetList[-1])
-    allWeight = 0
-    for i in range(length):
-        allWeight = allWeight + filter[i]
-
-    for i in xrange(start, end):
-        v1 = newList[i - start : i + length - start]
-        targetList[i] = _multiList(v1, filter) / allWeight
-
-def _multiList(v1, v2):
-    '''multiply two list/tuple
-    multiple each value in v1 and v2, and sum them.
-
-    Args:
-        v1: first list/tuple, len(v1) == len(v2).
-        v2: second list/tuple, len(v1) == len(v2).
-    Returns:
-        the produce of the multiply.
-    '''
-    assert len(v1) == len(v2)
-    result = 0
-    for i in range(len(v1)):
-        result = result + v1[i] * v2[i]
-    return result
+    if end <= start:
+        return
+    values = _filter_array(numpy.asarray(targetList[start: end]), list(filter),
+                           "constant", (targetList[0], targetList[-1]))
+    targetList[start: end] = values.tolist()
 
 
+@profiled("color_features", pixels=image_pixels)
 def get_ellipse_color_features(im):
     '''get follow features of the ellipse:
         total pixels count: all pixels inside the ellipse
         white pixels count: all pixels inside the ellipse and is white color.
         most represented color(R,G,B) expect white.
-    '''
-    totalPixelCount = 0
-    whitePixelCount = 0
-    width, height = im.size
-    imMask = create_ellipse_mask_image(width, height)
-    for x in xrange(width):
-        for y in xrange(height):
-            if imMask.getpixel((x, y)) != 0:  # inside ellipse
-                totalPixelCount = totalPixelCount + 1
-                if  is_white_color(im.getpixel((x, y))):
-                    whitePixelCount = whitePixelCount + 1
-    r, g, b = get_ellipse_max_count_RGB(im, masked=True)
+    It is a view of analyze_ellipse(im, masked=True).
 
-    return totalPixelCount, whitePixelCount, r, g, b
+    Args:
+        im: an instance of PIL.Image, im.mode == "RGB"
+
+    Returns:
+        (total pixels count, white pixels count, r, g, b)
+    '''
+    assert str(im.mode) == "RGB"
+    stats = analyze_ellipse(im, masked=True)
+    r, g, b = stats.max_count
+    return stats.total_pixels, stats.white_pixels, r, g, b
 
 
 
@@ -473,6 +900,26 @@ class ImageProcessTest(unittest.TestCase):
         im = cut_region_in_image(self._test_im, x, y, w, h)
         create_ellipse_mask_image(w, h, im)
 
+    def test_createEllipseMaskImage_masked(self):
+        x, y, w, h = get_default_position()
+        for im in (cut_region_in_image(self._test_im, x, y, w, h),
+                   cut_region_in_image(self._test_im, 0, 0, 200, 120).convert("L")):
+            w, h = im.size
+            imExpected = create_ellipse_mask_image(w, h)
+            for x in range(w):
+                for y in range(h):
+                    if is_white_color(im.getpixel((x, y))):
+                        imExpected.putpixel((x, y), 0)
+            self.assertEqual(create_ellipse_mask_image(w, h, im).tobytes(),
+                             imExpected.tobytes())
+
+    def test_addEllipseMask_masked(self):
+        im = Image.new("RGB", (40, 40), "rgb(255,255,255)")
+        im.putpixel((20, 20), (255, 0, 0))
+        imOut = add_ellipse_mask_to_image(im, masked=True)
+        self.assertEqual(imOut.getpixel((10, 20)), (0, 0, 0))
+        self.assertEqual(imOut.getpixel((20, 20)), (255, 0, 0))
+
     def test_createEllipseMaskImage_0_0(self):
         create_ellipse_mask_image(0, 0)
 
@@ -485,6 +932,51 @@ class ImageProcessTest(unittest.TestCase):
     def test_createEllipseMaskImage_639_639(self):
         create_ellipse_mask_image(639, 639)
 
+    def test_createEllipseMaskImage_not_shared(self):
+        imMask = create_ellipse_mask_image(20, 20)
+        imMask.putpixel((10, 10), 0)
+        self.assertNotEqual(create_ellipse_mask_image(20, 20).getpixel((10, 10)), 0)
+
+    def test_ellipseMaskCache(self):
+        cache = EllipseMaskCache(maxsize=2)
+        mask = cache.get(30, 20)
+        self.assertEqual(mask.image.mode, "1")
+        self.assertEqual(mask.array.shape, (20, 30))
+        self.assertEqual(mask.count, mask.image.histogram()[1])
+        self.assertTrue(cache.get(30, 20) is mask)
+        self.assertEqual(cache.get(30, 20, "RGB").image.mode, "RGB")
+        self.assertEqual((cache.hits, cache.misses), (2, 2))
+        cache.get(10, 10)
+        self.assertEqual(len(cache), 2)
+        cache.get(30, 20)
+        self.assertEqual((cache.hits, cache.misses), (2, 4))
+
+    def test_ellipseMaskOffsets(self):
+        mask = get_ellipse_mask(30, 20)
+        self.assertEqual(len(mask.offsets), mask.count)
+        self.assertTrue(numpy.array_equal(mask.array.reshape(-1)[mask.offsets],
+                                          numpy.ones(mask.count, dtype=bool)))
+        self.assertTrue(get_ellipse_mask(30, 20, "L").offsets is mask.offsets)
+        pixels = numpy.random.RandomState(0).randint(0, 256, (50, 70, 3))
+        pixels = pixels.astype(numpy.uint8)
+        self.assertTrue(numpy.array_equal(
+            _get_ellipse_pixels(pixels[12:32, 5:35], mask.offsets),
+            pixels[12:32, 5:35][mask.array]))
+        self.assertTrue(numpy.array_equal(
+            pixels.reshape(-1, 3)[mask.get_image_offsets(5, 12, 70)],
+            pixels[12:32, 5:35][mask.array]))
+        im = Image.fromarray(pixels[12:32, 5:35])
+        white = get_white_pixel_array(im)
+        expected = pixels[12:32, 5:35][mask.array & ~white]
+        stats = analyze_ellipse(im, masked=True)
+        self.assertEqual(stats.total_pixels, mask.count)
+        self.assertEqual(stats.white_pixels,
+                         numpy.count_nonzero(mask.array & white))
+        self.assertEqual(stats.histogram[:256],
+                         numpy.bincount(expected[:, 0], minlength=256).tolist())
+        imMask = numpy.asarray(create_ellipse_mask_image(30, 20, im))
+        self.assertTrue(numpy.array_equal(imMask, mask.array & ~white))
+
     def test_cutImage_0_0_0_0(self):
         self.assertRaises(AssertionError, cut_region_in_image, self._test_im, 0, 0, 0, 0)
 
@@ -574,3 +1066,140 @@ class ImageProcessTest(unittest.TestCase):
     def test_filterList(self):
         l = list(range(256))
         _filterList(l)
+
+    def test_filterList_values(self):
+        for filter in ((1, 1, 1), (1, 2, 1), [1] * 41, (0, 1, 3, 1, 0)):
+            l = [i * i % 97 for i in range(300)]
+            half = len(filter) / 2
+            padded = [l[0]] * half + l[10: 266] + [l[-1]] * half
+            expected = [sum(padded[i + k] * filter[k] for k in range(len(filter))) /
+                        sum(filter) for i in range(256)]
+            _filterList(l, filter, 10, 266)
+            self.assertEqual(l[10: 266], expected)
+
+    def test_smoothHistogram(self):
+        random = numpy.random.RandomState(0)
+        histogram = random.randint(0, 5000, 768).tolist()
+        expected = []
+        for band in range(3):
+            values = histogram[band * 256: (band + 1) * 256]
+            padded = [values[0]] * 20 + values + [values[-1]] * 20
+            expected.extend(sum(padded[i: i + 41]) / 41 for i in range(256))
+        self.assertTrue(smooth_histogram(histogram) is histogram)
+        self.assertEqual(histogram, expected)
+
+    def test_smoothHistogramArray(self):
+        random = numpy.random.RandomState(1)
+        histograms = random.randint(0, 5000, (5, 768))
+        smoothed = smooth_histogram_array(histograms, (1, 2, 3, 2, 1), "reflect")
+        self.assertEqual(smoothed.shape, (5, 768))
+        self.assertEqual(smoothed[3].tolist(), smooth_histogram_array(
+            histograms[3], (1, 2, 3, 2, 1), "reflect").tolist())
+        band = numpy.pad(histograms[2, 256: 512], 2, "reflect")
+        self.assertEqual(smoothed[2, 256 + 44], (band[44] + 2 * band[45] + 3 * band[46] +
+                                                 2 * band[47] + band[48]) / 9)
+        self.assertEqual(smooth_histogram_array(numpy.ones(256), 5, "constant")[0], 0.6)
+
+    def test_analyzeEllipse(self):
+        im = cut_region_in_image(self._test_im, 160, 50, 640, 640)
+        stats = analyze_ellipse(im, masked=True)
+        self.assertEqual(stats.histogram, im.histogram(create_ellipse_mask_image(640, 640, im)))
+        self.assertEqual(stats.max_count, get_ellipse_max_count_RGB(im, True))
+        self.assertEqual(stats.average_bright, get_ellipse_average_bright(im, True))
+        self.assertEqual(stats.total_pixels, get_ellipse_mask(640, 640).count)
+
+    def test_analyzeEllipse_White(self):
+        im = Image.new("RGB", (64, 64), "rgb(255,255,255)")
+        stats = analyze_ellipse(im)
+        self.assertEqual(stats.white_ratio, 1.0)
+        self.assertEqual(stats.average, (255, 255, 255))
+        self.assertEqual(analyze_ellipse(im, masked=True).max_count, (0, 0, 0))
+
+    def test_createWhiteMaskImage(self):
+        im = Image.new("RGB", (11, 3), "rgb(255,255,255)")
+        im.putpixel((9, 1), (255, 0, 0))
+        imMask = create_white_mask_image(im)
+        self.assertEqual(imMask.mode, "1")
+        for x in range(11):
+            for y in range(3):
+                self.assertEqual(imMask.getpixel((x, y)) != 0,
+                                 is_white_color(im.getpixel((x, y))))
+        self.assertEqual(create_white_mask_image(im.convert("L")).getpixel((9, 1)), 0)
+
+    @slow
+    def test_getWhitePixelArray_pictures(self):
+        def is_white(color):
+            try:
+                return is_white_color(color)
+            except ZeroDivisionError:
+                return False
+        for directory in ("../../../pictures/VGA", "../../../pictures/720p"):
+            for name in sorted(os.listdir(directory)):
+                im = Image.open(os.path.join(directory, name))
+                white = get_white_pixel_array(im)
+                # test each color once, then map the result to every pixel
+                pixels = numpy.asarray(im).reshape(-1, 3).astype(numpy.int32)
+                keys = (pixels[:, 0] << 16) | (pixels[:, 1] << 8) | pixels[:, 2]
+                colors, inverse = numpy.unique(keys, return_inverse=True)
+                expected = numpy.array([is_white((int(c) >> 16, (int(c) >> 8) & 255,
+                                                  int(c) & 255)) for c in colors])
+                self.assertTrue(numpy.array_equal(
+                    expected[inverse].reshape(white.shape), white), name)
+
+    def test_getHlsPixelArray(self):
+        def encode(color):
+            try:
+                h, l, s = colorsys.rgb_to_hls(*color)
+            except ZeroDivisionError:
+                return None
+            return (int(h * 255), int(l), int(abs(s)))
+        values = range(0, 256, 5) + [1, 2, 3, 254]
+        colors = [(r, g, b) for r in values for g in values for b in values]
+        im = Image.new("RGB", (len(colors), 1))
+        im.putdata(colors)
+        hls = get_hls_pixel_array(im)[0]
+        for i, color in enumerate(colors):
+            expected = encode(color)
+            if expected is not None:
+                self.assertEqual(tuple(hls[i]), expected, color)
+        self.assertEqual(tuple(hls[colors.index((2, 0, 0))]), (0, 1, 255))
+
+    def test_drawEllipseHistogramHsl(self):
+        x, y, w, h = get_default_position()
+        im = cut_region_in_image(self._test_im, x, y, w, h)
+        imOriginal = im.copy()
+        imHls = im.copy()
+        for x in xrange(w):
+            for y in xrange(h):
+                r, g, b = im.getpixel((x, y))
+                hue, l, s = colorsys.rgb_to_hls(r, g, b)
+                imHls.putpixel((x, y), (int(hue * 255), int(l), int(abs(s))))
+        self.assertEqual(convert_image_to_hls(im).tobytes(), imHls.tobytes())
+        self.assertEqual(draw_ellipse_histogram_hsl(im, True).tobytes(),
+                         draw_ellipse_histogram(imHls, True).tobytes())
+        self.assertEqual(get_ellipse_histogram_hsl(im),
+                         get_ellipse_histogram_of_image(imHls))
+        self.assertEqual(im.tobytes(), imOriginal.tobytes())
+
+    def test_isWhiteColorArray(self):
+        colors = [(255, 255, 255), (200, 200, 200), (150, 150, 150),
+                  (255, 255, 0), (255, 0, 255), (0, 0, 255), (129, 128, 128),
+                  (128, 128, 128), (255, 120, 120), (255, 121, 121)]
+        result = _is_white_color_array(numpy.array(colors, dtype=numpy.uint8))
+        self.assertEqual(list(result), [is_white_color(c) for c in colors])
+
+    def test_getEllipseColorFeatures(self):
+        x, y, w, h = get_default_position()
+        im = cut_region_in_image(self._test_im, x, y, w, h)
+        imMask = create_ellipse_mask_image(w, h)
+        totalPixelCount = 0
+        whitePixelCount = 0
+        for x in xrange(w):
+            for y in xrange(h):
+                if imMask.getpixel((x, y)) != 0:
+                    totalPixelCount = totalPixelCount + 1
+                    if is_white_color(im.getpixel((x, y))):
+                        whitePixelCount = whitePixelCount + 1
+        r, g, b = get_ellipse_max_count_RGB(im, masked=True)
+        self.assertEqual(get_ellipse_color_features(im),
+                         (totalPixelCount, whitePixelCount, r, g, b))
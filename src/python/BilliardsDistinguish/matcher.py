@@ -0,0 +1,316 @@
+'''classify billiards by the nearest labeled reference histogram.
+
+    get_billiards_number uses only the white ratio and the max count color of
+    a billiards, while the whole histogram of the ellipse is known. A
+    signature keeps the histogram of each band of the pixels inside the
+    ellipse, quantized to `bins` bins and normalized, stored as the square
+    roots of the frequencies in one byte each, e.g. 24 bytes with 8 bins.
+
+    The dot product of two such vectors is the Bhattacharyya coefficient of
+    the histograms (1 - its Hellinger distance ** 2 per band), so a frame is
+    matched against all references with one matrix product. Thousands of
+    references per lighting condition take well below a millisecond.
+'''
+
+
+import os
+import shutil
+import sys
+import tempfile
+import timeit
+import unittest
+import numpy
+from BilliardsDistinguish.batch import list_image_files
+from BilliardsDistinguish.decode import open_region
+from BilliardsDistinguish.image_process import get_ellipse_mask, \
+    get_hls_pixel_array
+from BilliardsDistinguish.tuning import get_label
+
+DEFAULT_BINS = 8
+DEFAULT_SPACE = "RGB"
+SPACES = ("RGB", "HLS")
+
+# version of files of HistogramMatcher.save
+MATCHER_VERSION = 1
+
+
+def get_signature(pixels, inside=None, bins=DEFAULT_BINS):
+    '''signature of the billiards in an array of pixels.
+
+    Args:
+        pixels: numpy uint8 array with shape (height, width, 3).
+        inside(option): ellipse mask array, default: get_ellipse_mask
+        bins(option): count of bins of each band, a power of 2 not greater
+            than 256. default: 8
+
+    Returns:
+        numpy uint8 array with shape (3 * bins,), round(255 * sqrt(frequency))
+        of each bin.
+    '''
+    assert 0 < bins <= 256 and 256 % bins == 0
+    if inside is None:
+        h, w = pixels.shape[:2]
+        inside = get_ellipse_mask(w, h).array
+    selected = pixels[inside] // (256 // bins)
+    histograms = numpy.concatenate([
+        numpy.bincount(selected[:, band], minlength=bins)
+        for band in range(3)]).astype(numpy.float64)
+    histograms = histograms / max(len(selected), 1)
+    return numpy.rint(numpy.sqrt(histograms) * 255).astype(numpy.uint8)
+
+def get_image_signature(im_cut, bins=DEFAULT_BINS, space=DEFAULT_SPACE):
+    '''signature of a billiards cut from a picture.
+
+    Args:
+        im_cut: an instance of PIL.Image, mode "RGB".
+        bins(option): see get_signature.
+        space(option): "RGB" or "HLS", see get_hls_pixel_array. default: "RGB"
+    '''
+    assert space in SPACES
+    if space == "HLS":
+        pixels = get_hls_pixel_array(im_cut)
+    else:
+        pixels = numpy.asarray(im_cut)
+    return get_signature(pixels, bins=bins)
+
+
+class HistogramMatcher(object):
+    '''labeled reference signatures.
+
+    Attributes:
+        bins: count of bins of each band of signatures.
+        space: color space of signatures, see get_image_signature.
+        signatures: numpy uint8 array with shape (count, 3 * bins).
+        labels: numpy int16 array of numbers of the billiards.
+    '''
+    def __init__(self, bins=DEFAULT_BINS, space=DEFAULT_SPACE):
+        assert space in SPACES
+        self.bins = bins
+        self.space = space
+        self.signatures = numpy.zeros((0, 3 * bins), dtype=numpy.uint8)
+        self.labels = numpy.zeros(0, dtype=numpy.int16)
+        self._matrix = None
+
+    def __len__(self):
+        return len(self.labels)
+
+    def add(self, signatures, labels):
+        '''add references.
+
+        Args:
+            signatures: array with shape (count, 3 * bins), or one signature.
+            labels: numbers of the billiards of signatures, or one number.
+        '''
+        signatures = numpy.asarray(signatures, dtype=numpy.uint8)
+        signatures = signatures.reshape(-1, 3 * self.bins)
+        labels = numpy.asarray(labels, dtype=numpy.int16).reshape(-1)
+        assert len(signatures) == len(labels)
+        self.signatures = numpy.concatenate((self.signatures, signatures))
+        self.labels = numpy.concatenate((self.labels, labels))
+        self._matrix = None
+
+    def _get_matrix(self):
+        # similarities are products of float32, rebuilt after references added
+        if self._matrix is None:
+            self._matrix = self.signatures.astype(numpy.float32) / \
+                numpy.float32(255 * 255 * 3)
+        return self._matrix
+
+    def get_similarities(self, signatures):
+        '''similarity of signatures to all references, mean Bhattacharyya
+        coefficient of the bands, 1.0 for the same histograms.
+
+        Args:
+            signatures: array with shape (count, 3 * bins).
+
+        Returns:
+            numpy float32 array with shape (count, references).
+        '''
+        signatures = numpy.asarray(signatures, dtype=numpy.float32)
+        return numpy.dot(signatures.reshape(-1, 3 * self.bins),
+                         self._get_matrix().T)
+
+    def match_many(self, signatures, exclude=None):
+        '''labels of the most similar references of signatures.
+
+        Args:
+            signatures: array with shape (count, 3 * bins).
+            exclude(option): index of a reference not matched for each
+                signature, e.g. for leave one out evaluation.
+
+        Returns:
+            (numpy int16 array of labels, numpy float32 array of similarities)
+        '''
+        assert len(self) > 0
+        similarities = self.get_similarities(signatures)
+        if exclude is not None:
+            similarities[numpy.arange(len(similarities)), exclude] = -1
+        nearest = similarities.argmax(axis=1)
+        return (self.labels[nearest],
+                similarities[numpy.arange(len(similarities)), nearest])
+
+    def match(self, signature):
+        '''(label, similarity) of the most similar reference of a signature.'''
+        labels, similarities = self.match_many([signature])
+        return int(labels[0]), float(similarities[0])
+
+    def classify(self, im_cut):
+        '''number of the billiards cut from a picture, see match.'''
+        return self.match(get_image_signature(im_cut, self.bins,
+                                              self.space))[0]
+
+    def save(self, filename):
+        with open(filename, "wb") as fp:
+            numpy.savez(fp, version=MATCHER_VERSION, bins=self.bins,
+                        space=self.space, signatures=self.signatures,
+                        labels=self.labels)
+
+    @classmethod
+    def load(cls, filename):
+        with numpy.load(filename) as data:
+            assert int(data["version"]) == MATCHER_VERSION
+            matcher = cls(int(data["bins"]), str(data["space"]))
+            matcher.add(data["signatures"], data["labels"])
+        return matcher
+
+
+def build_matcher(sets, bins=DEFAULT_BINS, space=DEFAULT_SPACE):
+    '''build a matcher of labeled pictures, unlabeled pictures are skipped.
+
+    Args:
+        sets: iterable of (file names, position of billiards), pictures of
+            each lighting condition and geometry.
+        bins, space(option): see get_image_signature.
+
+    Returns:
+        an instance of HistogramMatcher, and the file names of references.
+    '''
+    matcher = HistogramMatcher(bins, space)
+    signatures = []
+    labels = []
+    references = []
+    for filenames, position in sets:
+        for filename in filenames:
+            label = get_label(filename)
+            if label is None:
+                continue
+            signatures.append(get_image_signature(
+                open_region(filename, position), bins, space))
+            labels.append(label)
+            references.append(filename)
+    if labels:
+        matcher.add(signatures, labels)
+    return matcher, references
+
+def add_arguments(parser):
+    parser.add_argument("inputs", nargs="*",
+                        help="directories or glob patterns of labeled "
+                        "pictures, default: the bundled VGA and 720p pictures")
+    parser.add_argument("--position", type=int, nargs=4,
+                        metavar=("LEFT", "TOP", "WIDTH", "HEIGHT"),
+                        help="position of the billiards in the pictures, "
+                        "needed with inputs")
+    parser.add_argument("--bins", type=int, default=DEFAULT_BINS,
+                        help="count of bins of each band")
+    parser.add_argument("--space", choices=SPACES, default=DEFAULT_SPACE)
+    parser.add_argument("--output", default=None,
+                        help="save the references to this file")
+    parser.set_defaults(func=command)
+
+def command(args):
+    from BilliardsDistinguish.benchmark import DEFAULT_PICTURE_DIR, \
+        PICTURE_SETS
+    if args.inputs:
+        assert args.position, "--position is needed with inputs"
+        sets = [([filename for pattern in args.inputs
+                  for filename in list_image_files(pattern)],
+                 tuple(args.position))]
+    else:
+        sets = [(list_image_files(os.path.join(DEFAULT_PICTURE_DIR, directory)),
+                 position) for name, directory, position in PICTURE_SETS]
+    start = timeit.default_timer()
+    matcher, references = build_matcher(sets, args.bins, args.space)
+    built = timeit.default_timer()
+    if len(matcher) < 2:
+        sys.stderr.write("at least 2 labeled pictures are needed\n")
+        return 1
+    labels, similarities = matcher.match_many(
+        matcher.signatures, exclude=numpy.arange(len(matcher)))
+    correct = int((labels == matcher.labels).sum())
+    sys.stderr.write("%d references of %d bytes, built in %.2fs\n" %
+                     (len(matcher), matcher.signatures.shape[1],
+                      built - start))
+    print "leave one out: %d/%d correct" % (correct, len(matcher))
+    for filename, label, number, similarity in zip(
+            references, matcher.labels, labels, similarities):
+        if label != number:
+            print "    %s: %d matched %d (%.3f)" % (filename, label, number,
+                                                     similarity)
+    # time of one lookup with 5000 references
+    large = HistogramMatcher(matcher.bins, matcher.space)
+    repeat = (5000 + len(matcher) - 1) // len(matcher)
+    large.add(numpy.tile(matcher.signatures, (repeat, 1)),
+              numpy.tile(matcher.labels, repeat))
+    large.match(matcher.signatures[0])
+    count = 200
+    start = timeit.default_timer()
+    for i in xrange(count):
+        large.match(matcher.signatures[i % len(matcher)])
+    print "one match of %d references: %.3fms" % \
+        (len(large), (timeit.default_timer() - start) * 1000 / count)
+    if args.output is not None:
+        matcher.save(args.output)
+    return 0
+
+
+
+###############################################################################
+# for unit test
+###############################################################################
+class MatcherTest(unittest.TestCase):
+    PICTURE_DIR = "../../../pictures/VGA"
+    POSITION = (215, 130, 265, 265)
+
+    def test_getSignature(self):
+        pixels = numpy.zeros((20, 30, 3), dtype=numpy.uint8)
+        pixels[..., 0] = 255
+        pixels[:10, :, 1] = 100
+        inside = numpy.ones((20, 30), dtype=bool)
+        signature = get_signature(pixels, inside, bins=4)
+        self.assertEqual(signature.tolist(), [0, 0, 0, 255, 180, 180, 0, 0,
+                                              255, 0, 0, 0])
+        signature = get_signature(pixels)
+        self.assertEqual(signature.shape, (3 * DEFAULT_BINS,))
+        frequencies = (signature.astype(float) / 255) ** 2
+        self.assertAlmostEqual(frequencies.sum(), 3.0, 1)
+
+    def test_match(self):
+        filenames = list_image_files(self.PICTURE_DIR)
+        references = [name for name in filenames if name.endswith("_a.jpg")]
+        others = [name for name in filenames if name.endswith("_b.jpg")]
+        matcher, names = build_matcher([(references, self.POSITION)])
+        self.assertEqual(names, references)
+        signature = matcher.signatures[3]
+        self.assertEqual(matcher.match(signature),
+                         (matcher.labels[3], matcher.match(signature)[1]))
+        self.assertTrue(matcher.match(signature)[1] > 0.99)
+        correct = 0
+        for filename in others:
+            number = matcher.classify(open_region(filename, self.POSITION))
+            correct = correct + (number == get_label(filename))
+        self.assertTrue(correct >= len(others) * 0.75,
+                        "%d/%d" % (correct, len(others)))
+
+    def test_saveLoad(self):
+        matcher = HistogramMatcher(8, "HLS")
+        matcher.add(numpy.arange(48).reshape(2, 24), [3, 4])
+        directory = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(directory, "matcher.npz")
+            matcher.save(filename)
+            loaded = HistogramMatcher.load(filename)
+        finally:
+            shutil.rmtree(directory)
+        self.assertEqual((loaded.bins, loaded.space), (8, "HLS"))
+        self.assertTrue(numpy.array_equal(loaded.signatures, matcher.signatures))
+        self.assertEqual(loaded.labels.tolist(), [3, 4])
@@ -0,0 +1,333 @@
+'''classify from a reduced region first, decode the full region only when the
+reduced one is not decisive.
+
+    Features of a region decoded at 1/scale size (see open_region) are close
+    to the features at full size, but the max count color of a band may move
+    a little, or jump to another peak of a histogram with two similar peaks.
+    The result of the reduced region is kept only when it is stable: the
+    same number for all features within ratio_margin and color_margin of
+    its features, so no threshold of billiards_distinguish is close, and the
+    peak of every band higher than peak_ratio times any other peak farther
+    than peak_window. Otherwise the full region is classified.
+
+    Only JPEG can be decoded at a reduced size, other pictures are decoded
+    at full size and reduced by averaging blocks of scale * scale pixels,
+    the same pixels the JPEG decoder averages.
+'''
+
+
+import itertools
+import os
+import shutil
+import StringIO
+import sys
+import tempfile
+import timeit
+import unittest
+import numpy
+from PIL import Image
+from BilliardsDistinguish.batch import list_image_files
+from BilliardsDistinguish.decode import open_region
+from BilliardsDistinguish.detector import BallDetector, default_detector
+from BilliardsDistinguish.image_process import _analyze_selected_pixels, \
+    _is_white_color_array
+from BilliardsDistinguish.tuning import get_label
+
+DEFAULT_SCALE = 4
+DEFAULT_RATIO_MARGIN = 0.02
+DEFAULT_COLOR_MARGIN = 2
+DEFAULT_PEAK_WINDOW = 32
+DEFAULT_PEAK_RATIO = 1.25
+
+
+def get_scaled_position(position, scale):
+    '''position of a region in a picture decoded at 1/scale size, the same
+    region as open_region(filename, position, scale).
+    '''
+    x, y, w, h = position
+    left, top = x // scale, y // scale
+    return (left, top, (x + w) // scale - left, (y + h) // scale - top)
+
+
+class CoarseStats(object):
+    '''counters of a CoarseToFineClassifier.
+
+    Attributes:
+        frames: count of classified frames.
+        fallbacks: count of frames classified at full size.
+        seconds: seconds of all classifications.
+    '''
+    def __init__(self):
+        self.frames = 0
+        self.fallbacks = 0
+        self.seconds = 0.0
+
+    @property
+    def fallback_rate(self):
+        if self.frames == 0:
+            return 0.0
+        return float(self.fallbacks) / self.frames
+
+    @property
+    def average_seconds(self):
+        if self.frames == 0:
+            return 0.0
+        return self.seconds / self.frames
+
+    def __str__(self):
+        return "%d frames, %.1f%% at full size, average %.2fms" % \
+            (self.frames, self.fallback_rate * 100,
+             self.average_seconds * 1000)
+
+
+class CoarseToFineClassifier(object):
+    '''classify pictures from a region decoded at 1/scale size, and at full
+    size when it is not stable.
+
+    Attributes:
+        detector: an instance of BallDetector of the full size region.
+        coarse: an instance of BallDetector of the reduced region.
+        scale: the region is first decoded at 1/scale size.
+        stats: an instance of CoarseStats.
+    '''
+    def __init__(self, detector=None, scale=DEFAULT_SCALE,
+                 ratio_margin=DEFAULT_RATIO_MARGIN,
+                 color_margin=DEFAULT_COLOR_MARGIN,
+                 peak_window=DEFAULT_PEAK_WINDOW,
+                 peak_ratio=DEFAULT_PEAK_RATIO):
+        '''
+        Args:
+            detector(option): default: default_detector()
+            scale(option): one of JPEG_SCALES but 1. default: 4
+            ratio_margin(option): margin of white color ratio. default: 0.02
+            color_margin(option): margin of max count values. default: 2
+            peak_window(option): peaks of a band closer than it to the max
+                count value are the same peak. default: 32
+            peak_ratio(option): min ratio of the max count to the counts of
+                other peaks. default: 1.25
+        '''
+        assert scale > 1
+        if detector is None:
+            detector = default_detector()
+        self.detector = detector
+        self.coarse = detector.replace(
+            position=get_scaled_position(detector.position, scale))
+        self.scale = scale
+        self.stats = CoarseStats()
+        self._ratioMargin = ratio_margin
+        self._colorMargin = color_margin
+        self._peakWindow = peak_window
+        self._peakRatio = peak_ratio
+        # offsets of features within the margins, rows of (white pixels
+        # ratio, r, g, b) in -1, 0, 1
+        self._offsets = numpy.array(list(itertools.product((-1, 0, 1),
+                                                           repeat=4)))
+
+    def _get_coarse_features(self, pixels):
+        '''(features, histogram) of the reduced region, see get_features.'''
+        coarse = self.coarse
+        selected = coarse._get_inside_pixels(pixels)
+        white = _is_white_color_array(selected, coarse.white_max_saturation,
+                                      coarse.white_min_lightness)
+        histogram, maxCount, total, whiteCount = _analyze_selected_pixels(
+            selected, white, masked=True)
+        return (total, whiteCount) + maxCount, histogram
+
+    def is_stable(self, features, histogram):
+        '''True if the number of features of the reduced region can be
+        trusted, see the module document.
+
+        Args:
+            features: (total pixels, white pixels, r, g, b)
+            histogram: histogram of the pixels not white, 3 * 256 counts.
+        '''
+        for band in numpy.asarray(histogram).reshape(3, 256):
+            peak = int(band.argmax())
+            others = band.copy()
+            others[max(peak - self._peakWindow, 0):
+                   peak + self._peakWindow + 1] = 0
+            if band[peak] < self._peakRatio * others.max():
+                return False
+        total = features[0]
+        rows = numpy.empty((len(self._offsets), 5), dtype=numpy.int64)
+        rows[:, 0] = total
+        rows[:, 1] = numpy.clip(
+            features[1] + self._offsets[:, 0] * self._ratioMargin * total,
+            0, total)
+        rows[:, 2:] = numpy.clip(
+            numpy.array(features[2:]) + self._offsets[:, 1:] *
+            self._colorMargin, 0, 255)
+        return len(set(self.coarse.classify_batch_features(rows))) == 1
+
+    def _open_not_jpeg(self, fp):
+        '''(full size region, reduced region) of a picture not JPEG.'''
+        x, y, w, h = self.detector.position
+        left, top, width, height = self.coarse.position
+        scale = self.scale
+        # pixels of the reduced region cover the box of width * scale and
+        # height * scale at (left * scale, top * scale), it starts and ends
+        # up to scale - 1 pixels before the full size region
+        left, top = left * scale, top * scale
+        box = open_region(fp, (left, top, x + w - left, y + h - top))
+        reduced = box.resize((width, height), Image.BOX,
+                             (0, 0, width * scale, height * scale))
+        return box.crop((x - left, y - top, x + w - left, y + h - top)), reduced
+
+    def classify_file(self, filename):
+        '''number of the billiards in a picture file, None if unknown.'''
+        start = timeit.default_timer()
+        with open(filename, "rb") as fp:
+            content = fp.read()
+        region = None
+        if Image.open(StringIO.StringIO(content)).format == "JPEG":
+            reduced = open_region(StringIO.StringIO(content),
+                                  self.detector.position, self.scale)
+        else:
+            region, reduced = self._open_not_jpeg(StringIO.StringIO(content))
+        features, histogram = self._get_coarse_features(numpy.asarray(reduced))
+        if self.is_stable(features, histogram):
+            number = self.coarse.classify_features(features)
+        else:
+            if region is None:
+                region = open_region(StringIO.StringIO(content),
+                                     self.detector.position)
+            number = self.detector.classify_features(
+                self.detector.get_features(region))
+            self.stats.fallbacks = self.stats.fallbacks + 1
+        self.stats.frames = self.stats.frames + 1
+        self.stats.seconds = self.stats.seconds + \
+            timeit.default_timer() - start
+        return number
+
+
+def compare_with_full_size(filenames, position, scale=DEFAULT_SCALE):
+    '''classify pictures coarse to fine and at full size.
+
+    Returns:
+        dict with keys "frames", "agree" (count of same numbers as at full
+        size), "fallbacks", "full_correct" and "coarse_correct" (count of
+        labeled pictures classified right), "full_seconds" and
+        "coarse_seconds" (average seconds per picture).
+    '''
+    detector = BallDetector(position)
+    classifier = CoarseToFineClassifier(detector, scale)
+    result = dict(frames=0, agree=0, full_correct=0, coarse_correct=0,
+                  full_seconds=0.0)
+    for filename in filenames:
+        start = timeit.default_timer()
+        full = detector.classify_file(filename)
+        result["full_seconds"] += timeit.default_timer() - start
+        coarse = classifier.classify_file(filename)
+        label = get_label(filename)
+        result["frames"] += 1
+        result["agree"] += full == coarse
+        result["full_correct"] += label is not None and full == label
+        result["coarse_correct"] += label is not None and coarse == label
+    result["fallbacks"] = classifier.stats.fallbacks
+    result["full_seconds"] /= max(result["frames"], 1)
+    result["coarse_seconds"] = classifier.stats.average_seconds
+    return result
+
+def add_arguments(parser):
+    parser.add_argument("inputs", nargs="*",
+                        help="directories or glob patterns of pictures, "
+                        "default: the bundled VGA and 720p pictures")
+    parser.add_argument("--position", type=int, nargs=4,
+                        metavar=("LEFT", "TOP", "WIDTH", "HEIGHT"),
+                        help="position of the billiards in the pictures, "
+                        "needed with inputs")
+    parser.add_argument("--scale", type=int, nargs="+", choices=(2, 4, 8),
+                        default=[2, 4, 8], help="scales to compare")
+    parser.set_defaults(func=command)
+
+def command(args):
+    from BilliardsDistinguish.benchmark import DEFAULT_PICTURE_DIR, \
+        PICTURE_SETS
+    if args.inputs:
+        assert args.position, "--position is needed with inputs"
+        sets = [("inputs", [filename for pattern in args.inputs
+                            for filename in list_image_files(pattern)],
+                 tuple(args.position))]
+    else:
+        sets = [(name, list_image_files(os.path.join(DEFAULT_PICTURE_DIR,
+                                                     directory)), position)
+                for name, directory, position in PICTURE_SETS]
+    print "%-8s %5s %7s %9s %9s %8s %8s %9s %9s" % \
+        ("set", "scale", "frames", "agree", "full size", "correct",
+         "coarse", "full ms", "coarse ms")
+    for name, filenames, position in sets:
+        for scale in args.scale:
+            result = compare_with_full_size(filenames, position, scale)
+            print "%-8s %5d %7d %9s %8.1f%% %8d %8d %9.2f %9.2f" % \
+                (name, scale, result["frames"],
+                 "%d/%d" % (result["agree"], result["frames"]),
+                 100.0 * result["fallbacks"] / max(result["frames"], 1),
+                 result["full_correct"], result["coarse_correct"],
+                 result["full_seconds"] * 1000,
+                 result["coarse_seconds"] * 1000)
+    sys.stdout.flush()
+    return 0
+
+
+
+###############################################################################
+# for unit test
+###############################################################################
+class MultiscaleTest(unittest.TestCase):
+    PICTURES = (("../../../pictures/VGA", (215, 130, 265, 265)),
+                ("../../../pictures/720p", (585, 165, 415, 415)))
+
+    def test_getScaledPosition(self):
+        filename = "../../../pictures/VGA/9_a.jpg"
+        for scale in (2, 4, 8):
+            position = get_scaled_position((215, 130, 265, 265), scale)
+            region = open_region(filename, (215, 130, 265, 265), scale)
+            self.assertEqual(region.size, position[2:])
+
+    def test_isStable(self):
+        classifier = CoarseToFineClassifier(BallDetector((0, 0, 40, 40)))
+        histogram = numpy.zeros(3 * 256, dtype=int)
+        histogram[[30, 256 + 200, 512 + 30]] = 10
+        self.assertTrue(classifier.is_stable((100, 10, 30, 200, 30),
+                                             histogram))
+        # close to the white ratio of big billiards
+        self.assertFalse(classifier.is_stable((100, 19, 30, 200, 30),
+                                              histogram))
+        # close to the dominant band
+        self.assertFalse(classifier.is_stable((100, 10, 30, 200, 199),
+                                              histogram))
+        # two peaks of band R
+        histogram[100] = 9
+        self.assertFalse(classifier.is_stable((100, 10, 30, 200, 30),
+                                              histogram))
+
+    def test_notJpeg(self):
+        directory, position = self.PICTURES[0]
+        detector = BallDetector(position)
+        classifier = CoarseToFineClassifier(detector)
+        temp = tempfile.mkdtemp()
+        try:
+            for number in (9, 12, 13):
+                filename = os.path.join(temp, "%d_a.png" % number)
+                Image.open(os.path.join(directory, "%d_a.jpg" % number)).save(
+                    filename)
+                self.assertEqual(classifier.classify_file(filename),
+                                 detector.classify_file(filename))
+            region, reduced = classifier._open_not_jpeg(filename)
+            self.assertEqual(region.tobytes(), detector.open(filename).tobytes())
+            pixels = numpy.asarray(Image.open(filename))
+        finally:
+            shutil.rmtree(temp)
+        self.assertEqual(classifier.stats.frames, 3)
+        self.assertEqual(reduced.size, classifier.coarse.position[2:])
+        left, top = classifier.coarse.position[:2]
+        block = pixels[top * 4:top * 4 + 4, left * 4:left * 4 + 4]
+        self.assertEqual(reduced.getpixel((0, 0)), tuple(
+            int(round(value)) for value in block.reshape(-1, 3).mean(axis=0)))
+
+    def test_agree(self):
+        for directory, position in self.PICTURES:
+            result = compare_with_full_size(list_image_files(directory),
+                                            position, 4)
+            self.assertEqual(result["agree"], result["frames"])
+            self.assertTrue(result["fallbacks"] < result["frames"])
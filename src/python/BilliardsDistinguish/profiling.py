@@ -0,0 +1,272 @@
+'''per stage timers of the pipeline, built in instead of an external
+profiler.
+
+    Functions of the pipeline are marked with the profiled decorator, or
+    wrap parts of them in PROFILER.stage(name). When PROFILER is disabled,
+    which is the default, a marked function only checks one flag before
+    calling the original. When enabled, every stage counts calls, seconds,
+    seconds not spent in nested stages (self seconds) and pixels processed:
+
+        PROFILER.enable()
+        ... classify some pictures ...
+        print PROFILER.report()
+
+    Stages are timed in every thread, worker processes of batch have their
+    own profiler, use one process to profile batch.
+'''
+
+
+import functools
+import json
+import threading
+import time
+import unittest
+from collections import OrderedDict
+
+
+class StageStats(object):
+    '''statistics of one stage.
+
+    Attributes:
+        calls: count of calls.
+        seconds: seconds from enter to exit of all calls.
+        self_seconds: seconds not spent in nested stages.
+        pixels: count of pixels processed.
+    '''
+    __slots__ = ("calls", "seconds", "self_seconds", "pixels")
+
+    def __init__(self):
+        self.calls = 0
+        self.seconds = 0.0
+        self.self_seconds = 0.0
+        self.pixels = 0
+
+
+class _NoStage(object):
+    '''stage of a disabled profiler, does nothing.'''
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+_NO_STAGE = _NoStage()
+
+
+class _Stage(object):
+    def __init__(self, profiler, name, pixels):
+        self._profiler = profiler
+        self._name = name
+        self._pixels = pixels
+
+    def __enter__(self):
+        # [start, seconds of nested stages]
+        self._frame = [time.time(), 0.0]
+        self._profiler._get_stack().append(self._frame)
+        return self
+
+    def __exit__(self, *exc_info):
+        seconds = time.time() - self._frame[0]
+        stack = self._profiler._get_stack()
+        stack.pop()
+        if stack:
+            stack[-1][1] = stack[-1][1] + seconds
+        self._profiler.record(self._name, seconds, seconds - self._frame[1],
+                              self._pixels)
+        return False
+
+
+class Profiler(object):
+    '''registry of StageStats by stage name.
+
+    Attributes:
+        enabled: True if stages are timed.
+    '''
+    def __init__(self):
+        self.enabled = False
+        self._stages = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def enable(self):
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def reset(self):
+        with self._lock:
+            self._stages = {}
+
+    def stage(self, name, pixels=0):
+        '''context manager timing a stage.
+
+        Args:
+            name: name of the stage.
+            pixels(option): count of pixels processed by the stage.
+        '''
+        if not self.enabled:
+            return _NO_STAGE
+        return _Stage(self, name, pixels)
+
+    def _get_stack(self):
+        stack = getattr(self._local, "stack", None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    def record(self, name, seconds, self_seconds, pixels=0):
+        '''add a call of a stage.'''
+        with self._lock:
+            stats = self._stages.get(name)
+            if stats is None:
+                stats = self._stages[name] = StageStats()
+            stats.calls = stats.calls + 1
+            stats.seconds = stats.seconds + seconds
+            stats.self_seconds = stats.self_seconds + self_seconds
+            stats.pixels = stats.pixels + pixels
+
+    def get_stats(self):
+        '''OrderedDict of stage name to a copy of its StageStats, most self
+        seconds first.
+        '''
+        with self._lock:
+            items = []
+            for name, stats in self._stages.items():
+                copy = StageStats()
+                for slot in StageStats.__slots__:
+                    setattr(copy, slot, getattr(stats, slot))
+                items.append((name, copy))
+        items.sort(key=lambda item: -item[1].self_seconds)
+        return OrderedDict(items)
+
+    def to_dict(self):
+        '''statistics as an OrderedDict which can be dumped to JSON, with self
+        percent of each stage in all self seconds.
+        '''
+        stages = self.get_stats()
+        total = sum(stats.self_seconds for stats in stages.values())
+        result = OrderedDict()
+        for name, stats in stages.items():
+            result[name] = OrderedDict((
+                ("calls", stats.calls),
+                ("seconds", stats.seconds),
+                ("self_seconds", stats.self_seconds),
+                ("self_percent", 100.0 * stats.self_seconds / total
+                 if total else 0.0),
+                ("pixels", stats.pixels)))
+        return OrderedDict((("total_self_seconds", total), ("stages", result)))
+
+    def to_json(self):
+        return json.dumps(self.to_dict(), indent=2)
+
+    def report(self):
+        '''text report, one line per stage.'''
+        result = self.to_dict()
+        lines = ["%-28s %8s %11s %11s %7s %10s" %
+                 ("stage", "calls", "total ms", "self ms", "self %",
+                  "Mpixel/s")]
+        for name, stats in result["stages"].items():
+            rate = stats["pixels"] / stats["seconds"] / 1e6 \
+                if stats["pixels"] and stats["seconds"] else 0.0
+            lines.append("%-28s %8d %11.2f %11.2f %6.1f%% %10.1f" %
+                         (name, stats["calls"], stats["seconds"] * 1000,
+                          stats["self_seconds"] * 1000, stats["self_percent"],
+                          rate))
+        return "\n".join(lines)
+
+# the profiler of the pipeline
+PROFILER = Profiler()
+
+
+def profiled(name, pixels=None):
+    '''decorator timing every call of a function as a stage of PROFILER.
+
+    Args:
+        name: name of the stage.
+        pixels(option): function of the arguments of the call to the count
+            of pixels processed, only called when PROFILER is enabled.
+    '''
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not PROFILER.enabled:
+                return func(*args, **kwargs)
+            count = pixels(*args, **kwargs) if pixels is not None else 0
+            with _Stage(PROFILER, name, count):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorate
+
+def image_pixels(im, *args, **kwargs):
+    '''pixels of an image given as the first argument, for profiled.'''
+    width, height = im.size
+    return width * height
+
+def array_pixels(array, *args, **kwargs):
+    '''pixels of an array of pixels with shape (..., bands) given as the first
+    argument, for profiled.
+    '''
+    return array.size // array.shape[-1]
+
+
+
+###############################################################################
+# for unit test
+###############################################################################
+class ProfilerTest(unittest.TestCase):
+    def setUp(self):
+        self._enabled = PROFILER.enabled
+        self._stages = PROFILER._stages
+        PROFILER._stages = {}
+
+    def tearDown(self):
+        PROFILER.enabled = self._enabled
+        PROFILER._stages = self._stages
+
+    def test_disabled(self):
+        @profiled("f")
+        def f(x):
+            return x + 1
+        PROFILER.disable()
+        self.assertEqual(f(1), 2)
+        with PROFILER.stage("g"):
+            pass
+        self.assertEqual(PROFILER.get_stats(), {})
+
+    def test_nested(self):
+        @profiled("inner", pixels=lambda n: n)
+        def inner(n):
+            time.sleep(0.01)
+            return n
+        @profiled("outer")
+        def outer():
+            with PROFILER.stage("block"):
+                time.sleep(0.01)
+            return inner(3) + inner(4)
+        PROFILER.enable()
+        self.assertEqual(outer(), 7)
+        stats = PROFILER.get_stats()
+        self.assertEqual(stats.keys()[0], "inner")
+        self.assertEqual((stats["inner"].calls, stats["inner"].pixels), (2, 7))
+        self.assertEqual(stats["outer"].calls, 1)
+        self.assertTrue(stats["outer"].seconds >= 0.03)
+        self.assertTrue(stats["outer"].self_seconds < 0.01)
+        result = json.loads(PROFILER.to_json())
+        self.assertAlmostEqual(sum(stage["self_percent"] for stage in
+                                   result["stages"].values()), 100.0)
+        self.assertEqual(len(PROFILER.report().splitlines()), 4)
+
+    def test_pipeline(self):
+        from BilliardsDistinguish.batch import classify_image_file
+        PROFILER.enable()
+        classify_image_file("../../../pictures/VGA/9_a.jpg",
+                            (215, 130, 265, 265))
+        stats = PROFILER.get_stats()
+        for name in ("decode", "white_scan", "ellipse_histogram",
+                     "get_billiards_number"):
+            self.assertEqual(stats[name].calls, 1)
+        # only pixels inside the ellipse are scanned
+        from BilliardsDistinguish.image_process import get_ellipse_mask
+        self.assertEqual(stats["white_scan"].pixels,
+                         get_ellipse_mask(265, 265).count)
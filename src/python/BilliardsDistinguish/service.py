@@ -0,0 +1,502 @@
+'''classification service for camera nodes on the local network.
+
+    A camera node opens a TCP connection and sends pictures one after
+    another, each as a 4 bytes big endian length and the content of the
+    picture file (JPEG, PNG, ...), and receives one signed byte for each:
+    the number of the billiards, UNKNOWN or ERROR.
+
+    Every connection is served by its own thread, which decodes the region
+    of the billiards, see open_region. Regions are then handed to one
+    batching thread, it waits at most max_wait seconds after the first
+    region for more, up to max_batch regions, and classifies them in one
+    vectorized pass, see BallDetector.get_batch_features. A bigger batch
+    costs latency and gives throughput under load.
+'''
+
+
+import Queue
+import SocketServer
+import StringIO
+import socket
+import struct
+import sys
+import threading
+import time
+import timeit
+import unittest
+from collections import deque
+import numpy
+from BilliardsDistinguish.batch import list_image_files
+from BilliardsDistinguish.calibration import get_command_detector
+from BilliardsDistinguish.detector import BallDetector, default_detector
+
+DEFAULT_PORT = 9527
+DEFAULT_MAX_BATCH = 16
+DEFAULT_MAX_WAIT = 0.005
+
+# requests larger than it are refused and the connection is closed
+MAX_PICTURE_BYTES = 64 * 1024 * 1024
+
+# count of latest latencies kept for percentiles
+LATENCY_WINDOW = 10000
+
+_HEADER = struct.Struct("!I")
+_RESPONSE = struct.Struct("!b")
+
+# responses other than numbers
+UNKNOWN = -1
+ERROR = -2
+
+
+class LatencyStats(object):
+    '''latencies of requests and sizes of batches, updated by many threads.
+
+    Attributes:
+        requests: count of requests.
+        errors: count of requests failed.
+        batches: count of classified batches.
+        max_batch_size: size of the biggest batch.
+    '''
+    def __init__(self, window=LATENCY_WINDOW):
+        self.requests = 0
+        self.errors = 0
+        self.batches = 0
+        self.max_batch_size = 0
+        self._batched = 0
+        self._latencies = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def add_latency(self, seconds):
+        with self._lock:
+            self.requests = self.requests + 1
+            self._latencies.append(seconds)
+
+    def add_error(self):
+        with self._lock:
+            self.errors = self.errors + 1
+
+    def add_batch(self, size):
+        with self._lock:
+            self.batches = self.batches + 1
+            self._batched = self._batched + size
+            self.max_batch_size = max(self.max_batch_size, size)
+
+    @property
+    def average_batch_size(self):
+        if self.batches == 0:
+            return 0.0
+        return float(self._batched) / self.batches
+
+    def get_percentile(self, percent):
+        '''percentile of the latest latencies in seconds, 0.0 if none.'''
+        with self._lock:
+            latencies = list(self._latencies)
+        if not latencies:
+            return 0.0
+        return float(numpy.percentile(latencies, percent))
+
+    @property
+    def p50(self):
+        return self.get_percentile(50)
+
+    @property
+    def p99(self):
+        return self.get_percentile(99)
+
+    def __str__(self):
+        return "%d requests, %d errors, p50 %.2fms, p99 %.2fms, %d batches, " \
+            "average batch %.1f, max batch %d" % \
+            (self.requests, self.errors, self.p50 * 1000, self.p99 * 1000,
+             self.batches, self.average_batch_size, self.max_batch_size)
+
+
+class _Request(object):
+    __slots__ = ("pixels", "number", "error", "done")
+
+    def __init__(self, pixels):
+        self.pixels = pixels
+        self.number = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class BatchClassifier(object):
+    '''classify regions given by many threads in batches, in one thread.'''
+    def __init__(self, detector=None, max_batch=DEFAULT_MAX_BATCH,
+                 max_wait=DEFAULT_MAX_WAIT, stats=None):
+        '''
+        Args:
+            detector(option): an instance of BallDetector,
+                default: default_detector()
+            max_batch(option): max count of regions of a batch. default: 16
+            max_wait(option): max seconds waiting for more regions after the
+                first region of a batch. default: 0.005
+            stats(option): an instance of LatencyStats to count batches.
+        '''
+        assert max_batch > 0 and max_wait >= 0
+        if detector is None:
+            detector = default_detector()
+        self.detector = detector
+        self._maxBatch = max_batch
+        self._maxWait = max_wait
+        self._stats = stats
+        self._queue = Queue.Queue()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def classify(self, im_cut):
+        '''number of the billiards of a region, None if unknown, blocks until
+        its batch is classified.
+
+        Args:
+            im_cut: an instance of PIL.Image, mode "RGB", the billiards cut
+                by detector.cut or detector.open.
+        '''
+        assert str(im_cut.mode) == "RGB"
+        request = _Request(numpy.asarray(im_cut))
+        assert request.pixels.shape == self.detector.mask.shape + (3,)
+        self._queue.put(request)
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.number
+
+    def _next_batch(self):
+        first = self._queue.get()
+        if first is None:
+            return None
+        batch = [first]
+        deadline = time.time() + self._maxWait
+        while len(batch) < self._maxBatch:
+            timeout = deadline - time.time()
+            try:
+                if timeout > 0:
+                    request = self._queue.get(timeout=timeout)
+                else:
+                    request = self._queue.get_nowait()
+            except Queue.Empty:
+                break
+            if request is None:
+                self._queue.put(None)
+                break
+            batch.append(request)
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            try:
+                features = self.detector.get_batch_features(
+                    numpy.array([request.pixels for request in batch]))
+                numbers = self.detector.classify_batch_features(features)
+            except Exception as e:
+                for request in batch:
+                    request.error = e
+            else:
+                for request, number in zip(batch, numbers):
+                    request.number = number
+            for request in batch:
+                request.done.set()
+            if self._stats is not None:
+                self._stats.add_batch(len(batch))
+
+    def close(self):
+        '''stop the batching thread after classified all given regions.'''
+        self._queue.put(None)
+        self._thread.join()
+
+
+def _read_exactly(fp, size):
+    '''read size bytes, None if the connection is closed before.'''
+    data = fp.read(size)
+    if len(data) < size:
+        return None
+    return data
+
+
+class _ClassifyHandler(SocketServer.StreamRequestHandler):
+    def handle(self):
+        server = self.server
+        while True:
+            header = _read_exactly(self.rfile, _HEADER.size)
+            if header is None:
+                return
+            length, = _HEADER.unpack(header)
+            if length > MAX_PICTURE_BYTES:
+                return
+            data = _read_exactly(self.rfile, length)
+            if data is None:
+                return
+            start = timeit.default_timer()
+            try:
+                im_cut = server.classifier.detector.open(
+                    StringIO.StringIO(data))
+                number = server.classifier.classify(im_cut)
+                code = UNKNOWN if number is None else number
+            except Exception:
+                # any failure of one picture, e.g. ValueError of PIL or an
+                # error of its batch, is answered and the connection is kept
+                server.stats.add_error()
+                code = ERROR
+            self.wfile.write(_RESPONSE.pack(code))
+            self.wfile.flush()
+            server.stats.add_latency(timeit.default_timer() - start)
+
+
+class ClassifyServer(SocketServer.ThreadingTCPServer):
+    '''TCP server of the classification service.
+
+    Attributes:
+        classifier: an instance of BatchClassifier.
+        stats: an instance of LatencyStats, latency is from a picture
+            received to its response sent.
+    '''
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, detector=None, max_batch=DEFAULT_MAX_BATCH,
+                 max_wait=DEFAULT_MAX_WAIT):
+        '''
+        Args:
+            address: (host, port) to listen, port 0 for any free port.
+            detector, max_batch, max_wait(option): see BatchClassifier.
+        '''
+        self.stats = LatencyStats()
+        self.classifier = BatchClassifier(detector, max_batch, max_wait,
+                                          self.stats)
+        SocketServer.ThreadingTCPServer.__init__(self, address,
+                                                 _ClassifyHandler)
+
+    def server_close(self):
+        SocketServer.ThreadingTCPServer.server_close(self)
+        self.classifier.close()
+
+
+class ClassifyClient(object):
+    '''connection of a camera node to the service.'''
+    def __init__(self, address, timeout=None):
+        self._socket = socket.create_connection(address, timeout)
+        self._rfile = self._socket.makefile("rb")
+
+    def classify(self, data):
+        '''number of the billiards of a picture.
+
+        Args:
+            data: content of a picture file.
+
+        Returns:
+            number of the billiards, None if unknown.
+
+        Raises:
+            IOError: the service can not classify the picture, or the
+                connection is closed.
+        '''
+        self._socket.sendall(_HEADER.pack(len(data)) + data)
+        response = _read_exactly(self._rfile, _RESPONSE.size)
+        if response is None:
+            raise IOError("connection closed by the service")
+        code, = _RESPONSE.unpack(response)
+        if code == ERROR:
+            raise IOError("the service can not classify the picture")
+        return None if code == UNKNOWN else code
+
+    def close(self):
+        self._rfile.close()
+        self._socket.close()
+
+
+def run_load(address, pictures, connections=8, requests=100):
+    '''send pictures to the service from many connections at once, like many
+    camera nodes.
+
+    Args:
+        address: (host, port) of the service.
+        pictures: list of contents of picture files, sent in turn.
+        connections(option): count of concurrent connections. default: 8
+        requests(option): count of pictures sent by each connection.
+            default: 100
+
+    Returns:
+        (LatencyStats of round trips, seconds of all requests, responses of
+        the first connection)
+    '''
+    assert pictures and connections > 0 and requests > 0
+    stats = LatencyStats()
+    responses = [None] * connections
+    errors = []
+
+    def run(index):
+        client = ClassifyClient(address)
+        try:
+            numbers = []
+            for i in xrange(requests):
+                start = timeit.default_timer()
+                try:
+                    numbers.append(client.classify(
+                        pictures[(index + i) % len(pictures)]))
+                except IOError as e:
+                    numbers.append(e)
+                stats.add_latency(timeit.default_timer() - start)
+            responses[index] = numbers
+        except Exception as e:
+            errors.append(e)
+        finally:
+            client.close()
+
+    threads = [threading.Thread(target=run, args=(i,))
+               for i in range(connections)]
+    start = timeit.default_timer()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    seconds = timeit.default_timer() - start
+    if errors:
+        raise errors[0]
+    return stats, seconds, responses[0]
+
+def add_serve_arguments(parser):
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--position", type=int, nargs=4,
+                        metavar=("LEFT", "TOP", "WIDTH", "HEIGHT"),
+                        help="position of the billiards in the pictures")
+    parser.add_argument("--max-batch", type=int, default=DEFAULT_MAX_BATCH,
+                        help="max count of pictures classified at once")
+    parser.add_argument("--max-wait", type=float,
+                        default=DEFAULT_MAX_WAIT * 1000,
+                        help="max milliseconds waiting to fill a batch")
+    parser.add_argument("--report", type=float, default=10.0,
+                        help="seconds between reports of latency, "
+                        "0 for none")
+    parser.add_argument("--correction", metavar="FILE",
+                        help="color correction of the camera, see calibrate")
+    parser.set_defaults(func=serve_command)
+
+def serve_command(args):
+    detector = get_command_detector(args.position, args.correction)
+    server = ClassifyServer((args.host, args.port), detector, args.max_batch,
+                            args.max_wait / 1000.0)
+    host, port = server.server_address
+    sys.stderr.write("serving on %s:%d\n" % (host, port))
+
+    def report():
+        while True:
+            time.sleep(args.report)
+            sys.stderr.write("%s\n" % server.stats)
+    if args.report > 0:
+        reporter = threading.Thread(target=report)
+        reporter.daemon = True
+        reporter.start()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        sys.stderr.write("%s\n" % server.stats)
+    return 0
+
+def add_loadgen_arguments(parser):
+    parser.add_argument("inputs", nargs="+",
+                        help="directories or glob patterns of pictures")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--connections", type=int, default=8,
+                        help="count of concurrent connections")
+    parser.add_argument("--requests", type=int, default=100,
+                        help="count of pictures sent by each connection")
+    parser.set_defaults(func=loadgen_command)
+
+def loadgen_command(args):
+    pictures = []
+    for pattern in args.inputs:
+        for filename in list_image_files(pattern):
+            with open(filename, "rb") as fp:
+                pictures.append(fp.read())
+    assert pictures, "no pictures found"
+    stats, seconds, responses = run_load((args.host, args.port), pictures,
+                                         args.connections, args.requests)
+    print "%d requests in %.2fs, %.1f requests/s, p50 %.2fms, p99 %.2fms" % \
+        (stats.requests, seconds, stats.requests / seconds, stats.p50 * 1000,
+         stats.p99 * 1000)
+    return 0
+
+
+
+###############################################################################
+# for unit test
+###############################################################################
+class ServiceTest(unittest.TestCase):
+    PICTURE_DIR = "../../../pictures/VGA"
+    POSITION = (215, 130, 265, 265)
+
+    def setUp(self):
+        self._server = ClassifyServer(("127.0.0.1", 0),
+                                      BallDetector(self.POSITION),
+                                      max_batch=4, max_wait=0.05)
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def tearDown(self):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+    def test_classify(self):
+        detector = BallDetector(self.POSITION)
+        filenames = list_image_files(self.PICTURE_DIR)[:8]
+        client = ClassifyClient(self._server.server_address)
+        try:
+            for filename in filenames:
+                with open(filename, "rb") as fp:
+                    self.assertEqual(client.classify(fp.read()),
+                                     detector.classify_file(filename))
+            self.assertRaises(IOError, client.classify, "not a picture")
+            self.assertEqual(client.classify(open(filenames[0], "rb").read()),
+                             detector.classify_file(filenames[0]))
+        finally:
+            client.close()
+        self.assertEqual(self._server.stats.errors, 1)
+        self.assertEqual(self._server.stats.requests, len(filenames) + 2)
+
+    def test_load(self):
+        detector = BallDetector(self.POSITION)
+        filenames = list_image_files(self.PICTURE_DIR)[:6]
+        pictures = [open(filename, "rb").read() for filename in filenames]
+        stats, seconds, responses = run_load(self._server.server_address,
+                                             pictures, connections=4,
+                                             requests=6)
+        self.assertEqual(responses, [detector.classify_file(filename)
+                                     for filename in filenames])
+        self.assertEqual(stats.requests, 24)
+        self.assertTrue(0 < stats.p50 <= stats.p99)
+        self.assertEqual(self._server.stats.requests, 24)
+        self.assertTrue(self._server.stats.max_batch_size <= 4)
+        self.assertTrue(self._server.stats.batches <= 24)
+
+    def test_batchError(self):
+        class BrokenDetector(BallDetector):
+            def classify_batch_features(self, features):
+                raise RuntimeError("broken")
+        server = ClassifyServer(("127.0.0.1", 0),
+                                BrokenDetector(self.POSITION), max_wait=0)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        client = ClassifyClient(server.server_address)
+        try:
+            picture = open(list_image_files(self.PICTURE_DIR)[0], "rb").read()
+            self.assertRaises(IOError, client.classify, picture)
+            self.assertRaises(IOError, client.classify, picture)
+        finally:
+            client.close()
+            server.shutdown()
+            server.server_close()
+            thread.join()
+        self.assertEqual(server.stats.errors, 2)
+        self.assertEqual(server.stats.requests, 2)
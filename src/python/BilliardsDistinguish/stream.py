@@ -0,0 +1,334 @@
+'''classify a continuous sequence of frames, for example the feed of the
+table camera.
+
+    Frames are decoded and cut in a decode thread and classified in the
+    caller's thread, the two stages are connected by a bounded queue, so the
+    pipeline never buffers more than queue_size frames: a producer faster than
+    the classifier is blocked instead of growing memory.
+'''
+
+
+import os
+import re
+import sys
+import threading
+import time
+import unittest
+import Queue
+import numpy
+from PIL import Image
+from BilliardsDistinguish.calibration import get_command_detector
+from BilliardsDistinguish.detector import BallDetector, default_detector
+from BilliardsDistinguish.gate import ChangeGate, DEFAULT_MAX_DIFFERENCE, \
+    DEFAULT_MAX_MEAN_DIFFERENCE
+from BilliardsDistinguish.profiling import profiled
+
+
+class FrameResult(object):
+    '''result of one classified frame.
+
+    Attributes:
+        index: index of the frame in the input sequence, start from 0.
+        number: number of the billiards, see get_billiards_number.
+        features: (total pixels, white pixels, r, g, b) of the frame, see
+            get_ellipse_color_features.
+        latency: seconds from taking the frame from input to its result.
+        reused: True if the result of a previous frame is reused, see
+            ChangeGate.
+    '''
+    __slots__ = ("index", "number", "features", "latency", "reused")
+
+    def __init__(self, index, number, features, latency, reused=False):
+        self.index = index
+        self.number = number
+        self.features = features
+        self.latency = latency
+        self.reused = reused
+
+
+class StreamStats(object):
+    '''counters of a stream, updated while frames are classified.
+
+    Attributes:
+        frames: count of classified frames.
+        elapsed: seconds from the first frame taken to the last result.
+        total_latency: sum of latency of all frames.
+        max_latency: max latency of all frames.
+    '''
+    def __init__(self):
+        self.frames = 0
+        self.elapsed = 0.0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+
+    @property
+    def fps(self):
+        if self.elapsed == 0:
+            return 0.0
+        return self.frames / self.elapsed
+
+    @property
+    def average_latency(self):
+        if self.frames == 0:
+            return 0.0
+        return self.total_latency / self.frames
+
+    def __str__(self):
+        return "%d frames, %.1f frames/s, latency average %.1fms max %.1fms" % \
+            (self.frames, self.fps, self.average_latency * 1000,
+             self.max_latency * 1000)
+
+
+@profiled("decode_frame")
+def decode_frame(frame, frame_size=None):
+    '''decode a frame to an instance of PIL.Image.
+
+    Args:
+        frame: a PIL.Image, a file name, a numpy array with shape
+            (height, width, 3) or a raw RGB buffer (bytearray, buffer or
+            memoryview).
+        frame_size(option): (width, height) of raw RGB buffers.
+
+    Returns:
+        an instance of PIL.Image.
+    '''
+    if isinstance(frame, Image.Image):
+        return frame
+    if isinstance(frame, basestring):
+        return Image.open(frame)
+    if isinstance(frame, numpy.ndarray):
+        return Image.fromarray(frame)
+    assert frame_size is not None, "frame_size is needed for raw RGB frames"
+    width, height = frame_size
+    pixels = numpy.frombuffer(frame, dtype=numpy.uint8)
+    return Image.fromarray(pixels.reshape(height, width, 3), "RGB")
+
+def read_raw_frames(fp, frame_size):
+    '''read raw RGB frames with fixed size from a file object, like the output
+    of a camera or `ffmpeg -f rawvideo -pix_fmt rgb24 -`.
+
+    Args:
+        fp: a file object opened in binary mode.
+        frame_size: (width, height) of each frame.
+
+    Returns:
+        generator of bytearray, one frame each, stop at end of file.
+    '''
+    width, height = frame_size
+    length = width * height * 3
+    while True:
+        frame = bytearray(length)
+        if fp.readinto(frame) != length:
+            return
+        yield frame
+
+def list_numbered_frames(directory):
+    '''list image files of a directory in order of the number in their names,
+    e.g. frame_2.jpg before frame_10.jpg.
+    '''
+    def key(name):
+        return [int(part) if part.isdigit() else part
+                for part in re.split(r"(\d+)", name)]
+    names = [name for name in os.listdir(directory)
+             if name.lower().endswith((".jpg", ".jpeg", ".png", ".bmp"))]
+    return [os.path.join(directory, name) for name in sorted(names, key=key)]
+
+def classify_frames(frames, position=None, frame_size=None, queue_size=8,
+                    stats=None, gate=None):
+    '''classify a sequence of frames. Streams of different cameras can be
+    classified in threads of one process, each with its own position.
+
+    Args:
+        frames: iterable of frames, see decode_frame, consumed lazily.
+        position(option): (left, top, width, height) of the billiards, or an
+            instance of BallDetector, default: default_detector()
+        frame_size(option): (width, height) of raw RGB frames.
+        queue_size(option): max count of decoded frames waiting to be
+            classified. default: 8
+        stats(option): an instance of StreamStats to update.
+        gate(option): an instance of ChangeGate, frames not changed reuse the
+            result of the last classified frame.
+
+    Returns:
+        generator of FrameResult, in order of frames.
+    '''
+    if isinstance(position, BallDetector):
+        detector = position
+    elif position is None:
+        detector = default_detector()
+    else:
+        detector = BallDetector(position)
+    if stats is None:
+        stats = StreamStats()
+    assert queue_size > 0
+    decoded = Queue.Queue(queue_size)
+
+    def classify(im_cut):
+        features = detector.get_features(im_cut)
+        return features, detector.classify_features(features)
+
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                decoded.put(item, timeout=0.1)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def decode():
+        try:
+            for index, frame in enumerate(frames):
+                taken = time.time()
+                if isinstance(frame, basestring):
+                    im_cut = detector.open(frame)
+                else:
+                    im_cut = detector.cut(decode_frame(frame, frame_size))
+                if not put((index, taken, im_cut)):
+                    return
+        except Exception:
+            put(sys.exc_info())
+            return
+        put(None)
+
+    decoder = threading.Thread(target=decode, name="frame-decoder")
+    decoder.daemon = True
+    start = time.time()
+    decoder.start()
+    try:
+        while True:
+            item = decoded.get()
+            if item is None:
+                return
+            if len(item) == 3 and isinstance(item[1], BaseException):
+                raise item[0], item[1], item[2]
+            index, taken, im_cut = item
+            if gate is None:
+                (features, number), reused = classify(im_cut), False
+            else:
+                (features, number), reused = gate.classify(im_cut, classify)
+            now = time.time()
+            latency = now - taken
+            stats.frames = stats.frames + 1
+            stats.elapsed = now - start
+            stats.total_latency = stats.total_latency + latency
+            stats.max_latency = max(stats.max_latency, latency)
+            yield FrameResult(index, number, features, latency, reused)
+    finally:
+        # the decoder may be blocked reading a live source, do not wait for it,
+        # it stops at its next put
+        stop.set()
+
+def add_arguments(parser):
+    parser.add_argument("input",
+                        help="directory of numbered frames, or - to read raw "
+                        "RGB frames from standard input")
+    parser.add_argument("--frame-size", type=int, nargs=2,
+                        metavar=("WIDTH", "HEIGHT"),
+                        help="size of raw RGB frames")
+    parser.add_argument("--position", type=int, nargs=4,
+                        metavar=("LEFT", "TOP", "WIDTH", "HEIGHT"),
+                        help="position of the billiards in the frames")
+    parser.add_argument("--queue-size", type=int, default=8)
+    parser.add_argument("--gate", action="store_true",
+                        help="reuse the last result for unchanged frames")
+    parser.add_argument("--gate-mean", type=float,
+                        default=DEFAULT_MAX_MEAN_DIFFERENCE,
+                        help="max mean difference of unchanged frames")
+    parser.add_argument("--gate-max", type=int, default=DEFAULT_MAX_DIFFERENCE,
+                        help="max difference of unchanged frames")
+    parser.add_argument("--correction", metavar="FILE",
+                        help="color correction of the camera, see calibrate")
+    parser.set_defaults(func=command)
+
+def command(args):
+    if args.input == "-":
+        assert args.frame_size, "--frame-size is needed for raw RGB frames"
+        frame_size = tuple(args.frame_size)
+        frames = read_raw_frames(sys.stdin, frame_size)
+    else:
+        frame_size = None
+        frames = list_numbered_frames(args.input)
+    stats = StreamStats()
+    gate = None
+    if args.gate:
+        gate = ChangeGate(max_mean_difference=args.gate_mean,
+                          max_difference=args.gate_max)
+    detector = get_command_detector(args.position, args.correction)
+    for result in classify_frames(frames, detector, frame_size,
+                                  args.queue_size, stats, gate):
+        sys.stdout.write("%d,%s,%.1f\n" % (result.index, result.number,
+                                           result.latency * 1000))
+        sys.stdout.flush()
+    sys.stderr.write(str(stats) + "\n")
+    if gate is not None:
+        sys.stderr.write(str(gate) + "\n")
+    return 0
+
+
+
+###############################################################################
+# for unit test
+###############################################################################
+class StreamTest(unittest.TestCase):
+    PICTURE_DIR = "../../../pictures/VGA"
+    POSITION = (215, 130, 265, 265)
+
+    def test_listNumberedFrames(self):
+        names = [os.path.basename(filename)
+                 for filename in list_numbered_frames(self.PICTURE_DIR)]
+        self.assertEqual(names[:4], ["0_a.jpg", "0_b.jpg", "1_a.jpg", "1_b.jpg"])
+        self.assertEqual(names[-1], "15_c.jpg")
+
+    def test_classifyFrames(self):
+        filenames = list_numbered_frames(self.PICTURE_DIR)[:6]
+        images = [Image.open(filename) for filename in filenames]
+        raw = [bytearray(im.tobytes()) for im in images]
+        stats = StreamStats()
+        results = list(classify_frames(filenames, self.POSITION, queue_size=2,
+                                       stats=stats))
+        self.assertEqual([r.index for r in results], range(6))
+        self.assertEqual(stats.frames, 6)
+        self.assertTrue(stats.fps > 0)
+        for frames in (images, raw):
+            others = list(classify_frames(frames, self.POSITION, images[0].size))
+            self.assertEqual([r.features for r in others],
+                             [r.features for r in results])
+
+    def test_classifyFrames_close(self):
+        frames = list_numbered_frames(self.PICTURE_DIR) * 10
+        results = classify_frames(frames, self.POSITION, queue_size=1)
+        results.next()
+        results.close()
+
+    def test_classifyFrames_threads(self):
+        from multiprocessing.pool import ThreadPool
+        cameras = [(list_numbered_frames(self.PICTURE_DIR)[:8], self.POSITION),
+                   (list_numbered_frames("../../../pictures/720p")[:8],
+                    (585, 165, 415, 415))]
+        def classify(camera):
+            return [r.number for r in classify_frames(*camera)]
+        pool = ThreadPool(2)
+        try:
+            threaded = pool.map(classify, cameras)
+        finally:
+            pool.close()
+            pool.join()
+        self.assertEqual(threaded, [classify(camera) for camera in cameras])
+
+    def test_classifyFrames_gate(self):
+        filenames = list_numbered_frames(self.PICTURE_DIR)[:3]
+        frames = [filename for filename in filenames for i in range(4)]
+        gate = ChangeGate()
+        results = list(classify_frames(frames, self.POSITION, gate=gate))
+        expected = list(classify_frames(frames, self.POSITION))
+        self.assertEqual([r.number for r in results],
+                         [r.number for r in expected])
+        self.assertEqual([r.reused for r in results], [False, True, True, True] * 3)
+        self.assertEqual((gate.hits, gate.misses), (9, 3))
+
+    def test_classifyFrames_error(self):
+        results = classify_frames(["not_exist.jpg"], self.POSITION)
+        self.assertRaises(IOError, list, results)
@@ -0,0 +1,206 @@
+'''track the position of the billiards across frames.
+
+    The rig shifts slightly over time, so the billiards is not always at the
+    same position. Locating it in the whole frame for every frame is costly,
+    BallTracker locates it only in the neighborhood of its previous position,
+    and locates it in the whole frame again only when the result of the
+    neighborhood is not trusted.
+'''
+
+
+import time
+import unittest
+import numpy
+from PIL import Image, ImageDraw
+from BilliardsDistinguish.image_process import locate_billiards_in_image
+
+DEFAULT_MARGIN = 16
+DEFAULT_MIN_CONFIDENCE = 0.8
+
+
+class TrackerStats(object):
+    '''counters of a tracker.
+
+    Attributes:
+        frames: count of updated frames.
+        relocations: count of frames located in the whole frame.
+        total_seconds: seconds of all updates.
+        max_seconds: max seconds of one update.
+        last_seconds: seconds of the last update.
+    '''
+    def __init__(self):
+        self.frames = 0
+        self.relocations = 0
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+        self.last_seconds = 0.0
+
+    @property
+    def relocate_rate(self):
+        if self.frames == 0:
+            return 0.0
+        return float(self.relocations) / self.frames
+
+    @property
+    def average_seconds(self):
+        if self.frames == 0:
+            return 0.0
+        return self.total_seconds / self.frames
+
+    def __str__(self):
+        return "%d frames, %.1f%% relocated, average %.2fms max %.2fms" % \
+            (self.frames, self.relocate_rate * 100, self.average_seconds * 1000,
+             self.max_seconds * 1000)
+
+
+class BallTracker(object):
+    '''track the billiards in a sequence of frames.
+
+    Attributes:
+        box: (x, y, width, height) of the billiards in the last frame, None
+            if never found.
+        confidence: confidence of the neighborhood search of the last frame,
+            1.0 after located in the whole frame, 0.0 if not found.
+        stats: an instance of TrackerStats.
+    '''
+    def __init__(self, box=None, margin=DEFAULT_MARGIN,
+                 min_confidence=DEFAULT_MIN_CONFIDENCE,
+                 locate=locate_billiards_in_image):
+        '''
+        Args:
+            box(option): (x, y, width, height) of the billiards in the first
+                frame, default: located in the first frame.
+            margin(option): pixels searched around the previous box.
+                default: 16
+            min_confidence(option): below it the billiards is located in the
+                whole frame. default: 0.8
+            locate(option): function of an image to the bounding box (left,
+                upper, right, lower) of the billiards in it, or None, like
+                locate_billiards_in_image and PIL.Image.getbbox, used for
+                both the neighborhood and the whole frame.
+        '''
+        assert margin > 0
+        self.box = box
+        self.confidence = 1.0
+        self.stats = TrackerStats()
+        self._margin = margin
+        self._min_confidence = min_confidence
+        self._locate = locate
+
+    def update(self, im):
+        '''find the billiards in the next frame.
+
+        Returns:
+            (x, y, width, height) of the billiards, None if not found.
+        '''
+        start = time.time()
+        self.confidence = 0.0
+        if self.box is not None:
+            box, self.confidence = self._search(im)
+        if self.confidence < self._min_confidence:
+            box = _get_position(self._locate(im))
+            self.confidence = 0.0 if box is None else 1.0
+            self.stats.relocations = self.stats.relocations + 1
+        self.box = box
+        seconds = time.time() - start
+        self.stats.frames = self.stats.frames + 1
+        self.stats.total_seconds = self.stats.total_seconds + seconds
+        self.stats.max_seconds = max(self.stats.max_seconds, seconds)
+        self.stats.last_seconds = seconds
+        return box
+
+    def _search(self, im):
+        '''locate the billiards in the previous box expanded by margin.
+
+        The result is not trusted when it touches a side of the neighborhood
+        inside the frame, the billiards may cross it, otherwise confidence is
+        how much the size stays the same.
+
+        Returns:
+            (box, confidence)
+        '''
+        x, y, w, h = self.box
+        width, height = im.size
+        window = (max(x - self._margin, 0), max(y - self._margin, 0),
+                  min(x + w + self._margin, width),
+                  min(y + h + self._margin, height))
+        if window[0] >= window[2] or window[1] >= window[3]:
+            return None, 0.0
+        found = self._locate(im.crop(window))
+        if found is None:
+            return None, 0.0
+        left, upper, right, lower = found
+        sizes = (window[2] - window[0], window[3] - window[1])
+        if (left == 0 and window[0] > 0) or (upper == 0 and window[1] > 0) or \
+                (right == sizes[0] and window[2] < width) or \
+                (lower == sizes[1] and window[3] < height):
+            return None, 0.0
+        box = (window[0] + left, window[1] + upper, right - left, lower - upper)
+        confidence = float(min(w, box[2])) / max(w, box[2]) * \
+            float(min(h, box[3])) / max(h, box[3])
+        return box, confidence
+
+
+def _get_position(bbox):
+    '''(left, upper, right, lower) to (x, y, width, height).'''
+    if bbox is None:
+        return None
+    left, upper, right, lower = bbox
+    return (left, upper, right - left, lower - upper)
+
+
+
+###############################################################################
+# for unit test
+###############################################################################
+class TrackingTest(unittest.TestCase):
+    SIZE = (320, 240)
+
+    def _create_frame(self, x, y, diameter=80):
+        im = Image.new("RGB", self.SIZE, "white")
+        ImageDraw.Draw(im).ellipse((x, y, x + diameter - 1, y + diameter - 1),
+                                   fill="rgb(20,40,160)")
+        return im
+
+    def _locate(self, im):
+        dark = numpy.asarray(im.convert("L")) < 128
+        return Image.fromarray(dark.astype(numpy.uint8) * 255).getbbox()
+
+    def _expected(self, im):
+        return _get_position(self._locate(im))
+
+    def test_track(self):
+        tracker = BallTracker(locate=self._locate)
+        moves = [(100, 80), (103, 81), (107, 79), (110, 84), (112, 86)]
+        for x, y in moves:
+            im = self._create_frame(x, y)
+            self.assertEqual(tracker.update(im), self._expected(im))
+        self.assertEqual(tracker.stats.frames, 5)
+        self.assertEqual(tracker.stats.relocations, 1)
+        self.assertEqual(tracker.confidence, 1.0)
+        # a jump out of the neighborhood and a lost billiards are relocated
+        im = self._create_frame(200, 20)
+        self.assertEqual(tracker.update(im), self._expected(im))
+        self.assertEqual(tracker.stats.relocations, 2)
+        self.assertEqual(tracker.update(Image.new("RGB", self.SIZE, "white")),
+                         None)
+        im = self._create_frame(10, 150)
+        self.assertEqual(tracker.update(im), self._expected(im))
+        self.assertEqual(tracker.stats.relocations, 4)
+        self.assertAlmostEqual(tracker.stats.relocate_rate, 4 / 8.0)
+        self.assertTrue(tracker.stats.average_seconds > 0)
+
+    def test_track_size(self):
+        tracker = BallTracker(locate=self._locate)
+        tracker.update(self._create_frame(100, 80))
+        im = self._create_frame(100, 80, 60)
+        self.assertEqual(tracker.update(im), self._expected(im))
+        self.assertEqual(tracker.stats.relocations, 2)
+
+    def test_track_default(self):
+        im = Image.open("../../../pictures/VGA/8_a.jpg")
+        tracker = BallTracker()
+        box = tracker.update(im)
+        self.assertEqual(box, _get_position(locate_billiards_in_image(im)))
+        self.assertEqual(tracker.update(im), box)
+        self.assertEqual(tracker.stats.relocations, 1)
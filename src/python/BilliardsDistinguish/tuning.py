@@ -0,0 +1,348 @@
+'''tune thresholds of billiards_distinguish over labeled pictures.
+
+    The number of the billiards is the leading number of the file name of a
+    labeled picture, e.g. 9_b.jpg or 9.jpg is billiards 9. Features of all
+    pictures are extracted once, with a FeatureStore they are extracted once
+    across runs, then every parameter set of a grid is evaluated on the
+    feature matrix with numpy broadcasting, without decoding any picture.
+
+    Parameters:
+        white_min_ratio: white ratio from which a billiards is white,
+            DEFAULT_WHITE_BILLIARDS_WHITE_COLOR_RATIO[0].
+        big_min_ratio: white ratio from which a billiards is big (striped),
+            DEFAULT_BIG_BILLIARDS_WHITE_COLOR_RATIO[0].
+        hue_1_3_5_h, hue_2_6_h, hue_4_7_8_h: DEFAULT_HUE_*_H.
+        black_max_bright, black_max_range: DEFAULT_BLACK_MAX_*.
+'''
+
+
+import json
+import os
+import re
+import sys
+import timeit
+import unittest
+from collections import OrderedDict
+import numpy
+from BilliardsDistinguish import billiards_distinguish
+from BilliardsDistinguish.billiards_distinguish import _get_billiards_types, \
+    _get_color_codes, _get_numbers_of_codes, get_billiards_number, \
+    get_billiards_numbers_of_parameters
+from BilliardsDistinguish.feature_store import FeatureStore, get_file_features
+
+PARAMETER_NAMES = ("white_min_ratio", "big_min_ratio", "hue_1_3_5_h",
+                   "hue_2_6_h", "hue_4_7_8_h", "black_max_bright",
+                   "black_max_range")
+
+# count of numbers of billiards, 0 ~ 15
+NUMBER_COUNT = 16
+
+_LABEL_PATTERN = re.compile(r"^(\d+)(?:_|\.)")
+
+
+def get_label(filename):
+    '''number of the billiards of a labeled picture, None if not labeled.'''
+    match = _LABEL_PATTERN.match(os.path.basename(filename))
+    if match is None or int(match.group(1)) >= NUMBER_COUNT:
+        return None
+    return int(match.group(1))
+
+def get_current_parameters():
+    '''parameters of the constants of billiards_distinguish.'''
+    bd = billiards_distinguish
+    return OrderedDict((
+        ("white_min_ratio", bd.DEFAULT_WHITE_BILLIARDS_WHITE_COLOR_RATIO[0]),
+        ("big_min_ratio", bd.DEFAULT_BIG_BILLIARDS_WHITE_COLOR_RATIO[0]),
+        ("hue_1_3_5_h", bd.DEFAULT_HUE_1_3_5_H),
+        ("hue_2_6_h", bd.DEFAULT_HUE_2_6_H),
+        ("hue_4_7_8_h", bd.DEFAULT_HUE_4_7_8_H),
+        ("black_max_bright", bd.DEFAULT_BLACK_MAX_BRIGHT),
+        ("black_max_range", bd.DEFAULT_BLACK_MAX_RANGE)))
+
+def get_default_grid(steps=5):
+    '''grid of parameters around the constants of billiards_distinguish, the
+    current value of each parameter is always in the grid.
+
+    Args:
+        steps(option): count of values of each parameter, the white ratios
+            get 2 * steps values. default: 5
+
+    Returns:
+        OrderedDict of parameter name to sorted array of values.
+    '''
+    ranges = (("white_min_ratio", 0.60, 0.98, 2 * steps),
+              ("big_min_ratio", 0.02, 0.50, 2 * steps),
+              ("hue_1_3_5_h", 0.05, 0.30, steps),
+              ("hue_2_6_h", 0.35, 0.65, steps),
+              ("hue_4_7_8_h", 0.70, 0.95, steps),
+              ("black_max_bright", 45, 105, steps),
+              ("black_max_range", 10, 40, steps))
+    current = get_current_parameters()
+    grid = OrderedDict()
+    for name, start, stop, count in ranges:
+        values = numpy.linspace(start, stop, count)
+        if name.startswith("black"):
+            # compared with integer bands
+            values = numpy.round(values)
+        grid[name] = numpy.union1d(values, [current[name]])
+    return grid
+
+
+class LabeledFeatures(object):
+    '''features of labeled pictures, one item of each array per picture.
+
+    Attributes:
+        filenames: list of file names.
+        labels: int array of numbers of billiards.
+        features: int array with shape (count, 5), rows are (total pixels,
+            white pixels, r, g, b), see get_ellipse_color_features.
+        ratios: float array of white ratios.
+        r, g, b: int arrays of the most represented color.
+    '''
+    def __init__(self, filenames, labels, features):
+        self.filenames = list(filenames)
+        self.labels = numpy.asarray(labels, dtype=numpy.int16)
+        self.features = numpy.asarray(features, dtype=numpy.int64).reshape(-1, 5)
+        self.ratios = self.features[:, 1].astype(numpy.float64) / \
+            numpy.maximum(self.features[:, 0], 1)
+        self.r = self.features[:, 2]
+        self.g = self.features[:, 3]
+        self.b = self.features[:, 4]
+
+    def __len__(self):
+        return len(self.filenames)
+
+
+def load_labeled_features(filenames, position, store=None):
+    '''extract features of labeled pictures, pictures not labeled are skipped.
+
+    Args:
+        filenames: iterable of picture file names.
+        position: (left, top, width, height) of the billiards.
+        store(option): an instance of FeatureStore.
+
+    Returns:
+        an instance of LabeledFeatures.
+    '''
+    names = []
+    labels = []
+    features = []
+    for filename in filenames:
+        label = get_label(filename)
+        if label is None:
+            continue
+        names.append(filename)
+        labels.append(label)
+        features.append(get_file_features(filename, position, store))
+    return LabeledFeatures(names, labels, features)
+
+def merge_labeled_features(sets):
+    '''merge instances of LabeledFeatures to one.'''
+    return LabeledFeatures(sum([set_.filenames for set_ in sets], []),
+                           numpy.concatenate([set_.labels for set_ in sets]),
+                           numpy.concatenate([set_.features for set_ in sets]))
+
+def predict_numbers(features, parameters=None):
+    '''numbers of billiards of features with one parameter set.
+
+    Args:
+        features: an instance of LabeledFeatures.
+        parameters(option): mapping of PARAMETER_NAMES to values,
+            default: get_current_parameters()
+
+    Returns:
+        numpy int16 array, -1 for None.
+    '''
+    if parameters is None:
+        parameters = get_current_parameters()
+    return get_billiards_numbers_of_parameters(features.ratios, features.r,
+                                               features.g, features.b,
+                                               parameters)
+
+def get_confusion_matrix(labels, numbers):
+    '''confusion matrix of numbers predicted.
+
+    Returns:
+        numpy int array with shape (NUMBER_COUNT, NUMBER_COUNT + 1), rows are
+        labels, columns are predicted numbers, the last column counts None.
+    '''
+    matrix = numpy.zeros((NUMBER_COUNT, NUMBER_COUNT + 1), dtype=numpy.int64)
+    columns = numpy.where(numpy.asarray(numbers) < 0, NUMBER_COUNT, numbers)
+    numpy.add.at(matrix, (numpy.asarray(labels), columns), 1)
+    return matrix
+
+def tune_parameters(features, grid=None):
+    '''find the parameter set of the grid which classifies most pictures
+    correctly, ties are broken by the distance to the current parameters.
+
+    The white ratio parameters only change types and the others only change
+    color codes, so types of each ratio pair and codes of each color
+    parameter set are computed once, and all combinations are evaluated by
+    broadcasting them.
+
+    Args:
+        features: an instance of LabeledFeatures.
+        grid(option): OrderedDict of parameter name to values,
+            default: get_default_grid()
+
+    Returns:
+        (OrderedDict of best parameters, count of correct pictures, count of
+        evaluated parameter sets)
+    '''
+    if grid is None:
+        grid = get_default_grid()
+    labels = features.labels
+
+    white, big = numpy.meshgrid(grid["white_min_ratio"], grid["big_min_ratio"],
+                                indexing="ij")
+    valid = big < white
+    white = white[valid][:, numpy.newaxis]
+    big = big[valid][:, numpy.newaxis]
+    types = _get_billiards_types(features.ratios, [white, 1.0], [big, white],
+                                 [0, big])
+
+    colorNames = PARAMETER_NAMES[2:]
+    colorGrid = [values.ravel()[:, numpy.newaxis] for values in
+                 numpy.meshgrid(*[grid[name] for name in colorNames],
+                                indexing="ij")]
+    codes = _get_color_codes(features.r, features.g, features.b, *colorGrid)
+
+    # correct[i, j]: count of correct pictures of types[i] and codes[j]
+    correct = numpy.empty((len(types), len(codes)), dtype=numpy.int64)
+    for i in xrange(len(types)):
+        numbers = _get_numbers_of_codes(types[i], codes)
+        correct[i] = (numbers == labels).sum(axis=1)
+
+    best = correct.max()
+    rows, columns = numpy.nonzero(correct == best)
+    current = get_current_parameters()
+    candidates = numpy.column_stack(
+        [white[rows, 0], big[rows, 0]] +
+        [values[columns, 0] for values in colorGrid])
+    scale = numpy.array([numpy.ptp(grid[name]) or 1.0
+                         for name in PARAMETER_NAMES])
+    distance = (((candidates - current.values()) / scale) ** 2).sum(axis=1)
+    chosen = candidates[distance.argmin()]
+    parameters = OrderedDict()
+    for name, value in zip(PARAMETER_NAMES, chosen):
+        if name.startswith("black"):
+            parameters[name] = int(value)
+        else:
+            parameters[name] = float(value)
+    return parameters, int(best), correct.size
+
+def format_confusion_matrix(matrix):
+    lines = ["label\\number " + " ".join("%3d" % number
+                                       for number in range(NUMBER_COUNT)) +
+             " None"]
+    for label in range(NUMBER_COUNT):
+        lines.append("%12d " % label +
+                     " ".join("%3d" % count for count in matrix[label]))
+    return "\n".join(lines)
+
+def add_arguments(parser):
+    parser.add_argument("inputs", nargs="*",
+                        help="directories or glob patterns of labeled "
+                        "pictures, default: the bundled VGA and 720p pictures")
+    parser.add_argument("--position", type=int, nargs=4,
+                        metavar=("LEFT", "TOP", "WIDTH", "HEIGHT"),
+                        help="position of the billiards in the pictures, "
+                        "needed with inputs")
+    parser.add_argument("--steps", type=int, default=5,
+                        help="count of values of each parameter in the grid")
+    parser.add_argument("--cache", default=None, metavar="DIRECTORY",
+                        help="feature store, pictures in it are not decoded")
+    parser.add_argument("--output", default=None,
+                        help="write best parameters and confusion matrix to "
+                        "this JSON file")
+    parser.set_defaults(func=command)
+
+def command(args):
+    from BilliardsDistinguish.batch import list_image_files
+    from BilliardsDistinguish.benchmark import DEFAULT_PICTURE_DIR, \
+        PICTURE_SETS
+    if args.inputs:
+        assert args.position, "--position is needed with inputs"
+        sets = [([filename for pattern in args.inputs
+                  for filename in list_image_files(pattern)],
+                 tuple(args.position))]
+    else:
+        sets = [(list_image_files(os.path.join(DEFAULT_PICTURE_DIR, directory)),
+                 position) for name, directory, position in PICTURE_SETS]
+    store = None
+    if args.cache is not None:
+        store = FeatureStore(args.cache)
+    try:
+        start = timeit.default_timer()
+        features = merge_labeled_features(
+            [load_labeled_features(filenames, position, store)
+             for filenames, position in sets])
+        extracted = timeit.default_timer()
+    finally:
+        if store is not None:
+            store.close()
+    parameters, correct, evaluated = tune_parameters(
+        features, get_default_grid(args.steps))
+    tuned = timeit.default_timer()
+    currentCorrect = int((predict_numbers(features) == features.labels).sum())
+    matrix = get_confusion_matrix(features.labels,
+                                  predict_numbers(features, parameters))
+    sys.stderr.write("%d pictures, features %.2fs, %d parameter sets %.2fs\n" %
+                     (len(features), extracted - start, evaluated,
+                      tuned - extracted))
+    print "current: %d/%d correct" % (currentCorrect, len(features))
+    print "best: %d/%d correct" % (correct, len(features))
+    for name, value in parameters.items():
+        print "    %s = %s" % (name, value)
+    print format_confusion_matrix(matrix)
+    if args.output is not None:
+        with open(args.output, "w") as fp:
+            json.dump(OrderedDict((("parameters", parameters),
+                                   ("correct", correct),
+                                   ("pictures", len(features)),
+                                   ("confusion_matrix", matrix.tolist()))),
+                      fp, indent=2)
+    return 0
+
+
+
+###############################################################################
+# for unit test
+###############################################################################
+class TuningTest(unittest.TestCase):
+    PICTURE_DIR = "../../../pictures/VGA"
+    POSITION = (215, 130, 265, 265)
+
+    def test_getLabel(self):
+        self.assertEqual(get_label("pictures/VGA/9_b.jpg"), 9)
+        self.assertEqual(get_label("pictures/720p/12.jpg"), 12)
+        self.assertEqual(get_label("pictures/frame.jpg"), None)
+
+    def test_predictNumbers(self):
+        random = numpy.random.RandomState(0)
+        count = 500
+        features = LabeledFeatures(
+            ["x"] * count, numpy.zeros(count),
+            numpy.column_stack((numpy.full(count, 100),
+                                random.randint(0, 101, count),
+                                random.randint(0, 256, (count, 3)))))
+        numbers = predict_numbers(features)
+        for i in xrange(count):
+            number = get_billiards_number(features.ratios[i], int(features.r[i]),
+                                          int(features.g[i]), int(features.b[i]))
+            self.assertEqual(numbers[i], -1 if number is None else number)
+
+    def test_tuneParameters(self):
+        from BilliardsDistinguish.batch import list_image_files
+        features = load_labeled_features(list_image_files(self.PICTURE_DIR),
+                                         self.POSITION)
+        current = (predict_numbers(features) == features.labels).sum()
+        parameters, correct, evaluated = tune_parameters(features,
+                                                         get_default_grid(3))
+        self.assertTrue(correct >= current)
+        self.assertTrue(evaluated > 1000)
+        numbers = predict_numbers(features, parameters)
+        self.assertEqual((numbers == features.labels).sum(), correct)
+        matrix = get_confusion_matrix(features.labels, numbers)
+        self.assertEqual(matrix.sum(), len(features))
+        self.assertEqual(numpy.trace(matrix), correct)
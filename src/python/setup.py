@@ -7,7 +7,12 @@ setup(name="BilliardsDistinguish",
       author="tran-wang",
       author_email="doublechuan.wang@gmail.com",
       packages=find_packages(),
-      install_requires=["PIL"],
+      entry_points={
+          "console_scripts": [
+              "billiards-distinguish = BilliardsDistinguish.cli:main",
+          ],
+      },
+      install_requires=["PIL", "numpy"],
       tests_require = ["nose>=1.3"],
       test_suite="nose.collector"
       )
\ No newline at end of file